@@ -14,37 +14,55 @@
 # =============================================================================
 
 
-from time import sleep
 import squad_QSL
 import mlperf_loadgen as lg
 import numpy as np
-import threading
 import requests
 import array
-import time
+import functools
 import os
 import sys
 
 sys.path.insert(0, os.getcwd())
 
+import binary_protocol
+from dispatcher import Dispatcher
+
 
 class bert_QDL:
     """QDL acting as a proxy to the SUT.
     This QDL communicates with the SUT via HTTP.
-    It uses two endpoints to communicate with the SUT:
-    - /predict/ : Send a query to the SUT and get a response.
+    It uses three endpoints to communicate with the SUT:
+    - /predict_binary/ : Send a batch of queries as raw arrays and get their responses.
+    - /predict/ : Send a query to the SUT as json and get a response.
     - /getname/ : Get the name of the SUT. Send a getname to the SUT and get a response.
+    Requests go over a pool of persistent connections, each to the least
+    loaded healthy SUT node (see lon/dispatcher.py).
     """
 
-    def __init__(self, qsl: squad_QSL.SQuAD_v1_QSL, sut_server_addr: list):
+    def __init__(
+        self,
+        qsl: squad_QSL.SQuAD_v1_QSL,
+        sut_server_addr: list,
+        protocol: str = "binary",
+        batch_size: int = 8,
+        max_outstanding: int = 4,
+    ):
         """
         Constructor for the QDL.
         Args:
             qsl: The QSL to use.
             sut_server_addr: A list of addresses of the SUT.
+            protocol: "binary" or "json".
+            batch_size: Maximum number of samples per binary request.
+            max_outstanding: Maximum number of requests in flight per SUT.
         """
         self.qsl = qsl
         self.quantized = False
+        self.protocol = protocol
+        self.batch_size = batch_size if protocol == "binary" else 1
+
+        self.session = binary_protocol.new_session(max_outstanding)
 
         # Construct QDL from the python binding
         self.qdl = lg.ConstructQDL(
@@ -52,16 +70,11 @@ class bert_QDL:
         )
         self.sut_server_addr = sut_server_addr
         self.num_nodes = len(sut_server_addr)
-
-        # For round robin between the SUTs:
-        self.next_sut_id = 0
-        self.lock = threading.Lock()
+        self.dispatcher = Dispatcher(sut_server_addr, max_outstanding)
 
     def issue_query(self, query_samples):
         """Process the query to send to the SUT"""
-        threading.Thread(
-            target=self.process_query_async,
-            args=[query_samples]).start()
+        self.process_query_async(query_samples)
 
     def flush_queries(self):
         """Flush the queries. Dummy implementation."""
@@ -69,59 +82,79 @@ class bert_QDL:
 
     def process_query_async(self, query_samples):
         """
-        This function is called by the Loadgen in a separate thread.
-        It is responsible for
-            1. Creating a query for the SUT, by reading the features from the QSL.
-            2. Sending the query to the SUT.
-            3. Waiting for the response from the SUT.
-            4. Deserializing the response.
-            5. Calling mlperf_loadgen.QuerySamplesComplete(query_samples, response)
+        This function is called by the Loadgen.
+        It creates the queries for the SUT by reading the features from the
+        QSL and hands them to the dispatcher, which sends them to the SUT
+        nodes in the background. client_predict_worker then
+            1. Sends the query to the SUT.
+            2. Waits for the response from the SUT.
+            3. Deserializes the response.
+            4. Calls mlperf_loadgen.QuerySamplesComplete(query_samples, response)
         Args:
             query_samples: A list of QuerySample objects.
         """
 
-        max_num_threads = int(
-            os.environ.get(
-                "CM_MAX_NUM_THREADS",
-                os.cpu_count()))
-
-        for i in range(len(query_samples)):
-            eval_features = self.qsl.get_features(query_samples[i].index)
-            encoded_eval_features = {
-                "input_ids": eval_features.input_ids,
-                "input_mask": eval_features.input_mask,
-                "segment_ids": eval_features.segment_ids,
-            }
-            n = threading.active_count()
-            while n >= max_num_threads:
-                sleep(0.0001)
-                n = threading.active_count()
-            threading.Thread(
-                target=self.client_predict_worker,
-                args=[encoded_eval_features, query_samples[i].id],
-            ).start()
-
-    def get_sut_id_round_robin(self):
-        """Get the SUT id in round robin."""
-        with self.lock:
-            res = self.next_sut_id
-            self.next_sut_id = (self.next_sut_id + 1) % self.num_nodes
-        return res
-
-    def client_predict_worker(self, query, query_id):
-        """Serialize the query, send it to the SUT in round robin, and return the deserialized response."""
-        url = "{}/predict/".format(
-            self.sut_server_addr[self.get_sut_id_round_robin()])
-        responses = []
-        response = requests.post(url, json={"query": query})
-        output = response.json()["result"]
-        output = np.array(output).astype(np.float32)
-        response_array = array.array("B", output.tobytes())
-        bi = response_array.buffer_info()
+        for i in range(0, len(query_samples), self.batch_size):
+            batch = query_samples[i: i + self.batch_size]
+            queries = []
+            for q in batch:
+                if self.protocol == "binary":
+                    # rows of the QSL's arrays, sent as int32
+                    eval_features = {
+                        "input_ids": self.qsl.input_ids[q.index],
+                        "input_mask": self.qsl.input_mask[q.index],
+                        "segment_ids": self.qsl.segment_ids[q.index],
+                    }
+                else:
+                    features = self.qsl.get_features(q.index)
+                    eval_features = {
+                        "input_ids": features.input_ids,
+                        "input_mask": features.input_mask,
+                        "segment_ids": features.segment_ids,
+                    }
+                queries.append(eval_features)
+            query_ids = [q.id for q in batch]
+            self.dispatcher.submit(
+                self.client_predict_worker,
+                queries,
+                query_ids,
+                size=len(batch),
+                on_failure=functools.partial(
+                    self.client_predict_failed, query_ids))
+
+    def client_predict_worker(self, sut_addr, queries, query_ids):
+        """Serialize the queries, send them to the SUT at sut_addr, and return the deserialized responses."""
+        if self.protocol == "binary":
+            results = binary_protocol.post(
+                self.session,
+                "{}/predict_binary/".format(sut_addr),
+                queries,
+                {"input_ids": np.int32, "input_mask": np.int32, "segment_ids": np.int32},
+            )
+            outputs = [result["output"] for result in results]
+        else:
+            response = self.session.post(
+                "{}/predict/".format(sut_addr), json={"query": queries[0]})
+            response.raise_for_status()
+            outputs = [np.array(response.json()["result"]).astype(np.float32)]
 
-        responses.append(lg.QuerySampleResponse(query_id, bi[0], bi[1]))
+        responses = []
+        response_arrays = []
+        for query_id, output in zip(query_ids, outputs):
+            response_array = array.array("B", output.tobytes())
+            response_arrays.append(response_array)
+            bi = response_array.buffer_info()
+            responses.append(lg.QuerySampleResponse(query_id, bi[0], bi[1]))
         lg.QuerySamplesComplete(responses)
 
+    def client_predict_failed(self, query_ids, error):
+        """Completes the samples of a request that failed on every SUT node
+        with empty responses, so that loadgen does not wait for them forever.
+        The run is not valid then."""
+        print(f"Completing {len(query_ids)} samples with empty responses: {error!r}")
+        lg.QuerySamplesComplete(
+            [lg.QuerySampleResponse(query_id, 0, 0) for query_id in query_ids])
+
     def client_get_name(self):
         """Get the name of the SUT from ALL the SUTS."""
         if len(self.sut_server_addr) == 1:
@@ -135,4 +168,7 @@ class bert_QDL:
         return "Multi-node SUT: " + ", ".join(sut_names)
 
     def __del__(self):
+        for node in self.dispatcher.stats():
+            print(node)
+        self.dispatcher.close()
         lg.DestroyQDL(self.qdl)
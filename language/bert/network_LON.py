@@ -33,9 +33,12 @@ def set_args(
     g_backend,
     g_total_count_override=None,
     g_perf_count_override=None,
+    g_protocol="binary",
+    g_batch_size=8,
+    g_max_outstanding=4,
 ):
 
-    global settings, log_settings, audit_conf, sut_server, total_count_override, perf_count_override, backend
+    global settings, log_settings, audit_conf, sut_server, total_count_override, perf_count_override, backend, protocol, batch_size, max_outstanding
     sys.argv = sys.argv[0:1]
     settings = g_settings
     log_settings = g_log_settings
@@ -44,11 +47,20 @@ def set_args(
     total_count_override = g_total_count_override
     perf_count_override = g_perf_count_override
     backend = g_backend
+    protocol = g_protocol
+    batch_size = g_batch_size
+    max_outstanding = g_max_outstanding
 
 
 def main(argv):
     qsl = squad_QSL.get_squad_QSL(total_count_override, perf_count_override)
-    qdl = bert_QDL.bert_QDL(qsl, sut_server_addr=sut_server)
+    qdl = bert_QDL.bert_QDL(
+        qsl,
+        sut_server_addr=sut_server,
+        protocol=protocol,
+        batch_size=batch_size,
+        max_outstanding=max_outstanding,
+    )
 
     lg.StartTestWithLogSettings(
         qdl.qdl,
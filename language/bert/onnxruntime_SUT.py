@@ -15,7 +15,7 @@
 # limitations under the License.
 
 from time import sleep
-from squad_QSL import get_squad_QSL
+from squad_QSL import get_squad_QSL, max_seq_length
 from transformers import BertConfig, BertForQuestionAnswering
 import onnxruntime
 import numpy as np
@@ -24,6 +24,7 @@ import threading
 import array
 import json
 import os
+import queue
 import sys
 
 sys.path.insert(0, os.getcwd())
@@ -60,28 +61,117 @@ class BERT_ONNXRuntime_SUT:
                 model_path, self.options, providers=["CPUExecutionProvider"]
             )
 
+        if self.quantized:
+            self.input_names = ["input_ids", "attention_mask", "token_type_ids"]
+        else:
+            self.input_names = ["input_ids", "input_mask", "segment_ids"]
+
+        # a fixed batch or sequence dimension of the model overrides the
+        # requested batch size / sequence bucketing
+        batch_dim, seq_dim = self.sess.get_inputs()[0].shape[:2]
+        self.batch_size = args.batch_size
+        if isinstance(batch_dim, int):
+            self.batch_size = min(self.batch_size, batch_dim)
+        self.seq_bucket = args.seq_bucket
+        if isinstance(seq_dim, int):
+            self.seq_bucket = 0
+        self.num_workers = args.num_workers
+        if "CM_MAX_NUM_THREADS" in os.environ:
+            print(
+                "CM_MAX_NUM_THREADS is ignored, the number of threads running "
+                "batches is set by --num_workers"
+            )
+        print(
+            "Batch size {}, sequence bucket {}, {} workers".format(
+                self.batch_size, self.seq_bucket or "off", self.num_workers
+            )
+        )
+
         print("Constructing SUT...")
         self.sut = lg.ConstructSUT(self.issue_queries, self.flush_queries)
         print("Finished constructing SUT.")
 
         self.qsl = get_squad_QSL(args.max_examples)
 
+        self.query_queue = queue.Queue()
+        self.workers = []
+        if self.network != "sut":
+            for _ in range(self.num_workers):
+                worker = threading.Thread(target=self.process_queries)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
     def issue_queries(self, query_samples):
-        max_num_threads = int(
-            os.environ.get(
-                "CM_MAX_NUM_THREADS",
-                os.cpu_count()))
-
-        for i in range(len(query_samples)):
-            eval_features = self.qsl.get_features(query_samples[i].index)
-            n = threading.active_count()
-            while n >= max_num_threads:
-                # sleep(0.01)
-                n = threading.active_count()
-            threading.Thread(
-                target=self.process_sample, args=[
-                    eval_features, query_samples[i].id]
-            ).start()
+        if len(query_samples) > 1:
+            # longest first, so the batches drained from the queue hold
+            # samples of similar length
+            seq_lens = self.qsl.seq_lens
+            query_samples = sorted(
+                query_samples, key=lambda q: seq_lens[q.index], reverse=True
+            )
+        for q in query_samples:
+            self.query_queue.put(q)
+
+    def process_queries(self):
+        """Worker loop. Blocks for one sample, then batches the samples that
+        are already queued, up to batch_size. Ends at the None that stop()
+        queues for every worker."""
+        while True:
+            qitem = self.query_queue.get()
+            if qitem is None:
+                break
+            qitems = [qitem]
+            while len(qitems) < self.batch_size:
+                try:
+                    qitem = self.query_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if qitem is None:
+                    self.process_batch(qitems)
+                    return
+                qitems.append(qitem)
+            self.process_batch(qitems)
+
+    def process_batch(self, qitems):
+        indices = np.array([q.index for q in qitems])
+        seq_len = max_seq_length
+        if self.seq_bucket:
+            # run only up to the longest sample, rounded up to the bucket
+            longest = int(self.qsl.seq_lens[indices].max())
+            seq_len = min(
+                max_seq_length,
+                -(-longest // self.seq_bucket) * self.seq_bucket,
+            )
+        # the QSL keeps the inputs as int64, the dtype of the model inputs,
+        # so the rows are gathered without a conversion
+        arrays = (self.qsl.input_ids, self.qsl.input_mask, self.qsl.segment_ids)
+        fd = {
+            name: a[indices, :seq_len]
+            for name, a in zip(self.input_names, arrays)
+        }
+
+        scores = self.sess.run([o.name for o in self.sess.get_outputs()], fd)
+        output = np.stack(scores, axis=-1)
+        if seq_len < max_seq_length:
+            # positions past the bucket are padding, give them logits that
+            # are never picked as answer start or end
+            padded = np.full(
+                (len(qitems), max_seq_length, output.shape[-1]),
+                -10000.0,
+                dtype=output.dtype,
+            )
+            padded[:, :seq_len] = output
+            output = padded
+
+        responses = []
+        response_arrays = []
+        for q, sample_output in zip(qitems, output):
+            response_array = array.array("B", sample_output.tobytes())
+            response_arrays.append(response_array)
+            bi = response_array.buffer_info()
+            responses.append(lg.QuerySampleResponse(q.id, bi[0], bi[1]))
+        lg.QuerySamplesComplete(responses)
 
     def process_sample(self, eval_features, query_id=None):
         """For Loadgen over the network"""
@@ -94,18 +184,11 @@ class BERT_ONNXRuntime_SUT:
             input_mask = eval_features.input_mask
             segment_ids = eval_features.segment_ids
 
-        if self.quantized:
-            fd = {
-                "input_ids": np.array(input_ids).astype(np.int64)[np.newaxis, :],
-                "attention_mask": np.array(input_mask).astype(np.int64)[np.newaxis, :],
-                "token_type_ids": np.array(segment_ids).astype(np.int64)[np.newaxis, :],
-            }
-        else:
-            fd = {
-                "input_ids": np.array(input_ids).astype(np.int64)[np.newaxis, :],
-                "input_mask": np.array(input_mask).astype(np.int64)[np.newaxis, :],
-                "segment_ids": np.array(segment_ids).astype(np.int64)[np.newaxis, :],
-            }
+        fd = {
+            name: np.array(a, dtype=np.int64)[np.newaxis, :]
+            for name, a in zip(
+                self.input_names, (input_ids, input_mask, segment_ids))
+        }
 
         scores = self.sess.run([o.name for o in self.sess.get_outputs()], fd)
         output = np.stack(scores, axis=-1)[0]
@@ -121,6 +204,13 @@ class BERT_ONNXRuntime_SUT:
     def flush_queries(self):
         pass
 
+    def stop(self):
+        for _ in self.workers:
+            self.query_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
     def __del__(self):
         if self.profile:
             print(
@@ -76,6 +76,26 @@ def get_args():
         default=None,
         help="Loadgen network mode",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="maximum batch size (only valid for onnxruntime backend)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=2,
+        help="number of threads running batches (only valid for onnxruntime backend)",
+    )
+    parser.add_argument(
+        "--seq_bucket",
+        type=int,
+        default=0,
+        help="run batches only up to their longest sample, rounded up to a "
+        "multiple of this length. Needs a model with a dynamic sequence "
+        "axis, 0 disables (only valid for onnxruntime backend)",
+    )
     parser.add_argument("--node", type=str, default="")
     parser.add_argument("--port", type=int, default=8000)
     parser.add_argument(
@@ -84,6 +104,24 @@ def get_args():
         default=["http://localhost:8000"],
         help="Address of the server(s) under test.",
     )
+    parser.add_argument(
+        "--network_protocol",
+        choices=["binary", "json"],
+        default="binary",
+        help="Loadgen over the network: send raw int32/float32 arrays or json lists",
+    )
+    parser.add_argument(
+        "--network_batch_size",
+        type=int,
+        default=8,
+        help="Loadgen over the network: samples per binary request",
+    )
+    parser.add_argument(
+        "--network_max_outstanding",
+        type=int,
+        default=4,
+        help="Loadgen over the network: requests in flight per SUT node",
+    )
 
     args = parser.parse_args()
     return args
@@ -183,6 +221,9 @@ def main():
             args.sut_server,
             args.backend,
             args.max_examples,
+            g_protocol=args.network_protocol,
+            g_batch_size=args.network_batch_size,
+            g_max_outstanding=args.network_max_outstanding,
         )
         app.run(app_main)
 
@@ -212,6 +253,9 @@ def main():
     print("Done!")
 
     if sut:
+        if hasattr(sut, "stop"):
+            sut.stop()
+
         print("Destroying SUT...")
         lg.DestroySUT(sut.sut)
 
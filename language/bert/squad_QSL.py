@@ -17,12 +17,16 @@
 
 import pickle
 import mlperf_loadgen as lg
+import numpy as np
 from create_squad_data import read_squad_examples, convert_examples_to_features
 from transformers import BertTokenizer
+import multiprocessing
 import os
 import sys
 
 sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from packed_arrays import encoding_key, load_packed, save_packed
 
 
 # To support feature cache.
@@ -32,6 +36,64 @@ max_query_length = 64
 doc_stride = 128
 
 
+_tokenizer = None
+
+
+def _init_tokenizer(vocab_file):
+    global _tokenizer
+    _tokenizer = BertTokenizer(vocab_file)
+
+
+def _convert_chunk(examples):
+    features = []
+    convert_examples_to_features(
+        examples=examples,
+        tokenizer=_tokenizer,
+        max_seq_length=max_seq_length,
+        doc_stride=doc_stride,
+        max_query_length=max_query_length,
+        is_training=False,
+        output_fn=features.append,
+        verbose_logging=False,
+    )
+    return features
+
+
+def convert_examples_parallel(examples, vocab_file, num_workers=None):
+    """Runs convert_examples_to_features on chunks of the examples in a
+    process pool. The features are numbered as by a single call."""
+    num_workers = num_workers or os.cpu_count()
+    chunk_size = max(1, -(-len(examples) // (num_workers * 8)))
+    chunks = [
+        examples[i: i + chunk_size] for i in range(0, len(examples), chunk_size)
+    ]
+    with multiprocessing.Pool(
+        num_workers, _init_tokenizer, (vocab_file,)
+    ) as pool:
+        chunk_features = pool.map(_convert_chunk, chunks)
+
+    eval_features = []
+    unique_id = 1000000000
+    example_offset = 0
+    for chunk, features in zip(chunks, chunk_features):
+        for feature in features:
+            feature.unique_id = unique_id
+            feature.example_index += example_offset
+            unique_id += 1
+            eval_features.append(feature)
+        example_offset += len(chunk)
+    return eval_features
+
+
+class PackedFeatures(object):
+    """Model inputs of one feature, as lists like in InputFeatures"""
+
+    def __init__(self, input_ids, input_mask, segment_ids):
+        self.input_ids = input_ids
+        self.input_mask = input_mask
+        self.segment_ids = segment_ids
+
+
 class SQuAD_v1_QSL:
     def __init__(
         self,
@@ -40,55 +102,82 @@ class SQuAD_v1_QSL:
         cache_path="eval_features.pickle",
     ):
         print("Constructing QSL...")
-        eval_features = []
-        # Load features if cached, convert from examples otherwise.
-        if os.path.exists(cache_path):
-            print("Loading cached features from '%s'..." % cache_path)
-            with open(cache_path, "rb") as cache_file:
-                eval_features = pickle.load(cache_file)
+        vocab_file = os.environ.get("VOCAB_FILE")
+        if not vocab_file:
+            vocab_file = "build/data/bert_tf_v1_1_large_fp32_384_v2/vocab.txt"
+        dataset_file = os.environ.get("DATASET_FILE")
+        if not dataset_file:
+            dataset_file = "build/data/dev-v1.1.json"
+
+        # The model inputs are kept as int64 arrays, the dtype the backends
+        # feed to the model, in a directory per vocabulary, dataset and
+        # feature configuration, and memory-mapped by later runs. Without
+        # the sources, the features cache is the key.
+        sources = [vocab_file, dataset_file]
+        if not all(os.path.exists(path) for path in sources):
+            sources = [cache_path]
+        key = encoding_key(
+            sources,
+            max_seq_length=max_seq_length,
+            max_query_length=max_query_length,
+            doc_stride=doc_stride,
+            dtype="int64",
+        )
+        packed_dir = os.path.join(
+            os.path.splitext(cache_path)[0] + ".packed", key)
+        names = ["input_ids", "input_mask", "segment_ids", "seq_lens"]
+        packed = load_packed(packed_dir, names)
+
+        if packed is not None:
+            print("Loading packed features from '%s'..." % packed_dir)
         else:
-            print(
-                "No cached features at '%s'... converting from examples..." % cache_path
-            )
-
-            print("Creating tokenizer...")
-            vocab_file = os.environ.get("VOCAB_FILE")
-            if not vocab_file:
-                vocab_file = "build/data/bert_tf_v1_1_large_fp32_384_v2/vocab.txt"
-            tokenizer = BertTokenizer(vocab_file)
-
-            print("Reading examples...")
-            dataset_file = os.environ.get("DATASET_FILE")
-            if not dataset_file:
-                dataset_file = "build/data/dev-v1.1.json"
-            eval_examples = read_squad_examples(
-                input_file=dataset_file,
-                is_training=False,
-                version_2_with_negative=False,
-            )
-
-            print("Converting examples to features...")
-
-            def append_feature(feature):
-                eval_features.append(feature)
-
-            convert_examples_to_features(
-                examples=eval_examples,
-                tokenizer=tokenizer,
-                max_seq_length=max_seq_length,
-                doc_stride=doc_stride,
-                max_query_length=max_query_length,
-                is_training=False,
-                output_fn=append_feature,
-                verbose_logging=False,
-            )
-
-            print("Caching features at '%s'..." % cache_path)
-            with open(cache_path, "wb") as cache_file:
-                pickle.dump(eval_features, cache_file)
-
-        self.eval_features = eval_features
-        self.count = total_count_override or len(self.eval_features)
+            # Load features if cached, convert from examples otherwise.
+            if os.path.exists(cache_path):
+                print("Loading cached features from '%s'..." % cache_path)
+                with open(cache_path, "rb") as cache_file:
+                    eval_features = pickle.load(cache_file)
+            else:
+                print(
+                    "No cached features at '%s'... converting from examples..."
+                    % cache_path
+                )
+
+                print("Reading examples...")
+                eval_examples = read_squad_examples(
+                    input_file=dataset_file,
+                    is_training=False,
+                    version_2_with_negative=False,
+                )
+
+                print("Converting examples to features...")
+                eval_features = convert_examples_parallel(
+                    eval_examples, vocab_file)
+
+                # the accuracy script reads the full features from here
+                print("Caching features at '%s'..." % cache_path)
+                with open(cache_path, "wb") as cache_file:
+                    pickle.dump(eval_features, cache_file)
+
+            input_mask = np.array(
+                [f.input_mask for f in eval_features], np.int64)
+            packed = {
+                "input_ids": np.array(
+                    [f.input_ids for f in eval_features], np.int64),
+                "input_mask": input_mask,
+                "segment_ids": np.array(
+                    [f.segment_ids for f in eval_features], np.int64
+                ),
+                "seq_lens": input_mask.sum(axis=1, dtype=np.int32),
+            }
+            save_packed(packed_dir, packed)
+
+        # int64 [count, max_seq_length] model inputs, for backends that
+        # batch samples
+        self.input_ids = packed["input_ids"]
+        self.input_mask = packed["input_mask"]
+        self.segment_ids = packed["segment_ids"]
+        self.seq_lens = packed["seq_lens"]
+        self.count = total_count_override or len(self.input_ids)
         self.perf_count = perf_count_override or self.count
         self.qsl = lg.ConstructQSL(
             self.count,
@@ -105,7 +194,11 @@ class SQuAD_v1_QSL:
         pass
 
     def get_features(self, sample_id):
-        return self.eval_features[sample_id]
+        return PackedFeatures(
+            self.input_ids[sample_id].tolist(),
+            self.input_mask[sample_id].tolist(),
+            self.segment_ids[sample_id].tolist(),
+        )
 
     def __del__(self):
         print("Finished destroying QSL.")
@@ -1,27 +1,44 @@
 # For QDL
-import threading
 import requests
-from time import sleep
 import mlperf_loadgen as lg
-import os
 import numpy as np
 import array
+import functools
 import time
 
+import binary_protocol
+from dispatcher import Dispatcher
+
 
 class GPTJ_QDL:
     """QDL acting as a proxy to the SUT.
     This QDL communicates with the SUT via HTTP.
-    It uses two endpoints to communicate with the SUT:
-    - /predict/ : Send a query to the SUT and get a response.
+    It uses three endpoints to communicate with the SUT:
+    - /predict_binary/ : Send a batch of queries as raw token arrays and get their output tokens.
+    - /predict/ : Send a query to the SUT as json and get a response.
     - /getname/ : Get the name of the SUT. Send a getname to the SUT and get a response.
+    Requests go over a pool of persistent connections, each to the least
+    loaded healthy SUT node (see lon/dispatcher.py).
     """
 
-    def __init__(self, qsl, sut_server_addr: list, scenario: str):
+    def __init__(
+        self,
+        qsl,
+        sut_server_addr: list,
+        scenario: str,
+        protocol: str = "binary",
+        batch_size: int = 1,
+        max_outstanding: int = 2,
+    ):
         self.scenario = scenario
         self.sut_server_addr = sut_server_addr
         self.num_nodes = len(sut_server_addr)
         self.qsl = qsl
+        self.protocol = protocol
+        self.batch_size = batch_size if protocol == "binary" else 1
+
+        self.session = binary_protocol.new_session(max_outstanding)
+        self.dispatcher = Dispatcher(sut_server_addr, max_outstanding)
 
         # Construct QDL from the python binding
         self.qdl = lg.ConstructQDL(
@@ -29,15 +46,9 @@ class GPTJ_QDL:
         )
         print("Finished constructing QDL!")
 
-        # For round robin between the SUTs:
-        self.next_sut_id = 0
-        self.lock = threading.Lock()
-
     def issue_query(self, query_samples):
         """Process the query to send to the SUT"""
-        threading.Thread(
-            target=self.process_query_async,
-            args=[query_samples]).start()
+        self.process_query_async(query_samples)
 
     def flush_queries(self):
         """Flush the queries. Dummy implementation."""
@@ -45,94 +56,114 @@ class GPTJ_QDL:
 
     def process_query_async(self, query_samples):
         """
-        This function is called by the Loadgen in a separate thread.
-        It is responsible for
-            1. Creating a query for the SUT, by reading the features from the QSL.
-            2. Sending the query to the SUT.
-            3. Waiting for the response from the SUT.
-            4. Deserializing the response.
-            5. Calling mlperf_loadgen.QuerySamplesComplete(query_samples, response)
+        This function is called by the Loadgen.
+        It creates the queries for the SUT by reading the features from the
+        QSL and hands them to the dispatcher, which sends them to the SUT
+        nodes in the background. client_predict_worker then
+            1. Sends the query to the SUT.
+            2. Waits for the response from the SUT.
+            3. Deserializes the response.
+            4. Calls mlperf_loadgen.QuerySamplesComplete(query_samples, response)
         Args:
             query_samples: A list of QuerySample objects.
         """
 
-        max_num_threads = int(
-            os.environ.get(
-                "CM_MAX_NUM_THREADS",
-                os.cpu_count()))
         if self.scenario == "Offline":
-            # Client sends multiple requests using threads
-            # Pause when active thread equals the set max number of threads
-            # Only sends next request after recieving respose from server to
-            # any of the currently active threads
+            # Client sends batches of samples through the dispatcher
+            # Only sends the next request to a SUT after recieving the
+            # response to one of its outstanding requests
             print("Executing Offline scenario!")
-            for i in range(len(query_samples)):
-                index = query_samples[i].index
-                input_ids_tensor = self.qsl.data_object.source_encoded_input_ids[index]
-                input_masks_tensor = self.qsl.data_object.source_encoded_attn_masks[
-                    index
-                ]
-                text = self.qsl.data_object.sources[index]
-                query = {
-                    "input_text": text,
-                    "input_ids_tensor": input_ids_tensor.tolist(),
-                    "input_masks_tensor": input_masks_tensor.tolist(),
-                }
-                n = threading.active_count()
-                while n >= max_num_threads:
-                    sleep(0.0001)
-                    n = threading.active_count()
-                threading.Thread(
-                    target=self.client_predict_worker, args=[
-                        query, query_samples[i].id]
-                ).start()
+            # samples of similar length are batched together
+            if self.batch_size > 1:
+                query_samples = sorted(
+                    query_samples,
+                    key=lambda q: self.qsl.data_object.source_encoded_input_ids[
+                        q.index
+                    ].shape[-1],
+                    reverse=True,
+                )
+            for i in range(0, len(query_samples), self.batch_size):
+                batch = query_samples[i: i + self.batch_size]
+                query_ids = [q.id for q in batch]
+                self.dispatcher.submit(
+                    self.client_predict_worker,
+                    [self.get_query(q.index) for q in batch],
+                    query_ids,
+                    size=len(batch),
+                    on_failure=functools.partial(
+                        self.client_predict_failed, query_ids),
+                )
         if self.scenario == "Server":
             # Client sends request to server
             # Number of samples can vary based on Poisson distribution
-            index = query_samples[0].index
-            input_ids_tensor = self.qsl.data_object.source_encoded_input_ids[index]
-            input_masks_tensor = self.qsl.data_object.source_encoded_attn_masks[index]
-            text = self.qsl.data_object.sources[index]
-            query = {
-                "input_text": text,
-                "input_ids_tensor": input_ids_tensor.tolist(),
-                "input_masks_tensor": input_masks_tensor.tolist(),
+            query_ids = [query_samples[0].id]
+            self.dispatcher.submit(
+                self.client_predict_worker,
+                [self.get_query(query_samples[0].index)],
+                query_ids,
+                on_failure=functools.partial(
+                    self.client_predict_failed, query_ids),
+            )
+
+    def get_query(self, index):
+        input_ids_tensor = self.qsl.data_object.source_encoded_input_ids[index]
+        input_masks_tensor = self.qsl.data_object.source_encoded_attn_masks[index]
+        if self.protocol == "binary":
+            return {
+                "input_ids": input_ids_tensor.numpy()[0],
+                "attention_mask": input_masks_tensor.numpy()[0],
             }
-            self.client_predict_worker(query, query_samples[0].id)
-
-    def get_sut_id_round_robin(self):
-        """Get the SUT id in round robin."""
-        with self.lock:
-            res = self.next_sut_id
-            self.next_sut_id = (self.next_sut_id + 1) % self.num_nodes
-        return res
-
-    def client_predict_worker(self, query, query_id):
-        """Serialize the query, send it to the SUT in round robin, and return the deserialized response."""
-        url = "{}/predict/".format(
-            self.sut_server_addr[self.get_sut_id_round_robin()])
-        responses = []
+        return {
+            "input_text": self.qsl.data_object.sources[index],
+            "input_ids_tensor": input_ids_tensor.tolist(),
+            "input_masks_tensor": input_masks_tensor.tolist(),
+        }
+
+    def client_predict_worker(self, sut_addr, queries, query_ids):
+        """Serialize the queries, send them to the SUT at sut_addr, and return the deserialized responses."""
         # Start the timer
         startTime = time.time()
-        # Sending the request to the server through POST method
-        # Upon recieving the response, it is stored in response variable
-        response = requests.post(url, json={"query": query})
+        if self.protocol == "binary":
+            results = binary_protocol.post(
+                self.session,
+                "{}/predict_binary/".format(sut_addr),
+                queries,
+                {"input_ids": np.int32, "attention_mask": np.int32},
+            )
+            output_batches = [result["pred_output"] for result in results]
+        else:
+            # Sending the request to the server through POST method
+            # Upon recieving the response, it is stored in response variable
+            response = self.session.post(
+                "{}/predict/".format(sut_addr), json={"query": queries[0]})
+            response.raise_for_status()
+            output = response.json()["result"]
+            print(queries[0]["input_text"])
+            print(output["response_text"])
+            output_batches = [
+                np.array(output["pred_output_batch"]).astype(np.int32)]
         # Measure the response time
         endTime = time.time()
         # calculate the latency
         print(f"Latency = {endTime-startTime}")
-        output = response.json()["result"]
-        response_text = output["response_text"]
-        print(query["input_text"])
-        print(response_text)
 
-        output_batch = np.array(output["pred_output_batch"]).astype(np.int32)
-        response_array = array.array("B", output_batch.tobytes())
-        bi = response_array.buffer_info()
-
-        responses.append(lg.QuerySampleResponse(query_id, bi[0], bi[1]))
+        responses = []
+        response_arrays = []
+        for query_id, output_batch in zip(query_ids, output_batches):
+            response_array = array.array("B", output_batch.tobytes())
+            response_arrays.append(response_array)
+            bi = response_array.buffer_info()
+            responses.append(lg.QuerySampleResponse(query_id, bi[0], bi[1]))
         lg.QuerySamplesComplete(responses)
 
+    def client_predict_failed(self, query_ids, error):
+        """Completes the samples of a request that failed on every SUT node
+        with empty responses, so that loadgen does not wait for them forever.
+        The run is not valid then."""
+        print(f"Completing {len(query_ids)} samples with empty responses: {error!r}")
+        lg.QuerySamplesComplete(
+            [lg.QuerySampleResponse(query_id, 0, 0) for query_id in query_ids])
+
     def client_get_name(self):
         """Get the name of the SUT from ALL the SUTS."""
         if len(self.sut_server_addr) == 1:
@@ -146,4 +177,7 @@ class GPTJ_QDL:
         return "Multi-node SUT: " + ", ".join(sut_names)
 
     def __del__(self):
+        for node in self.dispatcher.stats():
+            print(node)
+        self.dispatcher.close()
         lg.DestroyQDL(self.qdl)
@@ -31,8 +31,10 @@ class SUT_base:
         use_gpu=False,
         network=None,
         qsl=None,
+        batch_size=1,
     ):
         self.network = network
+        self.batch_size = batch_size
         self.model_name = "EleutherAI/gpt-j-6B"
         self.model_path = model_path
         self.use_gpu = use_gpu
@@ -111,30 +113,81 @@ class SUT_base:
     def issue_queries(self, query_samples):
         print("Number of Samples in query_samples : ", len(query_samples))
 
-        total_samples_done = 0
-        list_prompts_tokens = []
-        list_prompts_attn_masks = []
-
-        # Pass each query to inference_call function
+        # Runs the queries in batches of batch_size
         # Activates only when scenario is Offline and network mode is None
-        for i in tqdm(range(len(query_samples))):
-            index = query_samples[i].index
-            input_ids_tensor = self.qsl.data_object.source_encoded_input_ids[index]
-            input_masks_tensor = self.qsl.data_object.source_encoded_attn_masks[index]
-            text = self.qsl.data_object.sources[index]
-            query = {
-                "input_text": text,
-                "input_ids_tensor": input_ids_tensor.tolist(),
-                "input_masks_tensor": input_masks_tensor.tolist(),
-            }
-            self.inference_call(query, query_samples[i].id)
+        data_object = self.qsl.data_object
+        # group samples of similar length, so that little left padding is
+        # needed within a batch
+        query_samples = sorted(
+            query_samples,
+            key=lambda q: data_object.source_encoded_input_ids[q.index].shape[-1],
+            reverse=True,
+        )
+        for i in tqdm(range(0, len(query_samples), self.batch_size)):
+            batch = query_samples[i: i + self.batch_size]
+            pred_outputs = self.inference_batch(
+                [data_object.source_encoded_input_ids[q.index] for q in batch],
+                [data_object.source_encoded_attn_masks[q.index] for q in batch],
+            )
+
+            response_arrays = []
+            responses = []
+            for q, pred_output in zip(batch, pred_outputs):
+                response_array = array.array("B", pred_output.tobytes())
+                response_arrays.append(response_array)
+                bi = response_array.buffer_info()
+                responses.append(lg.QuerySampleResponse(q.id, bi[0], bi[1]))
+            lg.QuerySamplesComplete(responses)
+
+    def inference_batch(self, input_ids, input_masks):
+        """Runs a batch of encoded samples of shape (1, seq_len), left padded
+        to the longest one. Returns the generated tokens of each sample, as
+        they would be generated at batch size 1"""
+        torch_device_type = "cuda" if self.use_gpu else "cpu"
+        eos_token_id = self.tokenizer.eos_token_id
+
+        max_len = max(x.shape[-1] for x in input_ids)
+        input_ids_tensor = torch.cat(
+            [pad(x, (max_len - x.shape[-1], 0), value=eos_token_id)
+             for x in input_ids]
+        )
+        input_masks_tensor = torch.cat(
+            [pad(x, (max_len - x.shape[-1], 0), value=0) for x in input_masks]
+        )
+
+        # Moves the tensor to CPU or GPU as per argument passed by user
+        input_ids_tensor = input_ids_tensor.to(torch_device_type)
+        input_masks_tensor = input_masks_tensor.to(torch_device_type)
+
+        with torch.inference_mode(), torch.autocast(
+            device_type=torch_device_type,
+            enabled=self.amp_enabled,
+            dtype=self.amp_dtype if self.amp_enabled else None,
+        ):
+            output_batch = self.model.generate(
+                input_ids=input_ids_tensor,
+                attention_mask=input_masks_tensor,
+                **gen_kwargs,
+                pad_token_id=eos_token_id,
+            )
+
+        pred_outputs = []
+        for output in output_batch[:, max_len:].cpu().numpy():
+            # sequences that finished before the longest one of the batch are
+            # padded with eos after their own eos
+            eos = np.flatnonzero(output == eos_token_id)
+            if len(eos):
+                output = output[: eos[0] + 1]
+            pred_outputs.append(output)
+        return pred_outputs
 
     def inference_call(self, query, query_id=None):
         """Common for all scenarios"""
         torch_device_type = "cuda" if self.use_gpu else "cpu"
 
-        input_ids_tensor = torch.tensor(query["input_ids_tensor"])
-        input_masks_tensor = torch.tensor(query["input_masks_tensor"])
+        # lists when the query came over the network, tensors otherwise
+        input_ids_tensor = torch.as_tensor(query["input_ids_tensor"])
+        input_masks_tensor = torch.as_tensor(query["input_masks_tensor"])
 
         # Moves the tensor to CPU or GPU as per argument passed by user
         input_ids_tensor = input_ids_tensor.to(torch_device_type)
@@ -212,6 +265,7 @@ class SUT_Offline(SUT_base):
         use_gpu,
         network,
         qsl,
+        batch_size=1,
     ):
         SUT_base.__init__(
             self,
@@ -223,6 +277,7 @@ class SUT_Offline(SUT_base):
             use_gpu,
             network,
             qsl,
+            batch_size,
         )
 
     """IssueQuery and inference methods implemented in Base class"""
@@ -263,8 +318,8 @@ class SUT_Server(SUT_base):
         input_masks_tensor = self.qsl.data_object.source_encoded_attn_masks[index]
         text = self.qsl.data_object.sources[index]
         query = {
-            "input_ids_tensor": input_ids_tensor.tolist(),
-            "input_masks_tensor": input_masks_tensor.tolist(),
+            "input_ids_tensor": input_ids_tensor,
+            "input_masks_tensor": input_masks_tensor,
         }
         pred_output_batch = (
             self.inference_call(query, query_samples[0].id).cpu().numpy()
@@ -312,8 +367,8 @@ class SUT_SingleStream(SUT_base):
         input_ids_tensor = self.qsl.data_object.source_encoded_input_ids[index]
         input_masks_tensor = self.qsl.data_object.source_encoded_attn_masks[index]
         query = {
-            "input_ids_tensor": input_ids_tensor.tolist(),
-            "input_masks_tensor": input_masks_tensor.tolist(),
+            "input_ids_tensor": input_ids_tensor,
+            "input_masks_tensor": input_masks_tensor,
         }
 
         pred_output_batch = (
@@ -339,6 +394,7 @@ def get_SUT(
     use_gpu=False,
     network=None,
     qsl=None,
+    batch_size=1,
 ):
     if scenario == "Offline":
         return SUT_Offline(
@@ -350,6 +406,7 @@ def get_SUT(
             use_gpu,
             network,
             qsl,
+            batch_size,
         )
     elif scenario == "Server":
         return SUT_Server(
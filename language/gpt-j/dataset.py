@@ -8,9 +8,20 @@ from torch.nn.functional import pad
 from torch.utils.data import DataLoader
 from typing import Optional, Dict, Sequence
 import io
+import sys
 import utils
 import copy
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from packed_arrays import (
+    PackedMasks,
+    PackedTokens,
+    encoding_key,
+    load_packed,
+    pack_tokens,
+    save_packed,
+)
+
 PROMPT_DICT = {
     "prompt_input": (
         "Below is an instruction that describes a task, paired with an input that provides further context. "
@@ -44,9 +55,6 @@ class Dataset:
         self.pad_val = pad_val
         self.pad_max = pad_max
 
-        self.tokenizer = get_transformer_autotokenizer(self.model_name)
-        self.tokenizer.pad_token = self.tokenizer.eos_token
-
         self.list_data_dict = utils.jload(self.dataset_path)
 
         prompt_input, prompt_no_input = (
@@ -67,24 +75,39 @@ class Dataset:
         self.perf_count = perf_count_override or self.count
 
     def encode_samples(self):
-        print("Encoding Samples")
-
-        total_samples = len(self.sources)
-
-        source_encoded_input_ids = []
-        source_encoded_attn_masks = []
-
-        for i in range(total_samples):
-            source_encoded = self.tokenizer(
-                self.sources[i],
-                return_tensors="pt",
-                padding=True,
+        # The token ids are kept next to the dataset, in a directory per
+        # tokenizer and dataset content, and memory-mapped by later runs
+        max_length = 1919
+        key = encoding_key(
+            [self.dataset_path],
+            tokenizer=self.model_name,
+            use_fast=True,
+            max_length=max_length,
+            prompt=PROMPT_DICT["prompt_input"],
+        )
+        packed_dir = os.path.join(self.dataset_path + ".packed", key)
+        packed = load_packed(packed_dir, ["tokens", "offsets"])
+        if packed is None:
+            print("Encoding Samples")
+            self.tokenizer = get_transformer_autotokenizer(
+                self.model_name, use_fast=True)
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+            # the fast tokenizer encodes a batch on all cores
+            input_ids = self.tokenizer(
+                self.sources,
                 truncation=True,
-                max_length=1919,
-            )
-            source_encoded_input_ids.append(source_encoded.input_ids)
-            source_encoded_attn_masks.append(source_encoded.attention_mask)
-
+                max_length=max_length,
+            ).input_ids
+            tokens, offsets = pack_tokens(input_ids)
+            packed = {"tokens": tokens, "offsets": offsets}
+            save_packed(packed_dir, packed)
+        else:
+            print("Loading encoded samples from {}".format(packed_dir))
+
+        source_encoded_input_ids = PackedTokens(
+            packed["tokens"], packed["offsets"])
+        source_encoded_attn_masks = PackedMasks(source_encoded_input_ids)
         return source_encoded_input_ids, source_encoded_attn_masks
 
     def LoadSamplesToRam(self, sample_list):
@@ -4,6 +4,9 @@ import argparse
 import os
 import math
 import sys
+
+sys.path.insert(0, os.path.join(os.getcwd(), "..", "..", "lon"))
+
 from backend_PyTorch import get_SUT
 from GPTJ_QDL import GPTJ_QDL
 from GPTJ_QSL import get_GPTJ_QSL
@@ -49,6 +52,13 @@ def get_args():
     parser.add_argument(
         "--gpu", action="store_true", help="use GPU instead of CPU for the inference"
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Offline: number of samples generated together, samples of "
+        "similar length are batched",
+    )
     parser.add_argument(
         "--audit_conf",
         default="audit.conf",
@@ -79,6 +89,25 @@ def get_args():
         default=["http://localhost:8000"],
         help="Address of the server(s) under test.",
     )
+    parser.add_argument(
+        "--network_protocol",
+        choices=["binary", "json"],
+        default="binary",
+        help="Loadgen over the network: send raw token arrays or json lists",
+    )
+    parser.add_argument(
+        "--network_batch_size",
+        type=int,
+        default=1,
+        help="Loadgen over the network, Offline: samples per binary request, "
+        "generated together on the SUT",
+    )
+    parser.add_argument(
+        "--network_max_outstanding",
+        type=int,
+        default=2,
+        help="Loadgen over the network: requests in flight per SUT node",
+    )
     args = parser.parse_args()
     return args
 
@@ -115,7 +144,12 @@ def main():
         )
         if args.network == "lon":
             qdl = GPTJ_QDL(
-                sut_server_addr=args.sut_server, scenario=args.scenario, qsl=qsl
+                sut_server_addr=args.sut_server,
+                scenario=args.scenario,
+                qsl=qsl,
+                protocol=args.network_protocol,
+                batch_size=args.network_batch_size,
+                max_outstanding=args.network_max_outstanding,
             )
 
         # Initiates and loads loadgen test settings and log path
@@ -157,6 +191,7 @@ def main():
             network=args.network,
             dataset_path=args.dataset_path,
             max_examples=args.max_examples,
+            batch_size=args.batch_size,
             qsl=qsl,  # If args.network is None, then only QSL get passed to the SUT, else it will be None
         )
 
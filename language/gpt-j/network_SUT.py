@@ -1,8 +1,17 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from werkzeug.serving import WSGIRequestHandler
+import numpy as np
 import threading
+import torch
+
+import binary_protocol
 
 app = Flask(__name__)
 
+# HTTP/1.1 keeps the connections of the pooled LON clients open between
+# requests
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+
 node = ""
 
 model_mem_size = None
@@ -59,6 +68,32 @@ def predict():
         semaphore.release()
 
 
+@app.route("/predict_binary/", methods=["POST"])
+def predict_binary():
+    """Runs a batch of samples sent in the binary format of
+    binary_protocol.py as one generate call, returns the int32 output
+    tokens of every sample in the same format."""
+    queries = binary_protocol.decode(bytearray(request.get_data()))
+    semaphore.acquire()  # wait to acquire semaphore
+    try:
+        pred_outputs = backend.inference_batch(
+            [torch.from_numpy(q["input_ids"].astype(np.int64)).view(1, -1)
+             for q in queries],
+            [torch.from_numpy(q["attention_mask"].astype(np.int64)).view(1, -1)
+             for q in queries],
+        )
+    finally:
+        # semaphore is released after processing
+        semaphore.release()
+    return Response(
+        binary_protocol.encode(
+            [{"pred_output": output} for output in pred_outputs],
+            {"pred_output": np.int32},
+        ),
+        mimetype=binary_protocol.CONTENT_TYPE,
+    )
+
+
 @app.route("/getname/", methods=["POST", "GET"])
 def getname():
     """Returns the name of the SUT."""
@@ -1,10 +1,10 @@
 from transformers import AutoTokenizer
 
 
-def get_transformer_autotokenizer(model_name: str):
+def get_transformer_autotokenizer(model_name: str, use_fast: bool = False):
     return AutoTokenizer.from_pretrained(
         model_name,
         model_max_length=2048,
         padding_side="left",
-        use_fast=False,
+        use_fast=use_fast,
     )
@@ -8,7 +8,6 @@ from torch.utils.data import DataLoader
 from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaForCausalLM
 from transformers.generation.streamers import BaseStreamer
 
-import pickle
 import time
 import threading
 import tqdm
@@ -16,10 +15,11 @@ import queue
 
 import logging
 from typing import TYPE_CHECKING, Optional, List
-from pathlib import Path
 
 import mlperf_loadgen as lg
 from dataset import Dataset
+from output_store import OutputStore
+from continuous_batching import ContinuousBatchingEngine, PrefixCache, Request
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("Llama-70B-SUT")
@@ -81,6 +81,31 @@ class FirstTokenStreamer(BaseStreamer):
         return self.tokens_cache
 
 
+def length_buckets(query_samples, input_lens, batch_size, output_len_hints=None):
+    """Groups query samples into batches of similar length.
+
+    Samples are sorted by their expected output length (if hints are given)
+    and then by prompt length, and cut into batches of batch_size, so every
+    batch only needs to be padded to its own longest prompt.
+
+    Returns the batches and the padding efficiency, the fraction of real
+    prompt tokens among all tokens of the padded batches.
+    """
+    if output_len_hints is None:
+        def key(q): return input_lens[q.index]
+    else:
+        def key(q): return (output_len_hints[q.index], input_lens[q.index])
+    ordered = sorted(query_samples, key=key)
+    batches = [
+        ordered[i: i + batch_size] for i in range(0, len(ordered), batch_size)
+    ]
+    tokens = sum(input_lens[q.index] for q in ordered)
+    padded = sum(
+        len(b) * max(input_lens[q.index] for q in b) for b in batches
+    )
+    return batches, tokens / max(padded, 1)
+
+
 class SUT:
     def __init__(
         self,
@@ -94,6 +119,9 @@ class SUT:
         # Set this to True *only for test accuracy runs* in case your prior
         # session was killed partway through
         workers=1,
+        continuous_batching=False,
+        length_bucketing=False,
+        prefix_cache_gb=0,
     ):
 
         self.model_path = model_path or "meta-llama/Llama-2-70b-chat-hf"
@@ -141,10 +169,27 @@ class SUT:
         self.query_queue = queue.Queue()
 
         self.use_cached_outputs = use_cached_outputs
+        # generated tokens of every sample, keyed by the run configuration
+        self.output_store = OutputStore(
+            os.path.join("run_outputs", "outputs.bin"),
+            {"model": self.model_path, "dtype": dtype, "gen_kwargs": gen_kwargs},
+        )
         self.sample_counter = 0
         self.sample_counter_lock = threading.Lock()
 
+        self.continuous_batching = continuous_batching
+        self.engine = None
+        self.length_bucketing = length_bucketing
+        self.prefix_cache_gb = prefix_cache_gb
+
+    # token ids are returned with the dtype the accuracy script expects
+    output_dtype = np.int64
+
     def start(self):
+        if self.continuous_batching:
+            self.start_engine()
+            return
+
         # Create worker threads
         for j in range(self.num_workers):
             worker = threading.Thread(target=self.process_queries)
@@ -152,12 +197,97 @@ class SUT:
             self.worker_threads[j] = worker
 
     def stop(self):
+        if self.engine is not None:
+            self.engine.stop()
+            return
+
         for _ in range(self.num_workers):
             self.query_queue.put(None)
 
         for worker in self.worker_threads:
             worker.join()
 
+    def start_engine(self):
+        """Runs all samples through one continuous batching engine instead of
+        worker threads generating fixed batches"""
+        self.engine = ContinuousBatchingEngine(
+            self.model,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
+            max_batch_size=self.batch_size,
+            max_new_tokens=gen_kwargs["max_new_tokens"],
+            min_new_tokens=gen_kwargs["min_new_tokens"],
+            on_first_token=self.first_token_done,
+            on_complete=self.request_done,
+            prefix_cache=(
+                PrefixCache(int(self.prefix_cache_gb * 2**30))
+                if self.prefix_cache_gb
+                else None
+            ),
+        )
+        self.engine.start()
+
+    def make_request(self, query_sample):
+        request = Request(
+            query_sample.id,
+            self.data_object.input_ids[query_sample.index],
+            self.data_object.attention_masks[query_sample.index],
+        )
+        request.index = query_sample.index
+        return request
+
+    def first_token_done(self, request):
+        pass
+
+    def request_done(self, request):
+        # a failed request is still completed, with the tokens it got, so
+        # that loadgen does not wait for it; it is not stored for reuse
+        if request.error is None:
+            self.output_store.put(request.index, request.tokens)
+        n_tokens = len(request.tokens)
+        response_array = array.array(
+            "B", np.array(request.tokens, self.output_dtype).tobytes()
+        )
+        bi = response_array.buffer_info()
+        response = [
+            lg.QuerySampleResponse(
+                request.response_id,
+                bi[0],
+                bi[1],
+                n_tokens)]
+        lg.QuerySamplesComplete(response)
+
+        with self.sample_counter_lock:
+            self.sample_counter += 1
+            if self.sample_counter % 100 == 0:
+                print(f"Samples run: {self.sample_counter}")
+
+    def respond_cached(self, query_samples):
+        """Completes the samples that already have outputs in the output
+        store, returns the others"""
+        remaining = []
+        for q in query_samples:
+            output = self.output_store.get(q.index)
+            if output is None:
+                remaining.append(q)
+                continue
+            response_array = array.array(
+                "B", output.astype(self.output_dtype).tobytes())
+            bi = response_array.buffer_info()
+            response = [
+                lg.QuerySampleResponse(
+                    q.id,
+                    bi[0],
+                    bi[1],
+                    len(output))]
+            lg.QuerySamplesComplete(response)
+        cached = len(query_samples) - len(remaining)
+        if cached:
+            with self.sample_counter_lock:
+                self.sample_counter += cached
+            print(f"\tLoaded {cached} samples from the output store")
+        return remaining
+
     def process_queries(self):
         """Processor of the queued queries. User may choose to add batching logic"""
 
@@ -166,81 +296,81 @@ class SUT:
             if qitem is None:
                 break
 
+            if self.use_cached_outputs:
+                qitem = self.respond_cached(qitem)
+                if not qitem:
+                    continue
+
             query_ids = [q.index for q in qitem]
 
-            fname = "q" + "_".join([str(i) for i in query_ids])
-            fname = f"run_outputs/{fname}.pkl"
-            _p = Path(fname)
-            if self.use_cached_outputs and _p.exists():
-                # Read cache
-                with _p.open(mode="rb") as f:
-                    d = pickle.load(f)
-                processed_output = d["outputs"]
-                tik1 = None
-                tik2 = None
-                tik3 = None
-                tok = None
-            else:
-                # Construct / collate batch
-                max_seq_len = 1024
-
-                tik1 = time.time()
-
-                input_ids_tensor = []
-                input_masks_tensor = []
-                input_len = []
-                for q in qitem:
-                    input_ids_tensor.append(
-                        pad(
-                            self.data_object.input_ids[q.index],
-                            (
-                                max_seq_len -
-                                self.data_object.input_lens[q.index],
-                                0,
-                                0,
-                                0,
-                            ),
-                            value=self.tokenizer.pad_token_id,
-                        )
+            # Construct / collate batch
+            max_seq_len = 1024
+            if self.length_bucketing:
+                # the batch comes from length_buckets, pad it only to its
+                # longest prompt
+                max_seq_len = max(
+                    self.data_object.input_lens[q.index] for q in qitem
+                )
+
+            tik1 = time.time()
+
+            input_ids_tensor = []
+            input_masks_tensor = []
+            input_len = []
+            for q in qitem:
+                input_ids_tensor.append(
+                    pad(
+                        self.data_object.input_ids[q.index],
+                        (
+                            max_seq_len -
+                            self.data_object.input_lens[q.index],
+                            0,
+                            0,
+                            0,
+                        ),
+                        value=self.tokenizer.pad_token_id,
                     )
-                    input_masks_tensor.append(
-                        pad(
-                            self.data_object.attention_masks[q.index],
-                            (
-                                max_seq_len -
-                                self.data_object.input_lens[q.index],
-                                0,
-                                0,
-                                0,
-                            ),
-                            value=0,
-                        )
+                )
+                input_masks_tensor.append(
+                    pad(
+                        self.data_object.attention_masks[q.index],
+                        (
+                            max_seq_len -
+                            self.data_object.input_lens[q.index],
+                            0,
+                            0,
+                            0,
+                        ),
+                        value=0,
                     )
-                    input_len.append(self.data_object.input_lens[q.index])
-                input_ids_tensor = torch.cat(input_ids_tensor)
-                input_masks_tensor = torch.cat(input_masks_tensor)
+                )
+                input_len.append(self.data_object.input_lens[q.index])
+            input_ids_tensor = torch.cat(input_ids_tensor)
+            input_masks_tensor = torch.cat(input_masks_tensor)
 
-                assert input_ids_tensor.shape == input_masks_tensor.shape
-                assert input_ids_tensor.shape[0] <= self.batch_size
+            assert input_ids_tensor.shape == input_masks_tensor.shape
+            assert input_ids_tensor.shape[0] <= self.batch_size
 
-                tik2 = time.time()
+            tik2 = time.time()
 
-                pred_output_tokens = self.model.generate(
-                    input_ids=input_ids_tensor,
-                    attention_mask=input_masks_tensor,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    **gen_kwargs,
-                )
+            pred_output_tokens = self.model.generate(
+                input_ids=input_ids_tensor,
+                attention_mask=input_masks_tensor,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **gen_kwargs,
+            )
 
-                tik3 = time.time()
+            tik3 = time.time()
 
-                processed_output = self.data_object.postProcess(
-                    pred_output_tokens,
-                    input_seq_lens=input_len,
-                    query_id_list=query_ids,
-                )
+            processed_output = self.data_object.postProcess(
+                pred_output_tokens,
+                input_seq_lens=input_len,
+                query_id_list=query_ids,
+                padded_len=max_seq_len,
+            )
 
             for i in range(len(qitem)):
+                self.output_store.put(qitem[i].index, processed_output[i])
                 n_tokens = processed_output[i].shape[0]
                 response_array = array.array(
                     "B", processed_output[i].tobytes())
@@ -258,13 +388,10 @@ class SUT:
             with self.sample_counter_lock:
                 self.sample_counter += len(qitem)
                 print(f"Samples run: {self.sample_counter}")
-                if tik1:
-                    print(f"\tBatchMaker time: {tik2 - tik1}")
-                    print(f"\tInference time: {tik3 - tik2}")
-                    print(f"\tPostprocess time: {tok - tik3}")
-                    print(f"\t==== Total time: {tok - tik1}")
-                else:
-                    print(f"\tLoaded from cache: {_p}")
+                print(f"\tBatchMaker time: {tik2 - tik1}")
+                print(f"\tInference time: {tik3 - tik2}")
+                print(f"\tPostprocess time: {tok - tik3}")
+                print(f"\t==== Total time: {tok - tik1}")
 
     def load_model(self):
         self.model = LlamaForCausalLM.from_pretrained(
@@ -314,6 +441,32 @@ class SUT:
         list_prompts_attn_masks = []
 
         print(f"IssueQuery started with {len(query_samples)} samples")
+        if self.engine is not None:
+            if self.use_cached_outputs:
+                query_samples = self.respond_cached(query_samples)
+            for q in query_samples:
+                self.engine.submit(self.make_request(q))
+            print("IssueQuery done")
+            return
+
+        if self.length_bucketing:
+            batches, efficiency = length_buckets(
+                query_samples,
+                self.data_object.input_lens,
+                self.batch_size,
+                self.data_object.output_len_hints,
+            )
+            fixed = sum(self.data_object.input_lens[q.index]
+                        for q in query_samples) / (1024 * len(query_samples))
+            print(
+                f"Padding efficiency: {efficiency:.1%} "
+                f"(padding every prompt to 1024: {fixed:.1%})"
+            )
+            for batch in batches:
+                self.query_queue.put(batch)
+            print("IssueQuery done")
+            return
+
         while len(query_samples) > 0:
             self.query_queue.put(query_samples[: self.batch_size])
             query_samples = query_samples[self.batch_size:]
@@ -336,26 +489,40 @@ class SUTServer(SUT):
         dataset_path=None,
         batch_size=None,
         workers=1,
+        continuous_batching=False,
+        length_bucketing=False,
+        prefix_cache_gb=0,
+        use_cached_outputs=False,
     ):
 
         super().__init__(
             model_path=model_path,
             dtype=dtype,
             device=device,
+            batch_size=batch_size,
             total_sample_count=total_sample_count,
             dataset_path=dataset_path,
             workers=workers,
+            continuous_batching=continuous_batching,
+            length_bucketing=length_bucketing,
+            prefix_cache_gb=prefix_cache_gb,
+            use_cached_outputs=use_cached_outputs,
         )
 
         self.first_token_queue = queue.Queue()
 
+    output_dtype = np.int32
+
     def start(self):
 
-        # Create worker threads
-        for j in range(self.num_workers):
-            worker = threading.Thread(target=self.process_queries)
-            worker.start()
-            self.worker_threads[j] = worker
+        if self.continuous_batching:
+            self.start_engine()
+        else:
+            # Create worker threads
+            for j in range(self.num_workers):
+                worker = threading.Thread(target=self.process_queries)
+                worker.start()
+                self.worker_threads[j] = worker
 
         # Create first token response thread
         self.ft_response_thread = threading.Thread(
@@ -380,6 +547,9 @@ class SUTServer(SUT):
             response = [lg.QuerySampleResponse(response_id, bi[0], bi[1])]
             lg.FirstTokenComplete(response)
 
+    def first_token_done(self, request):
+        self.first_token_queue.put((request.tokens[0], request.response_id))
+
     def process_queries(self):
         """Processor of the queued queries. User may choose to add batching logic"""
         while True:
@@ -425,14 +595,22 @@ class SUTServer(SUT):
 
     def issue_queries(self, query_samples):
 
+        if self.engine is not None:
+            for q in query_samples:
+                self.engine.submit(self.make_request(q))
+            return
+
         self.query_queue.put(query_samples[0])
 
     def stop(self):
-        for _ in range(self.num_workers):
-            self.query_queue.put(None)
+        if self.engine is not None:
+            self.engine.stop()
+        else:
+            for _ in range(self.num_workers):
+                self.query_queue.put(None)
 
-        for worker in self.worker_threads:
-            worker.join()
+            for worker in self.worker_threads:
+                worker.join()
 
         self.first_token_queue.put(None)
         self.ft_response_thread.join()
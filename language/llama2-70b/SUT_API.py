@@ -8,8 +8,6 @@ from torch.utils.data import DataLoader
 from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaForCausalLM
 from transformers.generation.streamers import BaseStreamer
 
-import json
-import pickle
 import time
 import threading
 import tqdm
@@ -17,16 +15,13 @@ import queue
 
 import logging
 from typing import TYPE_CHECKING, Optional, List
-from pathlib import Path
 
-import more_itertools as mit
-from concurrent.futures.thread import ThreadPoolExecutor
-
-import requests
-from urllib3.exceptions import InsecureRequestWarning
+import concurrent.futures
 
 import mlperf_loadgen as lg
+from api_client import APIError, APIServerPool, TokenDecoder
 from dataset import Dataset
+from output_store import OutputStore
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("Llama-70B-SUT")
@@ -103,14 +98,20 @@ class SUT:
         # Set this to True *only for test accuracy runs* in case your prior
         # session was killed partway through
         workers=1,
+        api_max_concurrency=64,
+        api_token_ids=False,
     ):
 
         self.model_path = model_path or "meta-llama/Llama-2-70b-chat-hf"
         self.device = device
         self.api_servers = []
-        if api_server:
+        if isinstance(api_server, str):
             self.api_servers.append(api_server)
+        elif api_server:
+            self.api_servers.extend(api_server)
         self.api_model_name = api_model_name
+        self.api_max_concurrency = api_max_concurrency
+        self.client = None
         self.device = device
 
         batch_size = total_sample_count
@@ -153,16 +154,30 @@ class SUT:
         )  # changed from false
 
         self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.token_decoder = TokenDecoder(
+            self.tokenizer, server_token_ids=api_token_ids)
 
         self.num_workers = workers
         self.worker_threads = [None] * self.num_workers
         self.query_queue = queue.Queue()
 
         self.use_cached_outputs = use_cached_outputs
+        # generated tokens of every sample, keyed by the run configuration
+        self.output_store = OutputStore(
+            os.path.join("run_outputs", "outputs.bin"),
+            {
+                "model": self.model_path,
+                "api_model_name": api_model_name,
+                "dtype": dtype,
+                "gen_kwargs": gen_kwargs,
+            },
+        )
         self.sample_counter = 0
         self.sample_counter_lock = threading.Lock()
 
     def start(self):
+        self.start_client()
+
         # Create worker threads
         for j in range(self.num_workers):
             worker = threading.Thread(target=self.process_queries)
@@ -176,37 +191,68 @@ class SUT:
         for worker in self.worker_threads:
             worker.join()
 
-    def query_api_vllm(self, inputs, idx):
-        headers = {
-            "Content-Type": "application/json",
-        }
-        json_data = {
-            "model": self.api_model_name,
-            "prompt": inputs,
-            "min_tokens": 1,
-            "max_tokens": 1024,
-        }
-
-        response_code = 0
-        print(f"Server path {self.api_servers[idx]}/v1/completions")
-        while response_code != 200:
+        self.stop_client()
+
+    def start_client(self):
+        if not self.api_servers:
+            print("Error: Specify at least one API to which the request is to be sent!")
+            exit(1)
+        print(f"Server paths {', '.join(self.api_servers)}")
+        self.client = APIServerPool(
+            self.api_servers,
+            self.api_model_name,
+            max_concurrency=self.api_max_concurrency,
+        )
+        self.client.start()
+
+    def stop_client(self):
+        if self.client is not None:
+            self.client.stop()
+            self.client = None
+
+    def query_api_vllm(self, inputs):
+        """Sends one prompt (token ids) to the least loaded server, the future
+        returns the generated token ids"""
+        future = concurrent.futures.Future()
+
+        def done(f):
             try:
-                response = requests.post(
-                    f"{self.api_servers[idx]}/v1/completions",
-                    headers=headers,
-                    json=json_data,
-                    verify=False,
-                )
-                response_code = response.status_code
+                future.set_result(
+                    self.token_decoder.tokens(f.result()["choices"][0]))
             except Exception as e:
-                print(e)
-                print("connection failure")
-                break
-        return [resp["text"] for resp in json.loads(response.text)["choices"]]
+                future.set_exception(e)
 
-    def api_action_handler(self, chunk, server_idx):
-        output = self.query_api_vllm(chunk, server_idx)
-        return output
+        request = self.client.complete(
+            inputs, min_tokens=1, max_tokens=1024, **self.token_decoder.params
+        )
+        request.add_done_callback(done)
+        return future
+
+    def respond_cached(self, query_samples):
+        """Completes the samples that already have outputs in the output
+        store, returns the others"""
+        remaining = []
+        for q in query_samples:
+            output = self.output_store.get(q.index)
+            if output is None:
+                remaining.append(q)
+                continue
+            response_array = array.array(
+                "B", output.astype(np.int64).tobytes())
+            bi = response_array.buffer_info()
+            response = [
+                lg.QuerySampleResponse(
+                    q.id,
+                    bi[0],
+                    bi[1],
+                    len(output))]
+            lg.QuerySamplesComplete(response)
+        cached = len(query_samples) - len(remaining)
+        if cached:
+            with self.sample_counter_lock:
+                self.sample_counter += cached
+            print(f"\tLoaded {cached} samples from the output store")
+        return remaining
 
     def process_queries(self):
         """Processor of the queued queries. User may choose to add batching logic"""
@@ -216,87 +262,44 @@ class SUT:
             if qitem is None:
                 break
 
-            query_ids = [q.index for q in qitem]
-
-            fname = "q" + "_".join([str(i) for i in query_ids])
-            fname = f"run_outputs/{fname}.pkl"
-            _p = Path(fname)
-            if self.use_cached_outputs and _p.exists():
-                # Read cache
-                with _p.open(mode="rb") as f:
-                    d = pickle.load(f)
-                processed_output = d["outputs"]
-                tik1 = None
-                tik2 = None
-                tik3 = None
-                tok = None
-            else:
-                # Construct / collate batch
-                max_seq_len = 1024
-
-                tik1 = time.time()
-
-                # OpenAI-API servers don't require padding and can take input tokens
-                # directly, so we build our input_ids_tensor as a jagged list
-                input_ids_tensor = []
-                for q in qitem:
-                    # input_ids_tensor.append(self.data_object.input_ids[q.index].tolist())
-                    input_ids_tensor += self.data_object.input_ids[q.index].tolist(
-                    )
-
-                # NOTE(mgoin): I don't think this has to be a torch tensor
-                # input_ids_tensor = torch.cat(input_ids_tensor)
-
-                # print(input_ids_tensor)
-
-                assert len(input_ids_tensor) <= self.batch_size
-
-                tik2 = time.time()
-
-                # NOTE(mgoin): I don't think threading is necessary since we are submitting all queries in one request
-                # The API server should take care of mini-batches and
-                # scheduling
-                if self.api_servers:
-                    """
-                    decoded = self.tokenizer.batch_decode(input_ids_tensor)
-                    cleaned = [entry.replace('</s>','').replace('<s>','') for entry in decoded]
-                    cleaned_chunks = [list(c) for c in mit.divide(len(self.api_servers), cleaned)]
-                    """
-                    cleaned_chunks = [input_ids_tensor]
-                    with ThreadPoolExecutor(
-                        max_workers=len(self.api_servers)
-                    ) as executor:
-                        # needs to be tested
-                        output_chunks = list(
-                            executor.map(
-                                self.api_action_handler,
-                                cleaned_chunks,
-                                range(len(self.api_servers)),
-                            )
-                        )
-                    output = []
-                    for row in output_chunks:
-                        output += row
-                else:
-                    print(
-                        "Error: Specify at least one API to which the request is to be sent!"
-                    )
-                    exit(1)
-
-                tik3 = time.time()
-
-            processed_output = self.tokenizer(output)["input_ids"]
-            # for i in range(len(qitem)):
-            for i in range(len(processed_output)):
-                # NOTE(mgoin): Not optimal to make numpy arrays just to
-                # serialize
-                unpadded = np.array(processed_output[i])
+            if self.use_cached_outputs:
+                qitem = self.respond_cached(qitem)
+                if not qitem:
+                    continue
+
+            # OpenAI-API servers don't require padding and can take input tokens
+            # directly, so every prompt is sent as its own request and
+            # the client spreads them over the servers
+            assert len(qitem) <= self.batch_size
+
+            tik1 = time.time()
+
+            futures = {
+                self.query_api_vllm(
+                    self.data_object.input_ids[q.index][0].tolist()
+                ): q
+                for q in qitem
+            }
+
+            tik2 = time.time()
+
+            # respond to every sample as soon as its text is back
+            for future in concurrent.futures.as_completed(futures):
+                q = futures[future]
+                try:
+                    output_tokens = future.result()
+                except APIError as e:
+                    log.error("Sample {} failed: {}".format(q.index, e))
+                    output_tokens = None
+                unpadded = np.array(output_tokens or [], np.int64)
+                if output_tokens is not None:
+                    self.output_store.put(q.index, unpadded)
                 n_tokens = unpadded.shape[0]
                 response_array = array.array("B", unpadded.tobytes())
                 bi = response_array.buffer_info()
                 response = [
                     lg.QuerySampleResponse(
-                        qitem[i].id,
+                        q.id,
                         bi[0],
                         bi[1],
                         n_tokens)]
@@ -307,13 +310,9 @@ class SUT:
             with self.sample_counter_lock:
                 self.sample_counter += len(qitem)
                 print(f"Samples run: {self.sample_counter}")
-                if tik1:
-                    print(f"\tBatchMaker time: {tik2 - tik1}")
-                    print(f"\tInference time: {tik3 - tik2}")
-                    print(f"\tPostprocess time: {tok - tik3}")
-                    print(f"\t==== Total time: {tok - tik1}")
-                else:
-                    print(f"\tLoaded from cache: {_p}")
+                print(f"\tSubmit time: {tik2 - tik1}")
+                print(f"\tWait and response time: {tok - tik2}")
+                print(f"\t==== Total time: {tok - tik1}")
 
     def get_sut(self):
         self.sut = lg.ConstructSUT(self.issue_queries, self.flush_queries)
@@ -356,26 +355,29 @@ class SUTServer(SUT):
         dataset_path=None,
         batch_size=None,
         workers=1,
+        api_max_concurrency=64,
+        api_token_ids=False,
+        use_cached_outputs=False,
     ):
 
         super().__init__(
             model_path=model_path,
-            api_server=None,
-            api_model_name=None,
+            api_server=api_server,
+            api_model_name=api_model_name,
             dtype=dtype,
             device=device,
             total_sample_count=total_sample_count,
             dataset_path=dataset_path,
             workers=workers,
+            api_max_concurrency=api_max_concurrency,
+            api_token_ids=api_token_ids,
+            use_cached_outputs=use_cached_outputs,
         )
 
-        with open(f"{self.model_path}/tokenizer.json", "r") as token_file:
-            llama_tokenizer = json.load(token_file)
-        self.llama_vocab = llama_tokenizer["model"]["vocab"]
-
         self.first_token_queue = queue.Queue()
 
     def start(self):
+        self.start_client()
 
         # Create worker threads
         for j in range(self.num_workers):
@@ -406,79 +408,59 @@ class SUTServer(SUT):
             response = [lg.QuerySampleResponse(response_id, bi[0], bi[1])]
             lg.FirstTokenComplete(response)
 
-    def stream_api_vllm(self, input, response_ids, idx):
-        headers = {
-            "Content-Type": "application/json",
-        }
-
-        json_data = {
-            "model": "/opt/app-root/share/models",
-            "prompt": input,
-            "max_tokens": 1024,
-            "temperature": 0,
-            "stream": True,
-            "logprobs": 1,
-        }
-
-        while True:
-            try:
-                token_cache = []
-                s = requests.Session()
-                first = True
-                with s.post(
-                    f"{self.api_servers[idx]}/v1/completions",
-                    headers=headers,
-                    json=json_data,
-                    verify=False,
-                    stream=True,
-                ) as resp:
-                    for line in resp.iter_lines():
-                        if line:
-                            decoded = line.decode()
-                            if decoded.startswith(
-                                    "data") and "[DONE]" not in decoded:
-                                inter = json.loads(decoded[6:])["choices"][0][
-                                    "logprobs"
-                                ]
-                                if "top_logprobs" in inter:
-                                    token_s = list(
-                                        inter["top_logprobs"][0].keys())[0]
-                                    token = self.llama_vocab[token_s]
-                                    if first:
-                                        self.first_token_queue.put(
-                                            (token, response_ids[0])
-                                        )
-                                        first = False
-                                    token_cache.append(token)
-                s.close()
-                if token_cache:
-                    return token_cache
-            except Exception as e:
-                s.close()
-                print("Connection failure")
-                print(f"An exception occurred: {type(e).__name__}")
-                print(f"Exception details: {e}")
-
-    def async_process_query(self, input_ids_tensor, qitem_id, idx):
+    def stream_api_vllm(self, input, response_id, on_done):
+        """Streams the completion of one prompt. The first token is put on
+        the first token queue as soon as it arrives, on_done(tokens, error)
+        is called on the client thread when the stream ends"""
+        token_cache = []
+        stream = self.token_decoder.stream()
+
+        def add(tokens):
+            if tokens and not token_cache:
+                self.first_token_queue.put((tokens[0], response_id))
+            token_cache.extend(tokens)
+
+        def on_event(event):
+            for choice in event["choices"]:
+                add(stream.tokens(choice))
+
+        def done(f):
+            add(stream.finish())
+            on_done(token_cache, f.exception())
+
+        self.client.stream(
+            input,
+            on_event,
+            max_tokens=1024,
+            temperature=0,
+            logprobs=1,
+            **self.token_decoder.params,
+        ).add_done_callback(done)
+
+    def async_process_query(self, input_ids_tensor, qitem_id):
         decoded = self.tokenizer.decode(input_ids_tensor[0])
-        response_ids = [qitem_id]
-        output_tokens = self.stream_api_vllm(decoded, response_ids, idx)
-        n_tokens = len(output_tokens)
-        if n_tokens <= 1:
-            print("WARNING: caught low token count")
-            print(input_ids_tensor)
-            print(output_tokens)
-        response_array = array.array(
-            "B", np.array(
-                output_tokens, np.int32).tobytes())
-        bi = response_array.buffer_info()
-        response = [lg.QuerySampleResponse(qitem_id, bi[0], bi[1], n_tokens)]
-        lg.QuerySamplesComplete(response)
-        sys.exit()
+
+        def on_done(output_tokens, error):
+            if error is not None:
+                log.error("Query {} failed: {}".format(qitem_id, error))
+            n_tokens = len(output_tokens)
+            if n_tokens <= 1:
+                print("WARNING: caught low token count")
+                print(input_ids_tensor)
+                print(output_tokens)
+            response_array = array.array(
+                "B", np.array(
+                    output_tokens, np.int32).tobytes())
+            bi = response_array.buffer_info()
+            response = [lg.QuerySampleResponse(
+                qitem_id, bi[0], bi[1], n_tokens)]
+            lg.QuerySamplesComplete(response)
+
+        self.stream_api_vllm(decoded, qitem_id, on_done)
 
     def process_queries(self):
-        """Processor of the queued queries. User may choose to add batching logic"""
-        server_idx = 0
+        """Processor of the queued queries. The client bounds the number of
+        concurrent streams per server, so queries are only handed over"""
         while True:
 
             qitem = self.query_queue.get()
@@ -486,44 +468,7 @@ class SUTServer(SUT):
                 break
 
             input_ids_tensor = self.data_object.input_ids[qitem.index]
-            input_masks_tensor = self.data_object.attention_masks[qitem.index]
-
-            if self.api_servers:
-                threading.Thread(
-                    target=self.async_process_query,
-                    args=(input_ids_tensor, qitem.id, server_idx),
-                ).start()
-                server_idx = (server_idx + 1) % len(self.api_servers)
-            else:
-                # TODO: This PoC is super slow with significant overhead. Best
-                # to create a patch to `generate`
-                tokens_cache = []
-                tokens_streamer = FirstTokenStreamer(
-                    self.first_token_queue,
-                    tokens_cache=tokens_cache,
-                    is_first_token=True,
-                    response_ids=[qitem.id],
-                )
-
-                _ = self.model.generate(
-                    input_ids=input_ids_tensor,
-                    attention_mask=input_masks_tensor,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    streamer=tokens_streamer,
-                    **gen_kwargs,
-                )
-
-                output_tokens = tokens_streamer.get_out_tokens()
-
-                n_tokens = len(output_tokens)
-                response_array = array.array(
-                    "B", np.array(output_tokens, np.int32).tobytes()
-                )
-                bi = response_array.buffer_info()
-                response = [
-                    lg.QuerySampleResponse(
-                        qitem.id, bi[0], bi[1], n_tokens)]
-                lg.QuerySamplesComplete(response)
+            self.async_process_query(input_ids_tensor, qitem.id)
 
     def issue_queries(self, query_samples):
 
@@ -536,5 +481,7 @@ class SUTServer(SUT):
         for worker in self.worker_threads:
             worker.join()
 
+        self.stop_client()
+
         self.first_token_queue.put(None)
         self.ft_response_thread.join()
@@ -0,0 +1,328 @@
+import asyncio
+import json
+import logging
+import threading
+
+import aiohttp
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("Llama-70B-API-Client")
+
+
+class APIError(Exception):
+    pass
+
+
+class APIServerPool:
+    """asyncio client for one or more OpenAI compatible completion servers.
+
+    All requests run on one event loop in a background thread, over a single
+    aiohttp session that keeps connections to the servers alive. At most
+    max_concurrency requests are in flight per server, the others wait until
+    a server has a free slot and then go to the server with the fewest
+    outstanding requests, so faster servers get more of the load. Failed
+    requests (connection errors and non-200 responses) are retried on the
+    least loaded server that has not failed them yet, up to retries times
+    with exponential backoff, before they fail with APIError.
+
+    complete() and stream() can be called from any thread and return
+    concurrent.futures.Future objects.
+
+    Args:
+        servers (List[str]): base urls, e.g. http://localhost:8000
+        model_name (str): model name passed in every request
+        max_concurrency (int): maximum outstanding requests per server
+        retries (int): retries of a failed request
+        backoff (float): seconds before the first retry, doubled every retry
+        timeout (float): total timeout of one request in seconds, or None
+    """
+
+    def __init__(
+        self,
+        servers,
+        model_name,
+        max_concurrency=64,
+        retries=3,
+        backoff=0.5,
+        timeout=None,
+    ):
+        if not servers:
+            raise ValueError("at least one api server is required")
+        self.servers = [s.rstrip("/") for s in servers]
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.outstanding = [0] * len(self.servers)
+        self.loop = None
+        self.thread = None
+        self.session = None
+        self.free = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+
+    def stop(self):
+        """Waits for the outstanding requests, then closes the connections"""
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def _open(self):
+        connector = aiohttp.TCPConnector(
+            limit=0, limit_per_host=self.max_concurrency, ssl=False
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self.free = asyncio.Condition()
+
+    async def _close(self):
+        pending = [
+            t for t in asyncio.all_tasks() if t is not asyncio.current_task()
+        ]
+        if pending:
+            await asyncio.wait(pending)
+        await self.session.close()
+
+    def complete(self, prompt, **params):
+        """Sends one completion request; the future returns the response json"""
+        return asyncio.run_coroutine_threadsafe(
+            self._request(self._payload(prompt, params), None), self.loop
+        )
+
+    def stream(self, prompt, on_event, **params):
+        """Sends one streaming completion request. on_event(event) is called
+        on the event loop thread for every event of the stream; the future
+        returns the number of events."""
+        payload = self._payload(prompt, params)
+        payload["stream"] = True
+        return asyncio.run_coroutine_threadsafe(
+            self._request(payload, on_event), self.loop
+        )
+
+    def _payload(self, prompt, params):
+        payload = {"model": self.model_name, "prompt": prompt}
+        payload.update(params)
+        return payload
+
+    async def _acquire(self, failed=()):
+        """Waits for a free slot, returns the least loaded server. Servers in
+        failed are only used when no other server has a free slot."""
+        async with self.free:
+            await self.free.wait_for(
+                lambda: min(self.outstanding) < self.max_concurrency
+            )
+            idx = min(
+                range(len(self.servers)),
+                key=lambda i: (
+                    self.outstanding[i] >= self.max_concurrency,
+                    i in failed,
+                    self.outstanding[i],
+                ),
+            )
+            self.outstanding[idx] += 1
+            return idx
+
+    async def _release(self, idx):
+        async with self.free:
+            self.outstanding[idx] -= 1
+            self.free.notify()
+
+    async def _request(self, payload, on_event):
+        attempt = 0
+        failed = set()
+        while True:
+            idx = await self._acquire(failed)
+            events = 0
+            try:
+                if on_event is None:
+                    return await self._post(idx, payload)
+                async for event in self._post_stream(idx, payload):
+                    events += 1
+                    on_event(event)
+                return events
+            except (aiohttp.ClientError, asyncio.TimeoutError, APIError) as e:
+                # a stream that already delivered events can not be replayed
+                if events or attempt >= self.retries:
+                    raise APIError(
+                        "request to {} failed: {}".format(self.servers[idx], e)
+                    ) from e
+                log.warning(
+                    "request to {} failed ({}), retrying".format(
+                        self.servers[idx], e)
+                )
+                failed.add(idx)
+            finally:
+                await self._release(idx)
+            await asyncio.sleep(self.backoff * 2**attempt)
+            attempt += 1
+
+    async def _post(self, idx, payload):
+        async with self.session.post(
+            self.servers[idx] + "/v1/completions", json=payload
+        ) as resp:
+            if resp.status != 200:
+                raise APIError(
+                    "status {}: {}".format(resp.status, await resp.text()))
+            return await resp.json()
+
+    async def _post_stream(self, idx, payload):
+        async with self.session.post(
+            self.servers[idx] + "/v1/completions", json=payload
+        ) as resp:
+            if resp.status != 200:
+                raise APIError(
+                    "status {}: {}".format(resp.status, await resp.text()))
+            # parse all events that arrived together with a single
+            # json.loads instead of one call per line
+            pending = b""
+            async for chunk in resp.content.iter_any():
+                pending += chunk.replace(b"\r\n", b"\n")
+                *messages, pending = pending.split(b"\n\n")
+                events, done = parse_sse(messages)
+                for event in events:
+                    yield event
+                if done:
+                    return
+            events, _ = parse_sse([pending])
+            for event in events:
+                yield event
+
+
+def parse_sse(messages):
+    """Returns the json events of complete server-sent event messages, and
+    whether the stream ended with [DONE]"""
+    data = []
+    done = False
+    for message in messages:
+        for line in message.split(b"\n"):
+            if not line.startswith(b"data:"):
+                continue
+            line = line[5:].strip()
+            if line == b"[DONE]":
+                done = True
+                break
+            data.append(line)
+        if done:
+            break
+    if not data:
+        return [], done
+    return json.loads(b"[" + b",".join(data) + b"]"), done
+
+
+class TokenDecoder:
+    """Extracts the generated token ids from completion responses.
+
+    Token ids are used directly when the server returns them, either as
+    choice["token_ids"] (return_token_ids) or as "token_id:<id>" logprob
+    tokens (return_tokens_as_token_ids). Otherwise logprob token strings are
+    looked up in a cache built from the tokenizer vocabulary, and plain text
+    is tokenized as a last resort.
+
+    Args:
+        tokenizer: HF tokenizer of the served model
+        server_token_ids (bool): ask the server for token ids; only vLLM
+            knows the request parameters, see params
+    """
+
+    def __init__(self, tokenizer, server_token_ids=False):
+        self.tokenizer = tokenizer
+        self.server_token_ids = server_token_ids
+        self.vocab = None
+
+    @property
+    def params(self):
+        """Request parameters asking the server for token ids"""
+        if not self.server_token_ids:
+            return {}
+        return {"return_token_ids": True, "return_tokens_as_token_ids": True}
+
+    def tokens(self, choice):
+        """Returns the token ids of a choice of a complete response"""
+        token_ids = self.token_ids(choice)
+        if token_ids is not None:
+            return token_ids
+        return self.encode(choice.get("text"))
+
+    def stream(self):
+        """Returns a StreamDecoder for the events of one streamed response"""
+        return StreamDecoder(self)
+
+    def token_ids(self, choice):
+        """Returns the token ids the server sent for a choice, or None if
+        it only sent text"""
+        token_ids = choice.get("token_ids")
+        if token_ids is not None:
+            return token_ids
+        logprobs = choice.get("logprobs")
+        if logprobs:
+            tokens = logprobs.get("tokens")
+            if tokens is None and logprobs.get("top_logprobs"):
+                tokens = [next(iter(top)) for top in logprobs["top_logprobs"]]
+            if tokens is not None:
+                return [self.token_id(t) for t in tokens]
+        return None
+
+    def encode(self, text):
+        if not text:
+            return []
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def token_id(self, token):
+        if token.startswith("token_id:"):
+            return int(token[9:])
+        if self.vocab is None:
+            self.vocab = self.tokenizer.get_vocab()
+        token_id = self.vocab.get(token)
+        if token_id is None:
+            token_id = self.tokenizer.convert_tokens_to_ids(token)
+            self.vocab[token] = token_id
+        return token_id
+
+
+class StreamDecoder:
+    """Token ids of the events of one streamed response.
+
+    Events that carry token ids are decoded on their own. Text fragments can
+    not be: a token may span two fragments, and tokenizers treat the start
+    of a text differently. The text of the stream is accumulated and encoded
+    as a whole on every event instead; the last token may still change with
+    the next fragment, so it is only handed out by the next event or by
+    finish().
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.text = ""
+        self.emitted = 0
+
+    def tokens(self, choice):
+        """Returns the new token ids of a choice of a stream event"""
+        token_ids = self.decoder.token_ids(choice)
+        if token_ids is not None:
+            return token_ids
+        if not choice.get("text"):
+            return []
+        self.text += choice["text"]
+        return self._new(self.decoder.encode(self.text)[:-1])
+
+    def finish(self):
+        """Returns the token ids not handed out yet, at the end of the
+        stream"""
+        return self._new(self.decoder.encode(self.text))
+
+    def _new(self, token_ids):
+        new = token_ids[self.emitted:]
+        self.emitted = max(self.emitted, len(token_ids))
+        return new
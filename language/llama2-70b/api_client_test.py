@@ -0,0 +1,251 @@
+"""Tests of APIServerPool against stub OpenAI compatible servers, and of
+TokenDecoder:
+
+    python -m pytest api_client_test.py
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+import unittest
+
+from aiohttp import web
+
+from api_client import APIError, APIServerPool, TokenDecoder
+
+
+class StubServer:
+    """OpenAI compatible /v1/completions endpoint on a local port.
+
+    Every request waits delay seconds, the first `failures` requests get a
+    500. Completions echo the prompt; streams send it word by word. The
+    server counts the requests and the maximum number in flight.
+    """
+
+    def __init__(self, delay=0.0, failures=0):
+        self.delay = delay
+        self.failures = failures
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.runner = asyncio.run_coroutine_threadsafe(
+            self._start(), self.loop).result()
+        self.url = "http://{}:{}".format(*self.runner.addresses[0][:2])
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post("/v1/completions", self.completions)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        return runner
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def completions(self, request):
+        payload = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.requests <= self.failures:
+                return web.Response(status=500, text="stub failure")
+            if not payload.get("stream"):
+                return web.json_response(
+                    {"choices": [{"index": 0, "text": payload["prompt"]}]})
+            resp = web.StreamResponse(
+                headers={"Content-Type": "text/event-stream"})
+            await resp.prepare(request)
+            for word in payload["prompt"].split():
+                event = {"choices": [{"index": 0, "text": word}]}
+                await resp.write(
+                    "data: {}\n\n".format(json.dumps(event)).encode())
+            await resp.write(b"data: [DONE]\n\n")
+            await resp.write_eof()
+            return resp
+        finally:
+            self.in_flight -= 1
+
+
+def unused_url():
+    """Url of a local port nothing listens on"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return "http://127.0.0.1:{}".format(s.getsockname()[1])
+
+
+class APIServerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = []
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.stop()
+        for stub in self.stubs:
+            stub.stop()
+
+    def stub(self, **kwargs):
+        stub = StubServer(**kwargs)
+        self.stubs.append(stub)
+        return stub
+
+    def start_pool(self, servers, **kwargs):
+        kwargs.setdefault("backoff", 0.01)
+        self.pool = APIServerPool(servers, "stub-model", **kwargs)
+        self.pool.start()
+        return self.pool
+
+    def complete_all(self, n):
+        futures = [self.pool.complete("prompt {}".format(i)) for i in range(n)]
+        return [f.result(timeout=30) for f in futures]
+
+    def test_complete(self):
+        pool = self.start_pool([self.stub().url])
+        response = pool.complete("hello there", max_tokens=4).result(10)
+        self.assertEqual(response["choices"][0]["text"], "hello there")
+
+    def test_stream(self):
+        pool = self.start_pool([self.stub().url])
+        events = []
+        n = pool.stream("a b c", events.append).result(10)
+        self.assertEqual(n, 3)
+        self.assertEqual([e["choices"][0]["text"] for e in events],
+                         ["a", "b", "c"])
+
+    def test_routes_to_least_outstanding(self):
+        # equally slow servers share a burst evenly
+        a, b = self.stub(delay=0.2), self.stub(delay=0.2)
+        self.start_pool([a.url, b.url], max_concurrency=8)
+        self.complete_all(6)
+        self.assertEqual((a.requests, b.requests), (3, 3))
+        self.assertEqual((a.max_in_flight, b.max_in_flight), (3, 3))
+
+    def test_faster_server_gets_more_load(self):
+        slow, fast = self.stub(delay=0.3), self.stub(delay=0.01)
+        self.start_pool([slow.url, fast.url], max_concurrency=2)
+        self.complete_all(20)
+        self.assertEqual(slow.requests + fast.requests, 20)
+        self.assertGreater(fast.requests, 3 * slow.requests)
+
+    def test_concurrency_cap(self):
+        stub = self.stub(delay=0.05)
+        self.start_pool([stub.url], max_concurrency=3)
+        responses = self.complete_all(12)
+        self.assertEqual(len(responses), 12)
+        self.assertEqual(stub.requests, 12)
+        self.assertEqual(stub.max_in_flight, 3)
+        self.assertEqual(self.pool.outstanding, [0])
+
+    def test_retries_5xx(self):
+        stub = self.stub(failures=2)
+        pool = self.start_pool([stub.url], retries=3)
+        response = pool.complete("retried").result(10)
+        self.assertEqual(response["choices"][0]["text"], "retried")
+        self.assertEqual(stub.requests, 3)
+
+    def test_retries_exhausted(self):
+        stub = self.stub(failures=10)
+        pool = self.start_pool([stub.url], retries=2)
+        with self.assertRaisesRegex(APIError, "status 500"):
+            pool.complete("failed").result(10)
+        self.assertEqual(stub.requests, 3)
+        self.assertEqual(pool.outstanding, [0])
+
+    def test_backoff(self):
+        stub = self.stub(failures=3)
+        pool = self.start_pool([stub.url], retries=3, backoff=0.1)
+        start = time.monotonic()
+        pool.complete("backoff").result(10)
+        # 0.1 + 0.2 + 0.4 seconds of backoff before the fourth attempt
+        self.assertGreaterEqual(time.monotonic() - start, 0.7)
+
+    def test_retries_connection_error_on_other_server(self):
+        stub = self.stub()
+        pool = self.start_pool([unused_url(), stub.url], retries=1)
+        # the first request goes to the dead server, its retry to the stub
+        responses = self.complete_all(4)
+        self.assertEqual(len(responses), 4)
+        self.assertEqual(stub.requests, 4)
+        self.assertEqual(pool.outstanding, [0, 0])
+
+    def test_connection_error_exhausted(self):
+        pool = self.start_pool([unused_url()], retries=2)
+        with self.assertRaises(APIError):
+            pool.complete("unreachable").result(10)
+
+    def test_stream_retries_5xx_before_events(self):
+        stub = self.stub(failures=1)
+        pool = self.start_pool([stub.url], retries=1)
+        events = []
+        self.assertEqual(pool.stream("x y", events.append).result(10), 2)
+        self.assertEqual(stub.requests, 2)
+
+
+class GreedyTokenizer:
+    """Longest match tokenizer: "ab" is one token, but "a" and "b" sent as
+    separate fragments are two"""
+
+    vocab = {"a": 1, "b": 2, "ab": 3, "c": 4}
+
+    def __call__(self, text, add_special_tokens=True):
+        ids = []
+        while text:
+            token = max((t for t in self.vocab if text.startswith(t)), key=len)
+            ids.append(self.vocab[token])
+            text = text[len(token):]
+        return {"input_ids": ids}
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+    def convert_tokens_to_ids(self, token):
+        return 0
+
+
+class TokenDecoderTest(unittest.TestCase):
+    def test_params_opt_in(self):
+        self.assertEqual(TokenDecoder(GreedyTokenizer()).params, {})
+        params = TokenDecoder(GreedyTokenizer(), server_token_ids=True).params
+        self.assertEqual(
+            params,
+            {"return_token_ids": True, "return_tokens_as_token_ids": True})
+
+    def test_token_ids(self):
+        decoder = TokenDecoder(GreedyTokenizer())
+        self.assertEqual(decoder.tokens({"token_ids": [7, 8]}), [7, 8])
+        self.assertEqual(
+            decoder.tokens({"logprobs": {"tokens": ["token_id:9", "ab"]}}),
+            [9, 3])
+        self.assertEqual(decoder.tokens({"text": "abc"}), [3, 4])
+
+    def test_stream_text_is_encoded_as_a_whole(self):
+        stream = TokenDecoder(GreedyTokenizer()).stream()
+        tokens = []
+        for fragment in ["a", "b", "c", "a", "c"]:
+            tokens += stream.tokens({"text": fragment})
+        tokens += stream.finish()
+        self.assertEqual(tokens, GreedyTokenizer()("abcac")["input_ids"])
+        self.assertEqual(tokens, [3, 4, 1, 4])
+
+    def test_stream_token_ids(self):
+        stream = TokenDecoder(GreedyTokenizer()).stream()
+        self.assertEqual(stream.tokens({"token_ids": [5]}), [5])
+        self.assertEqual(stream.tokens({"token_ids": [6]}), [6])
+        self.assertEqual(stream.finish(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,6 +11,8 @@ from pathlib import Path
 from transformers import LlamaTokenizerFast
 from tqdm import tqdm
 
+from output_store import read_outputs
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -24,7 +26,7 @@ def get_args():
         "--run-outputs",
         type=str,
         default="run_outputs",
-        help="Output dir generated by accuracy run.",
+        help="Output dir generated by accuracy run (holding outputs.bin).",
     )
     parser.add_argument(
         "--model-dir",
@@ -48,6 +50,13 @@ def load_dataset(p: os.PathLike):
 
 
 def load_run_outputs(p: os.PathLike):
+    store = Path(p) / "outputs.bin"
+    if store.exists():
+        # per-sample output store of the SUT, read in one sequential pass
+        print(f"Loading from {store}...")
+        return read_outputs(store)
+
+    # run_outputs of older runs: one pickle per batch
     g = glob.glob(str(Path(p) / "q*.pkl"))
 
     by_query_idx = dict()
@@ -74,7 +83,9 @@ def main(args):
     # Load Data
     df = load_dataset(args.dataset_path)
     run_outputs = load_run_outputs(args.run_outputs)
-    assert len(run_outputs) == 24576
+    assert len(run_outputs) == 24576, (
+        f"{len(run_outputs)} of 24576 samples in {args.run_outputs}, "
+        "was the accuracy run complete?")
 
     # Set up columns to add
     output_tok_ids_col = [None] * 24576
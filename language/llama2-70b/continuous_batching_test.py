@@ -0,0 +1,212 @@
+"""Checks the ContinuousBatchingEngine against model.generate on a tiny
+randomly initialized Llama, and the eviction of the PrefixCache. Runs on
+CPU:
+
+    python -m pytest continuous_batching_test.py
+"""
+
+import collections
+import unittest
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from continuous_batching import ContinuousBatchingEngine, PrefixCache, Request
+
+MAX_NEW_TOKENS = 16
+MIN_NEW_TOKENS = 2
+PAD = 0
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def prompts(n, prefix_len=0):
+    generator = torch.Generator().manual_seed(1)
+    prefix = torch.randint(1, 64, (prefix_len,), generator=generator)
+    return [
+        torch.cat([
+            prefix,
+            torch.randint(
+                1, 64, (int(torch.randint(2, 20, (1,), generator=generator)),),
+                generator=generator),
+        ])
+        for _ in range(n)
+    ]
+
+
+def generate(model, input_ids, eos_token_id):
+    """Greedy reference output of one prompt, without padding"""
+    with torch.inference_mode():
+        out = model.generate(
+            input_ids.unsqueeze(0),
+            attention_mask=torch.ones_like(input_ids).unsqueeze(0),
+            max_new_tokens=MAX_NEW_TOKENS,
+            min_new_tokens=MIN_NEW_TOKENS,
+            do_sample=False,
+            num_beams=1,
+            eos_token_id=eos_token_id,
+            pad_token_id=PAD,
+        )
+    tokens = out[0, len(input_ids):].tolist()
+    if eos_token_id in tokens[MIN_NEW_TOKENS:]:
+        tokens = tokens[: tokens.index(eos_token_id, MIN_NEW_TOKENS) + 1]
+    return tokens
+
+
+def pick_eos(model, inputs):
+    """The most frequent generated token, so that sequences stop at
+    different steps"""
+    counts = collections.Counter()
+    for input_ids in inputs:
+        counts.update(generate(model, input_ids, None)[MIN_NEW_TOKENS:])
+    return counts.most_common(1)[0][0]
+
+
+class FailingModel:
+    """Raises on the n-th forward pass of model"""
+
+    def __init__(self, model, n):
+        self.model = model
+        self.device = model.device
+        self.calls = 0
+        self.n = n
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.calls == self.n:
+            raise RuntimeError("forward pass {} failed".format(self.n))
+        return self.model(**kwargs)
+
+
+class ContinuousBatchingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = tiny_model()
+
+    def run_engine(self, model, inputs, eos_token_id, max_batch_size,
+                   prefix_cache=None):
+        completed = collections.defaultdict(list)
+        engine = ContinuousBatchingEngine(
+            model,
+            eos_token_id=eos_token_id,
+            pad_token_id=PAD,
+            max_batch_size=max_batch_size,
+            max_new_tokens=MAX_NEW_TOKENS,
+            min_new_tokens=MIN_NEW_TOKENS,
+            on_complete=lambda r: completed[r.response_id].append(r),
+            prefix_cache=prefix_cache,
+        )
+        for i, input_ids in enumerate(inputs):
+            engine.submit(Request(i, input_ids))
+        engine.start()
+        engine.stop()
+        self.assertEqual(sorted(completed), list(range(len(inputs))))
+        for requests in completed.values():
+            self.assertEqual(len(requests), 1)
+        return [completed[i][0] for i in range(len(inputs))]
+
+    def check_matches_generate(self, inputs, max_batch_size,
+                               prefix_cache=None):
+        eos = pick_eos(self.model, inputs)
+        expected = [generate(self.model, x, eos) for x in inputs]
+        self.assertGreater(len({len(t) for t in expected}), 1)
+        requests = self.run_engine(self.model, inputs, eos, max_batch_size,
+                                   prefix_cache)
+        for request, tokens in zip(requests, expected):
+            self.assertIsNone(request.error)
+            self.assertEqual(request.tokens, tokens)
+
+    def test_batch_size_1(self):
+        self.check_matches_generate(prompts(4), max_batch_size=1)
+
+    def test_batch_size_3(self):
+        # more requests than rows, so sequences join and leave mid-batch
+        self.check_matches_generate(prompts(9), max_batch_size=3)
+
+    def test_prefix_cache(self):
+        cache = PrefixCache(max_bytes=2**20, min_match=4)
+        self.check_matches_generate(prompts(9, prefix_len=12),
+                                    max_batch_size=3, prefix_cache=cache)
+        self.assertGreater(cache.hits, 0)
+
+    def test_failed_step_completes_requests(self):
+        inputs = prompts(7)
+        eos = pick_eos(self.model, inputs)
+        expected = [generate(self.model, x, eos) for x in inputs]
+        # pass 1 prefills the first batch, pass 3 is its second decode step
+        requests = self.run_engine(
+            FailingModel(self.model, 3), inputs, eos, max_batch_size=3)
+        failed = [r for r in requests if r.error is not None]
+        self.assertEqual([r.response_id for r in failed], [0, 1, 2])
+        for request in failed:
+            self.assertIsInstance(request.error, RuntimeError)
+            self.assertEqual(request.tokens,
+                             expected[request.response_id][:2])
+        for request in requests[3:]:
+            self.assertIsNone(request.error)
+            self.assertEqual(request.tokens, expected[request.response_id])
+
+
+def kv(n):
+    """One layer of keys and values of n tokens, 64 bytes per token"""
+    return [(torch.zeros(1, n, 8), torch.zeros(1, n, 8))]
+
+
+class PrefixCacheTest(unittest.TestCase):
+    def insert(self, cache, tokens):
+        tokens = torch.tensor(tokens)
+        cache.match(tokens)
+        cache.insert(tokens, kv(len(tokens)), ())
+
+    def matched(self, cache, tokens):
+        return cache.match(torch.tensor(tokens + [0]))[0]
+
+    def test_evicts_least_recently_used(self):
+        # room for three prompts of 8 tokens
+        cache = PrefixCache(max_bytes=3 * 8 * 64, min_match=4)
+        for i in range(1, 4):
+            self.insert(cache, [i] * 8)
+        self.assertEqual(self.matched(cache, [1] * 8), 8)
+        self.insert(cache, [4] * 8)
+        # 2 was used least recently, 1 was refreshed by the match
+        self.assertEqual(self.matched(cache, [2] * 8), 0)
+        for i in (1, 3, 4):
+            self.assertEqual(self.matched(cache, [i] * 8), 8)
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.bytes, cache.max_bytes)
+
+    def test_parent_becomes_evictable(self):
+        cache = PrefixCache(max_bytes=16 * 64, min_match=4)
+        # shared prefix [9] * 4, split into a parent and two leaves
+        self.insert(cache, [9] * 4 + [1] * 4)
+        self.insert(cache, [9] * 4 + [2] * 4)
+        self.assertEqual(cache.bytes, 12 * 64)
+        self.insert(cache, [5] * 16)
+        # both leaves and then their parent made room for the new prompt
+        self.assertEqual(cache.bytes, 16 * 64)
+        self.assertEqual(self.matched(cache, [9] * 4 + [1] * 4), 0)
+        self.assertEqual(self.matched(cache, [5] * 16), 16)
+        self.assertEqual(cache.root.children.keys(), {5})
+
+    def test_stale_entries_are_dropped(self):
+        cache = PrefixCache(max_bytes=2**20, min_match=4)
+        self.insert(cache, [1] * 8)
+        for _ in range(1000):
+            self.matched(cache, [1] * 8)
+        self.assertLess(len(cache.leaves), 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,8 +2,13 @@ import argparse
 from transformers import AutoTokenizer
 import nltk
 import evaluate
+import hashlib
+import multiprocessing
 import numpy as np
-import json
+import os
+import pickle
+
+from mlcommons_loadgen.accuracy_log import read_accuracy_log
 
 
 def get_args():
@@ -29,6 +34,25 @@ def get_args():
         help="dtype of the accuracy log",
         choices=["int32", "int64", "float"],
     )
+    parser.add_argument(
+        "--eval-workers",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of processes decoding the outputs and computing ROUGE, "
+        "0 to run in the main process",
+    )
+    parser.add_argument(
+        "--shard-size",
+        default=256,
+        type=int,
+        help="Number of samples per task of the evaluation processes",
+    )
+    parser.add_argument(
+        "--decode-cache",
+        default=None,
+        help="File caching the decoded outputs by token hash, so that "
+        "repeated evaluations only decode outputs they have not seen",
+    )
     args = parser.parse_args()
     return args
 
@@ -52,25 +76,79 @@ def postprocess_text(preds, targets):
     return preds, targets
 
 
-def main():
+# Sharded evaluation
+#
+# The outputs are decoded and scored in shards on a process pool. ROUGE is
+# computed per sample (use_aggregator=False) and the shards are merged in
+# order, so the means are the same as for a single compute() call.
+
+tokenizer = None
+metric = None
 
-    args = get_args()
-    dataset_path = args.dataset_file
-    checkpoint_path = args.checkpoint_path
-    metric = evaluate.load("rouge")
-    nltk.download("punkt")
 
+def init_worker(checkpoint_path):
+    global tokenizer, metric
     tokenizer = AutoTokenizer.from_pretrained(
         checkpoint_path,
         model_max_length=2048,
         padding_side="left",
         use_fast=False,
     )
+    metric = evaluate.load("rouge")
 
-    targets = get_groundtruth(args.dataset_file)
 
-    target_required = []
-    preds_token_ids = []
+def decode_shard(preds_token_ids):
+    return tokenizer.batch_decode(preds_token_ids, skip_special_tokens=True)
+
+
+def score_shard(samples):
+    """Scores a shard of (decoded output, target) samples, returns the
+    per-sample ROUGE scores and the prediction lengths"""
+    preds, targets = postprocess_text(*zip(*samples))
+    scores = metric.compute(
+        predictions=preds, references=targets, use_stemmer=True, use_aggregator=False
+    )
+    return scores, [len(pred) for pred in preds]
+
+
+def token_hash(tokens):
+    return hashlib.sha1(
+        np.ascontiguousarray(tokens, np.int64).tobytes()).digest()
+
+
+def load_decode_cache(path, checkpoint_path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        cache = pickle.load(f)
+    if cache["checkpoint"] != os.path.abspath(checkpoint_path):
+        print(f"Ignoring {path}, it was decoded with {cache['checkpoint']}")
+        return {}
+    return cache["texts"]
+
+
+def save_decode_cache(path, checkpoint_path, texts):
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(
+            {"checkpoint": os.path.abspath(checkpoint_path), "texts": texts}, f
+        )
+    os.replace(path + ".tmp", path)
+
+
+def shards(items, shard_size):
+    return [items[i: i + shard_size]
+            for i in range(0, len(items), shard_size)]
+
+
+def main():
+
+    args = get_args()
+    checkpoint_path = args.checkpoint_path
+    # fetch the metric and nltk data once, before the workers load them
+    evaluate.load("rouge")
+    nltk.download("punkt")
+
+    targets = get_groundtruth(args.dataset_file)
 
     eval_dtype = np.int64
     if args.dtype == "int32":
@@ -78,10 +156,12 @@ def main():
     elif args.dtype == "float":
         eval_dtype = np.float32
 
-    with open(args.mlperf_accuracy_file, "r") as f:
-        results = json.load(f)
+    results = read_accuracy_log(args.mlperf_accuracy_file)
 
     seen = set()
+    target_required = []
+    hashes = []
+    to_decode = {}
     gen_tok_len = 0
     for pred in results:
         qsl_idx = pred["qsl_idx"]
@@ -91,23 +171,49 @@ def main():
         seen.add(qsl_idx)
         target = targets[qsl_idx]
         target_required.append(target)
-        pred = np.frombuffer(bytes.fromhex(pred["data"]), eval_dtype)
+        pred = np.frombuffer(pred["data"], eval_dtype)
 
         gen_tok_len += len(pred)
-        preds_token_ids.append(pred)
+        key = token_hash(pred)
+        hashes.append(key)
+        to_decode.setdefault(key, pred)
+
+    texts = load_decode_cache(args.decode_cache, checkpoint_path)
+    for key in texts.keys() & to_decode.keys():
+        del to_decode[key]
+
+    pool = None
+    imap = map
+    if args.eval_workers > 0:
+        pool = multiprocessing.Pool(
+            args.eval_workers, init_worker, (checkpoint_path,))
+        imap = pool.imap
+    else:
+        init_worker(checkpoint_path)
+
+    # Decode each distinct output once
+    keys = list(to_decode)
+    decoded = imap(decode_shard, shards(list(to_decode.values()),
+                                        args.shard_size))
+    for shard_keys, shard_texts in zip(shards(keys, args.shard_size), decoded):
+        texts.update(zip(shard_keys, shard_texts))
+    if args.decode_cache is not None and keys:
+        save_decode_cache(args.decode_cache, checkpoint_path, texts)
+
+    samples = [(texts[key], target)
+               for key, target in zip(hashes, target_required)]
+    result = {}
+    prediction_lens = []
+    for scores, lens in imap(score_shard, shards(samples, args.shard_size)):
+        for k, v in scores.items():
+            result.setdefault(k, []).extend(v)
+        prediction_lens.extend(lens)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-    preds_decoded_text = tokenizer.batch_decode(
-        preds_token_ids, skip_special_tokens=True
-    )
-
-    preds, targets = postprocess_text(preds_decoded_text, target_required)
-
-    result = metric.compute(
-        predictions=preds, references=targets, use_stemmer=True, use_aggregator=False
-    )
     result = {k: round(np.mean(v) * 100, 4) for k, v in result.items()}
-    prediction_lens = [len(pred) for pred in preds]
-    gen_num = len(preds)
+    gen_num = len(prediction_lens)
 
     result = {
         **result,
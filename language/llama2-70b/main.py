@@ -101,12 +101,43 @@ def get_args():
         action="store_true",
         help="Enable log tracing. This file can become quite large",
     )
+    parser.add_argument(
+        "--accuracy-log-binary",
+        action="store_true",
+        help="Also write the accuracy log as raw bytes to mlperf_log_accuracy.bin",
+    )
     parser.add_argument(
         "--num-workers",
         type=int,
         default=1,
         help="Number of workers to process queries",
     )
+    parser.add_argument(
+        "--length-bucketing",
+        action="store_true",
+        help="Offline: batch samples of similar prompt and expected output "
+        "length and pad each batch only to its longest prompt",
+    )
+    parser.add_argument(
+        "--use-cached-outputs",
+        action="store_true",
+        help="(Offline) Serve samples already generated with the same model and "
+        "generation config from run_outputs/outputs.bin, e.g. to resume an "
+        "accuracy run that was killed",
+    )
+    parser.add_argument(
+        "--prefix-cache-gb",
+        type=float,
+        default=0,
+        help="With --continuous-batching: memory for the KV of shared prompt "
+        "prefixes in GB, 0 disables the prefix cache",
+    )
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Schedule generation per token step: finished sequences leave and "
+        "new ones join the running batch (up to --batch-size sequences)",
+    )
     parser.add_argument("--vllm", action="store_true", help="vllm mode")
     parser.add_argument(
         "--api-model-name",
@@ -117,8 +148,21 @@ def get_args():
     parser.add_argument(
         "--api-server",
         type=str,
+        nargs="+",
         default=None,
-        help="Specify an api endpoint call to use api mode",
+        help="Specify one or more api endpoints to use api mode",
+    )
+    parser.add_argument(
+        "--api-max-concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of outstanding requests per api endpoint",
+    )
+    parser.add_argument(
+        "--api-token-ids",
+        action="store_true",
+        help="Ask the api servers for token ids (vLLM only), instead of "
+        "tokenizing the returned text",
     )
 
     args = parser.parse_args()
@@ -135,13 +179,14 @@ def main():
     args = get_args()
 
     if args.vllm:
-        resp = verify_model_name(
-            args.api_model_name,
-            args.api_server + "/v1/models")
-        if resp["error"]:
-            print(f"\n\n\033[91mError:\033[0m", end=" ")
-            print(resp["error"])
-            sys.exit(1)
+        for api_server in args.api_server:
+            resp = verify_model_name(
+                args.api_model_name,
+                api_server + "/v1/models")
+            if resp["error"]:
+                print(f"\n\n\033[91mError:\033[0m", end=" ")
+                print(resp["error"])
+                sys.exit(1)
 
     settings = lg.TestSettings()
     settings.scenario = scenario_map[args.scenario.lower()]
@@ -158,6 +203,7 @@ def main():
     log_output_settings = lg.LogOutputSettings()
     log_output_settings.outdir = args.output_log_dir
     log_output_settings.copy_summary_to_stdout = True
+    log_output_settings.accuracy_log_binary = args.accuracy_log_binary
     log_settings = lg.LogSettings()
     log_settings.log_output = log_output_settings
     log_settings.enable_trace = args.enable_log_trace
@@ -182,6 +228,9 @@ def main():
             api_server=args.api_server,
             api_model_name=args.api_model_name,
             workers=args.num_workers,
+            api_max_concurrency=args.api_max_concurrency,
+            api_token_ids=args.api_token_ids,
+            use_cached_outputs=args.use_cached_outputs,
         )
     else:
         sut = sut_cls(
@@ -192,6 +241,10 @@ def main():
             total_sample_count=args.total_sample_count,
             device=args.device,
             workers=args.num_workers,
+            continuous_batching=args.continuous_batching,
+            length_bucketing=args.length_bucketing,
+            prefix_cache_gb=args.prefix_cache_gb,
+            use_cached_outputs=args.use_cached_outputs,
         )
 
     # Start sut before loadgen starts
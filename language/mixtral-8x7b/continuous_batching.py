@@ -0,0 +1,757 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import torch
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("Continuous-Batching")
+
+
+class Request:
+    """A sample being generated by the ContinuousBatchingEngine"""
+
+    def __init__(
+        self, response_id, input_ids, attention_mask=None, logits_processor=None
+    ):
+        self.response_id = response_id
+        # optional HF LogitsProcessorList for this request, called like in
+        # generate() with its (left padded) token ids
+        self.logits_processor = logits_processor
+        # prompt tokens without padding, 1D
+        if attention_mask is not None:
+            input_ids = input_ids[attention_mask.bool()]
+        self.input_ids = input_ids.reshape(-1)
+        self.tokens = []
+        self.arrival = time.time()
+        self.first_token_time = None
+        # the exception of a failed step, tokens then holds what was
+        # generated before it
+        self.error = None
+
+
+class ContinuousBatchingEngine:
+    """Iteration level scheduler around a HuggingFace causal LM.
+
+    Every step runs one forward pass for all running sequences. Finished
+    sequences (eos after min_new_tokens, or max_new_tokens tokens) are
+    retired after each step, and waiting requests are prefilled and join the
+    running batch as soon as there is room, so no request waits for the
+    longest sequence of a batch to finish. Offline and Server use the same
+    engine, they only differ in how requests arrive.
+
+    The running batch lives in preallocated buffers (see _Slots): decode
+    steps write the new keys and values in place, and sequences joining or
+    leaving only touch their own rows. Decoding is greedy, matching
+    gen_kwargs of the SUTs (num_beams=1, do_sample=False).
+
+    If a step raises, the exception is logged and every running or admitted
+    request is completed with request.error set, so that no caller waits
+    forever; the engine goes on with the waiting requests.
+
+    Args:
+        model: HuggingFace causal LM
+        eos_token_id (int): generation stops after this token
+        pad_token_id (int): token used for left padding
+        max_batch_size (int): maximum number of running sequences
+        max_new_tokens (int): maximum number of generated tokens per request
+        min_new_tokens (int): eos is suppressed before this many tokens
+        on_first_token: optional callback(request), called from the engine
+            thread once request.tokens holds the first token
+        on_complete: callback(request), called from the engine thread when
+            request.tokens is complete or request.error is set
+        prefix_cache: optional PrefixCache; prompts start their prefill
+            from the KV of their longest cached prefix
+    """
+
+    def __init__(
+        self,
+        model,
+        eos_token_id,
+        pad_token_id,
+        max_batch_size=32,
+        max_new_tokens=1024,
+        min_new_tokens=1,
+        on_first_token=None,
+        on_complete=None,
+        prefix_cache=None,
+    ):
+        self.model = model
+        self.device = model.device
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min_new_tokens
+        self.on_first_token = on_first_token
+        self.on_complete = on_complete
+        self.prefix_cache = prefix_cache
+
+        self.waiting = collections.deque()
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+        # The running batch: row i of slots belongs to running[i], pending
+        # holds the last generated token of every row that is not in the
+        # cache yet.
+        self.running = []
+        self.slots = _Slots(max_batch_size, pad_token_id, self.device)
+        self.pending = None
+
+        self.steps = 0
+        self.batch_size_sum = 0
+
+    def submit(self, request):
+        with self.cond:
+            self.waiting.append(request)
+            self.cond.notify()
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.start()
+
+    def stop(self):
+        """Finishes all submitted requests, then stops the engine thread"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+        if self.steps:
+            log.info(
+                "{} decode steps, average batch size {:.1f}".format(
+                    self.steps, self.batch_size_sum / self.steps
+                )
+            )
+        if self.prefix_cache is not None:
+            log.info(self.prefix_cache.stats())
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while not (self.waiting or self.running or self.stopping):
+                    self.cond.wait()
+                if not self.waiting and not self.running:
+                    break
+                n = min(len(self.waiting),
+                        self.max_batch_size - len(self.running))
+                admitted = [self.waiting.popleft() for _ in range(n)]
+            with torch.inference_mode():
+                try:
+                    if admitted:
+                        self.prefill(admitted)
+                    if self.running:
+                        self.decode()
+                except Exception as e:
+                    log.exception("Generation step failed")
+                    self.fail(admitted, e)
+
+    def fail(self, admitted, error):
+        """Completes the running and admitted requests after a failed step
+        and starts over with an empty batch"""
+        running = {id(r) for r in self.running}
+        failed = self.running + [r for r in admitted if id(r) not in running]
+        self.running = []
+        self.pending = None
+        # drop the buffers, the step may have failed allocating them
+        self.slots = _Slots(self.max_batch_size, self.pad_token_id,
+                            self.device)
+        log.error("Completing {} requests without the rest of their tokens"
+                  .format(len(failed)))
+        for request in failed:
+            request.error = error
+            self.complete(request)
+
+    def complete(self, request):
+        try:
+            self.on_complete(request)
+        except Exception:
+            log.exception(
+                "on_complete failed for request {}".format(request.response_id)
+            )
+
+    def prefill(self, requests):
+        """Runs the prompts of new requests and adds them to the batch.
+
+        With a prefix cache, row i is laid out as [pad, cached prefix, pad,
+        rest of the prompt]: the prefixes come from the cache, left padded to
+        the longest one, and only the rest of the prompts runs through the
+        model. The padding in between is masked out like the left padding.
+        """
+        prefixes = [(0, None)] * len(requests)
+        if self.prefix_cache is not None:
+            prefixes = [self.prefix_cache.match(r.input_ids)
+                        for r in requests]
+        plens = [n for n, _ in prefixes]
+        slens = [len(r.input_ids) - n for r, (n, _) in zip(requests, prefixes)]
+        pwidth = max(plens)
+        swidth = max(slens)
+        width = pwidth + swidth
+
+        input_ids = torch.full(
+            (len(requests), width), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(requests), width), dtype=torch.long)
+        for i, r in enumerate(requests):
+            input_ids[i, pwidth - plens[i]: pwidth] = r.input_ids[: plens[i]]
+            input_ids[i, width - slens[i]:] = r.input_ids[plens[i]:]
+            attention_mask[i, pwidth - plens[i]: pwidth] = 1
+            attention_mask[i, width - slens[i]:] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        past = None
+        if pwidth:
+            past = self.prefix_cache.batch(prefixes, pwidth)
+        out = self.model(
+            input_ids=input_ids[:, pwidth:],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, pwidth:],
+            past_key_values=past,
+            use_cache=True,
+        )
+        if self.prefix_cache is not None:
+            layers = cache_layers(out.past_key_values)
+            for i, r in enumerate(requests):
+                keep = attention_mask[i].bool()
+                self.prefix_cache.insert(
+                    r.input_ids,
+                    [(k[i][:, keep], v[i][:, keep]) for k, v in layers],
+                    out.past_key_values,
+                )
+        tokens = self.next_tokens(input_ids, out.logits[:, -1, :], requests)
+        self.slots.add(input_ids, attention_mask, out.past_key_values)
+        self.running.extend(requests)
+        self.emit(len(self.running) - len(requests), tokens)
+
+    def decode(self):
+        """Runs one decode step for every sequence in the batch"""
+        slots = self.slots
+        n = len(self.running)
+        slots.reserve(n, slots.end - slots.start, 1)
+        slots.input_ids[:n, slots.end] = self.pending
+        slots.attention_mask[:n, slots.end] = 1
+        attention_mask = slots.attention_mask[:n, slots.start: slots.end + 1]
+        out = self.model(
+            input_ids=self.pending.unsqueeze(-1),
+            attention_mask=attention_mask,
+            position_ids=attention_mask[:, :-1].sum(-1, keepdim=True),
+            past_key_values=slots.cache(),
+            use_cache=True,
+        )
+        slots.commit(out.past_key_values)
+        tokens = self.next_tokens(
+            slots.input_ids[:n, slots.start: slots.end],
+            out.logits[:, -1, :],
+            self.running,
+        )
+        self.steps += 1
+        self.batch_size_sum += n
+        self.emit(0, tokens)
+
+    def next_tokens(self, input_ids, scores, requests):
+        # same order as generate(): min_new_tokens first, then the logits
+        # processors of the requests, grouped so shared ones run once
+        suppress = [i for i, r in enumerate(requests)
+                    if len(r.tokens) < self.min_new_tokens]
+        if suppress:
+            scores[suppress, self.eos_token_id] = -float("inf")
+        processors = {}
+        for i, r in enumerate(requests):
+            if r.logits_processor is not None:
+                processors.setdefault(id(r.logits_processor), []).append(i)
+        for rows in processors.values():
+            index = torch.tensor(rows, device=scores.device)
+            scores[index] = requests[rows[0]].logits_processor(
+                input_ids[index], scores[index]
+            )
+        return scores.argmax(dim=-1)
+
+    def emit(self, first_row, tokens):
+        """Hands out the tokens generated for rows first_row onwards and
+        retires the sequences that are done"""
+        if first_row == 0:
+            self.pending = tokens
+        else:
+            self.pending = torch.cat([self.pending[:first_row], tokens])
+        done = []
+        now = time.time()
+        for i, token in enumerate(tokens.tolist()):
+            row = first_row + i
+            request = self.running[row]
+            request.tokens.append(token)
+            if len(request.tokens) == 1:
+                request.first_token_time = now
+                if self.on_first_token is not None:
+                    self.on_first_token(request)
+            if len(request.tokens) >= self.max_new_tokens or (
+                token == self.eos_token_id
+                and len(request.tokens) >= self.min_new_tokens
+            ):
+                done.append(row)
+        if done:
+            self.retire(done)
+
+    def retire(self, rows):
+        """Removes finished rows; the last running row moves into each hole,
+        so only the moved rows are copied"""
+        finished = [self.running[i] for i in rows]
+        order = list(range(len(self.running)))
+        for row in sorted(rows, reverse=True):
+            last = len(order) - 1
+            if row != last:
+                self.slots.move(last, row)
+                order[row] = order[last]
+            order.pop()
+        self.running = [self.running[i] for i in order]
+        if order:
+            self.pending = self.pending[
+                torch.tensor(order, device=self.pending.device)]
+        else:
+            self.pending = None
+        self.slots.truncate(len(order))
+        for request in finished:
+            self.complete(request)
+
+
+class _Slots:
+    """Preallocated tensors of the running batch.
+
+    Row i belongs to running[i] and every row ends at column end; columns
+    [start, end) are the window handed to the model. The attention mask is
+    0 outside of the window and on free rows. Sequences joining, leaving or
+    growing only write their own rows and columns. When the buffers are too
+    small they are reallocated `growth` times larger than needed, so the
+    copies are amortized over many steps.
+    """
+
+    growth = 1.5
+
+    def __init__(self, max_rows, pad_token_id, device):
+        self.max_rows = max_rows
+        self.pad_token_id = pad_token_id
+        self.device = device
+        self.rows = 0
+        self.start = self.end = 0
+        self.input_ids = self.attention_mask = None
+        # [rows, heads, columns, head_dim] per layer, on the device of the
+        # layer
+        self.keys = []
+        self.values = []
+        self.cache_type = None
+
+    def reserve(self, rows, width, extra, layers=None):
+        """Makes room for rows rows and a window of width columns ending at
+        end, followed by extra columns. layers are (key, value) per layer
+        giving the heads, dtypes and devices of new buffers."""
+        capacity, columns = (0, 0)
+        if self.input_ids is not None:
+            capacity, columns = self.input_ids.shape
+            if (rows <= capacity and width <= self.end
+                    and self.end + extra <= columns):
+                return
+        if rows > capacity:
+            capacity = max(
+                rows, min(int(capacity * self.growth) + 1, self.max_rows))
+        columns = int((width + extra) * self.growth) + 1
+        # most of the spare room goes after the window, for decode steps
+        end = width + (columns - width - extra) // 4
+        used = self.end - self.start
+        if layers is None:
+            layers = list(zip(self.keys, self.values))
+
+        def grow(old, new):
+            # columns are dim 1 of input_ids and the mask, dim 2 of the KV
+            if old is not None:
+                dim = new.dim() // 2
+                new[: self.rows].narrow(dim, end - used, used).copy_(
+                    old[: self.rows].narrow(dim, self.start, used))
+            return new
+
+        self.input_ids = grow(
+            self.input_ids,
+            torch.full((capacity, columns), self.pad_token_id,
+                       dtype=torch.long, device=self.device),
+        )
+        self.attention_mask = grow(
+            self.attention_mask,
+            torch.zeros((capacity, columns), dtype=torch.long,
+                        device=self.device),
+        )
+        keys, values = [], []
+        for i, (k, v) in enumerate(layers):
+            # zeros, masked out keys and values must stay finite
+            keys.append(grow(
+                self.keys[i] if self.keys else None,
+                k.new_zeros((capacity, k.shape[1], columns, k.shape[3])),
+            ))
+            values.append(grow(
+                self.values[i] if self.values else None,
+                v.new_zeros((capacity, v.shape[1], columns, v.shape[3])),
+            ))
+        self.keys, self.values = keys, values
+        self.start, self.end = end - used, end
+
+    def add(self, input_ids, attention_mask, past):
+        """Adds prefilled sequences as new rows, right aligned at end"""
+        if self.cache_type is None:
+            self.cache_type = (
+                tuple if isinstance(past, (tuple, list)) else type(past))
+        layers = cache_layers(past)
+        n, width = input_ids.shape
+        self.reserve(self.rows + n, max(self.end - self.start, width), 1,
+                     layers)
+        start = min(self.start, self.end - width)
+        if start < self.start:
+            self.input_ids[: self.rows, start: self.start] = self.pad_token_id
+        rows = slice(self.rows, self.rows + n)
+        new = slice(self.end - width, self.end)
+        self.input_ids[rows, start: new.start] = self.pad_token_id
+        self.input_ids[rows, new] = input_ids
+        self.attention_mask[rows, new] = attention_mask
+        for i, (k, v) in enumerate(layers):
+            self.keys[i][rows, :, new] = k
+            self.values[i][rows, :, new] = v
+        self.start = start
+        self.rows += n
+
+    def move(self, src, dst):
+        window = slice(self.start, self.end)
+        self.input_ids[dst, window] = self.input_ids[src, window]
+        self.attention_mask[dst, window] = self.attention_mask[src, window]
+        for k, v in zip(self.keys, self.values):
+            k[dst, :, window] = k[src, :, window]
+            v[dst, :, window] = v[src, :, window]
+
+    def truncate(self, rows):
+        """Frees the rows from rows on and drops the columns that are padding
+        for all remaining rows"""
+        self.attention_mask[rows: self.rows, self.start: self.end] = 0
+        self.rows = rows
+        if not rows:
+            self.start = self.end
+            return
+        used = self.attention_mask[:rows, self.start: self.end].any(0)
+        self.start += int(used.int().argmax())
+
+    def layer(self, i):
+        return (self.keys[i][: self.rows, :, self.start: self.end],
+                self.values[i][: self.rows, :, self.start: self.end])
+
+    def write(self, i, key_states, value_states):
+        """Writes the keys and values of the next columns of layer i, returns
+        the layer including them"""
+        q = slice(self.end, self.end + key_states.shape[-2])
+        self.keys[i][: self.rows, :, q] = key_states
+        self.values[i][: self.rows, :, q] = value_states
+        return (self.keys[i][: self.rows, :, self.start: q.stop],
+                self.values[i][: self.rows, :, self.start: q.stop])
+
+    def cache(self):
+        """Returns a KV cache of the window for the next decode step"""
+        if self.cache_type is tuple:
+            return tuple(self.layer(i) for i in range(len(self.keys)))
+        cache = _slot_cache_class(self.cache_type)()
+        cache.slots = self
+        for i in range(len(self.keys)):
+            set_cache_layer(cache, i, *self.layer(i))
+        return cache
+
+    def commit(self, past):
+        """Takes the column of a decode step into the window"""
+        if self.cache_type is tuple:
+            # legacy caches are concatenated by the model, copy the column
+            for i, (k, v) in enumerate(cache_layers(past)):
+                self.write(i, k[..., -1:, :], v[..., -1:, :])
+        self.end += 1
+
+
+_slot_cache_classes = {}
+
+
+def _slot_cache_class(cache_type):
+    """Returns a subclass of the Cache class cache_type whose update()
+    writes the new keys and values into the buffers of its slots instead of
+    concatenating them"""
+    cls = _slot_cache_classes.get(cache_type)
+    if cls is None:
+
+        class SlotCache(cache_type):
+            def update(self, key_states, value_states, layer_idx, *args,
+                       **kwargs):
+                k, v = self.slots.write(layer_idx, key_states, value_states)
+                set_cache_layer(self, layer_idx, k, v)
+                return k, v
+
+        cls = _slot_cache_classes[cache_type] = SlotCache
+    return cls
+
+
+class _Node:
+    __slots__ = ("tokens", "layers", "children", "parent", "last_used")
+
+    def __init__(self, tokens, layers, parent):
+        # tokens on the edge from the parent, and their (key, value) per
+        # layer, shaped [heads, len(tokens), head_dim]
+        self.tokens = tokens
+        self.layers = layers
+        self.children = {}
+        self.parent = parent
+        self.last_used = 0
+
+
+class PrefixCache:
+    """KV cache of prompt prefixes, shared between requests.
+
+    Prompts are stored in a radix tree keyed on token ids; every node holds
+    the keys and values of the tokens on its edge, so prompts that share a
+    prefix (e.g. the same system prompt) share its KV. match() returns the
+    KV of the longest cached prefix of a prompt, insert() adds the KV of a
+    prefilled prompt. When the stored KV exceeds max_bytes, the least
+    recently used leaves are evicted; they are kept in a heap ordered by
+    last use, so an eviction does not walk the tree.
+
+    Keys and values depend only on the tokens before them and on their
+    positions, which start at 0 for every prompt, so a cached prefix is
+    exact for any prompt that starts with it.
+
+    Args:
+        max_bytes (int): memory budget for the stored keys and values
+        min_match (int): shorter matches are not used
+    """
+
+    def __init__(self, max_bytes, min_match=16):
+        self.max_bytes = max_bytes
+        self.min_match = min_match
+        self.root = _Node((), None, None)
+        self.bytes = 0
+        self.clock = 0
+        self.like = None
+        # (last_used, seq, node) of the leaves; entries of nodes that were
+        # used again, got children or were evicted are skipped when popped
+        self.leaves = []
+        self.seq = itertools.count()
+        self.nodes = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    def match(self, input_ids):
+        """Returns (n, layers): the length of the longest cached prefix of
+        input_ids and its (key, value) per layer, shaped
+        [heads, n, head_dim]. At least the last prompt token is left to
+        prefill, the model needs its logits."""
+        tokens = input_ids.tolist()
+        limit = len(tokens) - 1
+        self.clock += 1
+        self.lookups += 1
+        self.prompt_tokens += len(tokens)
+
+        node, n, parts = self.root, 0, []
+        while n < limit:
+            child = node.children.get(tokens[n])
+            if child is None:
+                break
+            common = _common_length(child.tokens, tokens[n:limit])
+            self._touch(child)
+            parts.append((child, common))
+            n += common
+            if common < len(child.tokens):
+                break
+            node = child
+        if n < self.min_match:
+            return 0, None
+
+        self.hits += 1
+        self.hit_tokens += n
+        layers = []
+        for i in range(len(parts[0][0].layers)):
+            layers.append(
+                tuple(
+                    torch.cat([c.layers[i][j][:, :m] for c, m in parts], dim=1)
+                    for j in range(2)
+                )
+            )
+        return n, layers
+
+    def batch(self, prefixes, width):
+        """Builds the left padded KV cache of the matched prefixes"""
+        like = next(layers for _, layers in prefixes if layers is not None)
+        merged = []
+        for i, (k, v) in enumerate(like):
+            ks, vs = [], []
+            for n, layers in prefixes:
+                if layers is None:
+                    ks.append(k.new_zeros((k.shape[0], width, k.shape[2])))
+                    vs.append(v.new_zeros((v.shape[0], width, v.shape[2])))
+                else:
+                    ks.append(pad_left(layers[i][0], width, 0, -2))
+                    vs.append(pad_left(layers[i][1], width, 0, -2))
+            merged.append((torch.stack(ks), torch.stack(vs)))
+        return build_cache(merged, self.like)
+
+    def insert(self, input_ids, layers, like):
+        """Adds the (key, value) per layer, shaped [heads, len, head_dim], of
+        the prompt input_ids. like is a KV cache of the model, its format is
+        used for the caches built from the stored prefixes."""
+        if self.like is None:
+            self.like = () if isinstance(like, (tuple, list)) else type(like)()
+        tokens = input_ids.tolist()
+        node, n = self.root, 0
+        while n < len(tokens):
+            child = node.children.get(tokens[n])
+            if child is None:
+                leaf = _Node(
+                    tuple(tokens[n:]),
+                    [(k[:, n:].clone(), v[:, n:].clone()) for k, v in layers],
+                    node,
+                )
+                node.children[tokens[n]] = leaf
+                self._touch(leaf)
+                self.nodes += 1
+                self.bytes += _node_bytes(leaf)
+                break
+            common = _common_length(child.tokens, tokens[n:])
+            if common < len(child.tokens):
+                self._split(child, common)
+            self._touch(child)
+            node = node.children[tokens[n]]
+            n += common
+        self._evict()
+
+    def _split(self, node, n):
+        """Splits the edge of node after n tokens"""
+        head = _Node(
+            node.tokens[:n],
+            [(k[:, :n].clone(), v[:, :n].clone()) for k, v in node.layers],
+            node.parent,
+        )
+        head.last_used = node.last_used
+        node.parent.children[node.tokens[0]] = head
+        node.tokens = node.tokens[n:]
+        node.layers = [(k[:, n:].clone(), v[:, n:].clone())
+                       for k, v in node.layers]
+        node.parent = head
+        head.children[node.tokens[0]] = node
+        self.nodes += 1
+
+    def _touch(self, node):
+        node.last_used = self.clock
+        if not node.children:
+            self._push_leaf(node)
+
+    def _push_leaf(self, node):
+        heapq.heappush(self.leaves, (node.last_used, next(self.seq), node))
+        if len(self.leaves) > 4 * self.nodes + 64:
+            # drop the stale entries of often used leaves
+            self.leaves = [e for e in self.leaves if self._is_leaf(*e)]
+            heapq.heapify(self.leaves)
+
+    def _is_leaf(self, last_used, seq, node):
+        """Whether a heap entry still is the last use of a cached leaf"""
+        return (
+            not node.children
+            and node.last_used == last_used
+            and node.parent is not None
+            and node.parent.children.get(node.tokens[0]) is node
+        )
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.leaves:
+            entry = heapq.heappop(self.leaves)
+            if not self._is_leaf(*entry):
+                continue
+            leaf = entry[2]
+            parent = leaf.parent
+            del parent.children[leaf.tokens[0]]
+            leaf.parent = None
+            self.nodes -= 1
+            self.bytes -= _node_bytes(leaf)
+            self.evictions += 1
+            if parent is not self.root and not parent.children:
+                self._push_leaf(parent)
+
+    def stats(self):
+        return (
+            "prefix cache: {} of {} prompts hit, {:.1%} of prompt tokens "
+            "reused, {:.1f} MB stored, {} evictions".format(
+                self.hits,
+                self.lookups,
+                self.hit_tokens / max(self.prompt_tokens, 1),
+                self.bytes / 2**20,
+                self.evictions,
+            )
+        )
+
+
+def _common_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def _node_bytes(node):
+    return sum(
+        k.numel() * k.element_size() + v.numel() * v.element_size()
+        for k, v in node.layers
+    )
+
+
+def pad_left(t, width, value, dim=-1):
+    """Left pads t to width along dim"""
+    missing = width - t.shape[dim]
+    if missing == 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = missing
+    return torch.cat([t.new_full(shape, value), t], dim=dim)
+
+
+def cache_layers(past):
+    """Returns the (key, value) tensors per layer of a KV cache, for the
+    legacy tuple format as well as for Cache objects"""
+    if hasattr(past, "layers"):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    if hasattr(past, "key_cache"):
+        return list(zip(past.key_cache, past.value_cache))
+    return [tuple(layer) for layer in past]
+
+
+def set_cache_layer(cache, i, k, v):
+    """Sets the keys and values of layer i of a Cache object to k and v,
+    without copying them"""
+    if hasattr(cache, "layers"):
+        while len(cache.layers) <= i:
+            cache.layers.append(cache.layer_class_to_replicate())
+        layer = cache.layers[i]
+        if not layer.is_initialized:
+            layer.update(k[..., :0, :], v[..., :0, :])
+        layer.keys, layer.values = k, v
+    else:
+        if len(cache.key_cache) <= i:
+            cache.key_cache.append(k)
+            cache.value_cache.append(v)
+        else:
+            cache.key_cache[i], cache.value_cache[i] = k, v
+        if i == 0 and hasattr(cache, "_seen_tokens"):
+            cache._seen_tokens = k.shape[-2]
+
+
+def build_cache(layers, like):
+    """Builds a KV cache in the format of like from (key, value) per layer"""
+    if isinstance(like, (tuple, list)):
+        return tuple(layers)
+    cache = type(like)()
+    for i, (k, v) in enumerate(layers):
+        cache.update(k, v, i)
+    return cache
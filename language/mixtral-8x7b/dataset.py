@@ -9,13 +9,23 @@ from torch.nn.functional import pad
 from torch.utils.data import DataLoader
 from typing import Optional, Dict, Sequence
 import io
+import sys
 
 # import utils
 import copy
-import pickle
 
 import logging
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from packed_arrays import (
+    PackedMasks,
+    PackedTokens,
+    encoding_key,
+    load_packed,
+    pack_tokens,
+    save_packed,
+)
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("Llama-70B-Dataset")
 
@@ -61,28 +71,46 @@ class Dataset:
                 )
             )
 
-        print("Loading dataset...")
-        import pandas as pd
-
-        processed_data = pd.read_pickle(self.dataset_path)
-
-        input_tokens = processed_data["tok_input"]
-
-        self.input_ids = []
-        self.input_lens = []
-        self.attention_masks = []
-        self.dataset_names = []
-
-        for ids in input_tokens:
-            input_ids = torch.tensor(ids, dtype=torch.int32).view(
-                1, -1).to(self.device)
-            attn_mask = torch.ones_like(input_ids)
-            self.input_ids.append(input_ids)
-            self.attention_masks.append(attn_mask)
-            self.input_lens.append(input_ids.shape[-1])
-
-        for dataset in processed_data["dataset"]:
-            self.dataset_names.append(dataset)
+        # The token ids are packed into flat arrays next to the pickle on
+        # the first run, in a directory per pickle content, and later runs
+        # memory-map those instead of unpickling
+        packed_dir = os.path.join(
+            self.dataset_path + ".packed", encoding_key([self.dataset_path]))
+        packed = load_packed(packed_dir, ["tokens", "offsets", "dataset_names"])
+        if packed is None:
+            print("Loading dataset...")
+            import pandas as pd
+
+            processed_data = pd.read_pickle(self.dataset_path)
+
+            tokens, offsets = pack_tokens(processed_data["tok_input"])
+            packed = {
+                "tokens": tokens,
+                "offsets": offsets,
+                "dataset_names": processed_data["dataset"].to_numpy(str),
+            }
+
+            # Expected output length of every sample: the median reference
+            # output length of its dataset (OpenOrca, GSM8K or MBXP). Only
+            # used to put samples with similar generation lengths into the
+            # same batch.
+            if "tok_ref_output" in processed_data.columns:
+                ref_lens = processed_data["tok_ref_output"].apply(len)
+                medians = ref_lens.groupby(processed_data["dataset"]).median()
+                packed["output_len_hints"] = processed_data["dataset"].map(
+                    medians).to_numpy(np.float64)
+            save_packed(packed_dir, packed)
+        else:
+            print("Loading packed dataset from {}...".format(packed_dir))
+
+        self.input_ids = PackedTokens(
+            packed["tokens"], packed["offsets"], torch.int32, self.device)
+        self.attention_masks = PackedMasks(self.input_ids)
+        self.input_lens = np.diff(packed["offsets"]).tolist()
+        self.dataset_names = packed["dataset_names"].tolist()
+        self.output_len_hints = None
+        if "output_len_hints" in packed:
+            self.output_len_hints = packed["output_len_hints"].tolist()
         print("Finished loading dataset.")
 
     def postProcess(
@@ -91,6 +119,7 @@ class Dataset:
         input_seq_lens=None,
         query_id_list=None,
         sample_index_list=None,
+        padded_len=1024,
     ):
         """Postprocesses output prediction"""
 
@@ -104,9 +133,9 @@ class Dataset:
             pred = out_tokens[i, input_len:].reshape(-1).cpu().numpy()
             preds.append(pred)
         """
-        # Everything is padded to max_len (1024), so prune the input and parse
-        # to numpy
-        output_seq = out_tokens[:, 1024:].cpu().numpy()
+        # Everything is padded to padded_len (max_len, 1024, unless the SUT
+        # uses length buckets), so prune the input and parse to numpy
+        output_seq = out_tokens[:, padded_len:].cpu().numpy()
         aux_seq = []
         assert len(query_id_list) == output_seq.shape[0]
         for i in range(len(output_seq)):
@@ -116,16 +145,6 @@ class Dataset:
             aux_seq.append(aux)
         output_seq = np.stack(aux_seq)
 
-        # Save outputs
-        if not os.path.exists("run_outputs"):
-            os.makedirs("run_outputs")
-        fname = "q" + "_".join([str(i) for i in query_id_list])
-        fname = f"run_outputs/{fname}.pkl"
-        with open(fname, mode="wb") as f:
-            d = {"query_ids": query_id_list, "outputs": output_seq}
-            print(f"Saving outputs to {fname}")
-            pickle.dump(d, f)
-
         return output_seq
 
     def LoadSamplesToRam(self, sample_list):
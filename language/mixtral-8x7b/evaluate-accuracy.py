@@ -2,11 +2,16 @@ import argparse
 from transformers import AutoTokenizer
 import nltk
 import evaluate
+import hashlib
+import multiprocessing
 import numpy as np
 import pandas as pd
-import json
+import os
+import pickle
 import re
 
+from mlcommons_loadgen.accuracy_log import read_accuracy_log
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -25,6 +30,31 @@ def get_args():
         type=int,
         help="Number of workers used for the MBXP evaluation",
     )
+    parser.add_argument(
+        "--mbxp-cache",
+        default=None,
+        help="File caching the MBXP check outcomes by hash of solution and "
+        "tests, so re-evaluating unchanged solutions skips running them",
+    )
+    parser.add_argument(
+        "--eval-workers",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of processes decoding the outputs and computing the "
+        "OpenOrca and GSM8K metrics, 0 to run in the main process",
+    )
+    parser.add_argument(
+        "--shard-size",
+        default=256,
+        type=int,
+        help="Number of samples per task of the evaluation processes",
+    )
+    parser.add_argument(
+        "--decode-cache",
+        default=None,
+        help="File caching the decoded outputs by token hash, so that "
+        "repeated evaluations only decode outputs they have not seen",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -114,30 +144,102 @@ def create_mbxp_dict(row, response):
     }
 
 
-def main():
+# Sharded evaluation
+#
+# The outputs are decoded and scored in shards on a process pool. ROUGE is
+# computed per sample (use_aggregator=False) and the shards are merged in
+# order, so the means are the same as for a single compute() call.
+
+tokenizer = None
+metric = None
 
-    args = get_args()
-    dataset_path = args.dataset_file
-    checkpoint_path = args.checkpoint_path
-    metric = evaluate.load("rouge")
-    nltk.download("punkt")
 
+def init_worker(checkpoint_path):
+    global tokenizer, metric
     tokenizer = AutoTokenizer.from_pretrained(
         checkpoint_path,
         model_max_length=2048,
         padding_side="left",
         use_fast=False,
     )
+    metric = evaluate.load("rouge")
+
+
+def decode_shard(preds_token_ids):
+    return tokenizer.batch_decode(preds_token_ids, skip_special_tokens=True)
 
-    data = get_groundtruth(args.dataset_file)
-    query_types, gt_outputs = data["dataset"], data["gt_output"]
 
-    target_required_GSM8K = []
+def score_shard(samples):
+    """Scores a shard of (query_type, decoded output, target) samples,
+    returns the per-sample ROUGE scores and prediction lengths of the
+    OpenOrca samples and the number of correct GSM8K answers"""
+    preds_OpenOrca = []
     target_required_OpenOrca = []
-    results_MBXP = []
-    preds_token_GSM8K = []
-    preds_token_OpenOrca = []
-    preds_token_MBXP = []
+    gsm8k_correct = 0
+    for query_type, pred_text, target in samples:
+        if query_type == "OpenOrca":
+            preds_OpenOrca.append(pred_text)
+            target_required_OpenOrca.append(target)
+        else:
+            ref = try_float(target)
+            tgt = try_float(
+                maybe_remove_comma(find_number(pred_text.split("\nQ:")[0]))
+            )
+            if tgt is not None:
+                gsm8k_correct += ref == tgt
+
+    preds, targets = postprocess_text(
+        preds_OpenOrca, target_required_OpenOrca)
+    scores = {}
+    if preds:
+        scores = metric.compute(
+            predictions=preds,
+            references=targets,
+            use_stemmer=True,
+            use_aggregator=False,
+        )
+    return scores, [len(pred) for pred in preds], gsm8k_correct
+
+
+def token_hash(tokens):
+    return hashlib.sha1(
+        np.ascontiguousarray(tokens, np.int64).tobytes()).digest()
+
+
+def load_decode_cache(path, checkpoint_path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        cache = pickle.load(f)
+    if cache["checkpoint"] != os.path.abspath(checkpoint_path):
+        print(f"Ignoring {path}, it was decoded with {cache['checkpoint']}")
+        return {}
+    return cache["texts"]
+
+
+def save_decode_cache(path, checkpoint_path, texts):
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(
+            {"checkpoint": os.path.abspath(checkpoint_path), "texts": texts}, f
+        )
+    os.replace(path + ".tmp", path)
+
+
+def shards(items, shard_size):
+    return [items[i: i + shard_size]
+            for i in range(0, len(items), shard_size)]
+
+
+def main():
+
+    args = get_args()
+    checkpoint_path = args.checkpoint_path
+    # fetch the metric and nltk data once, before the workers load them
+    evaluate.load("rouge")
+    nltk.download("punkt")
+
+    data = get_groundtruth(args.dataset_file)
+    query_types, gt_outputs = data["dataset"], data["gt_output"]
 
     eval_dtype = np.int64
     if args.dtype == "int32":
@@ -145,10 +247,12 @@ def main():
     elif args.dtype == "float":
         eval_dtype = np.float32
 
-    with open(args.mlperf_accuracy_file, "r") as f:
-        results = json.load(f)
+    results = read_accuracy_log(args.mlperf_accuracy_file)
 
     seen = set()
+    qsl_idxs = []
+    hashes = []
+    to_decode = {}
     gen_tok_len = 0
     gen_num = 0
     for pred in results:
@@ -158,77 +262,74 @@ def main():
             continue
 
         seen.add(qsl_idx)
-
+        pred = np.frombuffer(pred["data"], eval_dtype)
+        gen_tok_len += len(pred)
+
+        key = token_hash(pred)
+        qsl_idxs.append(qsl_idx)
+        hashes.append(key)
+        to_decode.setdefault(key, pred)
+
+    texts = load_decode_cache(args.decode_cache, checkpoint_path)
+    for key in texts.keys() & to_decode.keys():
+        del to_decode[key]
+
+    pool = None
+    imap = map
+    if args.eval_workers > 0:
+        pool = multiprocessing.Pool(
+            args.eval_workers, init_worker, (checkpoint_path,))
+        imap = pool.imap
+    else:
+        init_worker(checkpoint_path)
+
+    # Decode each distinct output once
+    keys = list(to_decode)
+    decoded = imap(decode_shard, shards(list(to_decode.values()),
+                                        args.shard_size))
+    for shard_keys, shard_texts in zip(shards(keys, args.shard_size), decoded):
+        texts.update(zip(shard_keys, shard_texts))
+    if args.decode_cache is not None and keys:
+        save_decode_cache(args.decode_cache, checkpoint_path, texts)
+
+    samples = []
+    results_MBXP = []
+    gsm8k_total = 0
+    for qsl_idx, key in zip(qsl_idxs, hashes):
         query_type = query_types.iloc[qsl_idx]
-        if query_type == "GSM8K":
-            target = gt_outputs.iloc[qsl_idx]
-            target_required_GSM8K.append(target)
-            pred = np.frombuffer(bytes.fromhex(pred["data"]), eval_dtype)
-
-            gen_tok_len += len(pred)
-            preds_token_GSM8K.append(pred)
-        elif query_type == "OpenOrca":
-            target = gt_outputs.iloc[qsl_idx]
-            target_required_OpenOrca.append(target)
-            pred = np.frombuffer(bytes.fromhex(pred["data"]), eval_dtype)
-
-            gen_tok_len += len(pred)
-            preds_token_OpenOrca.append(pred)
+        if query_type in ("GSM8K", "OpenOrca"):
+            samples.append(
+                (query_type, texts[key], gt_outputs.iloc[qsl_idx]))
+            gsm8k_total += query_type == "GSM8K"
         else:
-            target = data.iloc[qsl_idx]
-            pred = np.frombuffer(bytes.fromhex(pred["data"]), eval_dtype)
-            pred_str = tokenizer.decode(pred, skip_special_tokens=True)
-            results_MBXP.append(create_mbxp_dict(target, pred_str))
-
-            gen_tok_len += len(pred)
-
-    # OpenOrca metric
-    preds_decoded_text = tokenizer.batch_decode(
-        preds_token_OpenOrca, skip_special_tokens=True
-    )
-
-    preds, targets = postprocess_text(
-        preds_decoded_text, target_required_OpenOrca)
-
-    if preds:
-        result = metric.compute(
-            predictions=preds,
-            references=targets,
-            use_stemmer=True,
-            use_aggregator=False,
-        )
-        result = {k: float(round(np.mean(v) * 100, 4))
-                  for k, v in result.items()}
-        prediction_lens = [len(pred) for pred in preds]
+            results_MBXP.append(
+                create_mbxp_dict(data.iloc[qsl_idx], texts[key]))
 
-    else:
-        result = {}
-        prediction_lens = []
-
-    # GSM8K metric
-    preds_decoded_text = tokenizer.batch_decode(
-        preds_token_GSM8K, skip_special_tokens=True
-    )
-    pred_nums = [
-        maybe_remove_comma(find_number(pred_text.split("\nQ:")[0]))
-        for pred_text in preds_decoded_text
-    ]
-    gsm8k_total = len(target_required_GSM8K)
+    # OpenOrca and GSM8K metrics
+    rouge_scores = {}
+    prediction_lens = []
     correct = 0
-    for idx in range(len(target_required_GSM8K)):
-        ref = try_float(target_required_GSM8K[idx])
-        tgt = try_float(pred_nums[idx])
-        if tgt is None:
-            continue
-        correct += ref == tgt
-
+    for scores, lens, gsm8k_correct in imap(
+        score_shard, shards(samples, args.shard_size)
+    ):
+        for k, v in scores.items():
+            rouge_scores.setdefault(k, []).extend(v)
+        prediction_lens.extend(lens)
+        correct += gsm8k_correct
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    result = {k: float(round(np.mean(v) * 100, 4))
+              for k, v in rouge_scores.items()}
     result["gsm8k"] = 100.0 * correct / gsm8k_total
 
     # MBXP metric
     from evaluate_mbxp import evaluate_mbxp
 
     if results_MBXP:
-        result["mbxp"] = evaluate_mbxp(results_MBXP, args.n_workers)
+        result["mbxp"] = evaluate_mbxp(
+            results_MBXP, args.n_workers, args.mbxp_cache)
     else:
         result["mbxp"] = 0
 
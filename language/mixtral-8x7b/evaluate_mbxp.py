@@ -1,8 +1,9 @@
 import argparse
+import hashlib
 import json
 import multiprocessing
+import os
 import pickle
-import queue
 import re
 import timeit
 
@@ -25,6 +26,28 @@ from mxeval.execution import (
     check_correctness_typescript,
 )
 
+CHECKERS = {
+    "cpp": check_correctness_cpp,
+    "csharp": check_correctness_csharp,
+    "go": check_correctness_go,
+    "java": check_correctness_java,
+    "javascript": check_correctness_javascript,
+    "kotlin": check_correctness_kotlin,
+    "perl": check_correctness_perl,
+    "php": check_correctness_php,
+    "python": check_correctness_python,
+    "ruby": check_correctness_ruby,
+    "scala": check_correctness_scala,
+    "swift": check_correctness_swift,
+    "typescript": check_correctness_typescript,
+}
+
+EVALUATED_LANGS = ["cpp", "python", "php", "javascript", "ruby", "typescript"]
+
+# Relative cost of checking one problem, the compiled languages pay for a
+# compiler run per problem
+LANG_COST = {"cpp": 4.0, "typescript": 3.0}
+
 
 def postprocess_golang(code: str) -> str:
     multi_line_imports = re.compile(
@@ -50,95 +73,145 @@ def postprocess_python(code: str) -> str:
     return code.lstrip()
 
 
-def worker(inp_queue, out_queue):
-    while True:
-        try:
-            problem = inp_queue.get(timeout=5)
-        except queue.Empty:
-            break
+def prepare_problem(problem):
+    """Returns the checker input of a problem and the extracted solution"""
+    problem = dict(problem)
+    problem["task_id"] = f"{problem['lang']}_{problem['entry_point']}"
+    problem["test"] = problem["test_code"]
 
-        key = f"{problem['lang']}_{problem['entry_point']}"
-        checker = eval(f"check_correctness_{problem['lang']}")
+    solution = problem["response"]
 
-        problem["task_id"] = key
-        problem["test"] = problem["test_code"]
+    try:
+        solution = solution[: solution.index("```")]
+    except ValueError:
+        # Happens when a code block isn't closed properly
+        pass
 
-        solution = problem["response"]
+    if problem["lang"] == "go":
+        solution = postprocess_golang(solution)
+    elif problem["lang"] == "python":
+        solution = postprocess_python(solution)
+    elif problem["lang"] == "scala":
+        solution = postprocess_scala(solution)
 
-        try:
-            solution = solution[: solution.index("```")]
-        except ValueError:
-            # Happens when a code block isn't closed properly
-            pass
-
-        if problem["lang"] == "go":
-            solution = postprocess_golang(solution)
-        elif problem["lang"] == "python":
-            solution = postprocess_python(solution)
-        elif problem["lang"] == "scala":
-            solution = postprocess_scala(solution)
-
-        # Mixtral likes escaping underscores for some reason, so let's remove
-        # these
-        solution = solution.replace("\\_", "_")
-
-        # The evaluation script evaluates `code = prompt + solution + tests`
-        # But Mixtral regenerates the prompt in its output, so we should remove
-        # this
-        problem["prompt"] = ""
+    # Mixtral likes escaping underscores for some reason, so let's remove
+    # these
+    solution = solution.replace("\\_", "_")
+
+    # The evaluation script evaluates `code = prompt + solution + tests`
+    # But Mixtral regenerates the prompt in its output, so we should remove
+    # this
+    problem["prompt"] = ""
+    return problem, solution
+
+
+def cache_key(problem, solution):
+    """Hash of everything that decides the outcome of a check"""
+    h = hashlib.sha1()
+    for part in (problem["lang"], problem["entry_point"],
+                 solution, problem["test"]):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def expected_cost(problem, solution):
+    """Sort key of a check, the cost of its language and then its length,
+    which keeps the problems of a language together"""
+    lang = problem["lang"]
+    return (LANG_COST.get(lang, 1.0), lang,
+            len(solution) + len(problem["test"]))
+
+
+def worker(inp_queue, out_queue):
+    """Checks problems until it gets None. The worker process lives for the
+    whole evaluation instead of being started per problem; every check
+    still runs in a fresh sandbox of its checker."""
+    while True:
+        job = inp_queue.get()
+        if job is None:
+            break
+
+        problem, solution = job
+        checker = CHECKERS[problem["lang"]]
         try:
             result = checker(problem, solution, timeout=20.0)
             out_queue.put(
-                (
-                    key,
-                    problem["lang"],
-                    result["passed"],
-                    result["result"],
-                    problem["response"],
-                )
-            )
+                (problem, solution, result["passed"], result["result"]))
         except Exception as e:
             print(e)
-            out_queue.put(
-                (key, problem["lang"], False, "", problem["response"]))
+            out_queue.put((problem, solution, False, ""))
 
 
-def evaluate_mbxp(results, n_workers):
-    by_lang = {}
-    for problem in results:
-        by_lang.setdefault(problem["lang"], []).append(problem)
+def load_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
 
-    inp_queue = multiprocessing.Queue()
-    out_queue = multiprocessing.Queue()
 
-    n_problems = 0
+def save_cache(cache_path, cache):
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(cache_path + ".tmp", cache_path)
 
-    for lang, problems in by_lang.items():
-        if lang not in ["cpp", "python", "php",
-                        "javascript", "ruby", "typescript"]:
+
+def evaluate_mbxp(results, n_workers, cache_path=None):
+    """Checks the MBXP responses and returns the pass@1 in percent.
+
+    The problems are queued longest expected check first, so the slow
+    compiled languages do not end up in the tail. With cache_path, outcomes are kept by hash of
+    solution and tests, and re-evaluating an unchanged solution is not run
+    again. Timeouts and checker errors are not cached.
+    """
+    cache = load_cache(cache_path)
+
+    jobs = []
+    done = []
+    for problem in results:
+        if problem["lang"] not in EVALUATED_LANGS:
             continue
+        problem, solution = prepare_problem(problem)
+        cached = cache.get(cache_key(problem, solution))
+        if cached is not None:
+            done.append((problem, solution, cached["passed"], cached["result"]))
+        else:
+            jobs.append((problem, solution))
+    jobs.sort(key=lambda job: expected_cost(*job), reverse=True)
+    n_problems = len(done) + len(jobs)
 
-        n_problems += len(problems)
-        for problem in problems:
-            inp_queue.put(problem)
+    inp_queue = multiprocessing.Queue()
+    out_queue = multiprocessing.Queue()
+    for job in jobs:
+        inp_queue.put(job)
 
     start = timeit.default_timer()
     workers = []
-    for _ in range(n_workers):
+    for _ in range(min(n_workers, len(jobs))):
+        inp_queue.put(None)
         w = multiprocessing.Process(target=worker, args=(inp_queue, out_queue))
         w.start()
         workers.append(w)
 
+    for _ in tqdm(range(len(jobs))):
+        problem, solution, passed, result = out_queue.get()
+        done.append((problem, solution, passed, result))
+        if result != "timed out" and result != "":
+            cache[cache_key(problem, solution)] = {
+                "passed": passed, "result": result}
+    for w in workers:
+        w.join()
+
     passes = {}
     n_passed = 0
     lang_passed = {}
     lang_counts = {}
-    for i in tqdm(range(n_problems)):
-        key, lang, passed, result, response = out_queue.get()
-        passes[key] = {
+    for problem, _, passed, result in done:
+        lang = problem["lang"]
+        passes[problem["task_id"]] = {
             "passed": passed,
             "result": result,
-            "response": response}
+            "response": problem["response"]}
         n_passed += passed
 
         lang_passed.setdefault(lang, 0)
@@ -148,10 +221,13 @@ def evaluate_mbxp(results, n_workers):
         lang_counts[lang] += 1
 
     end = timeit.default_timer()
-    print(f"Processed {n_problems} in {end - start}s")
+    print(f"Processed {n_problems} ({n_problems - len(jobs)} cached) "
+          f"in {end - start}s")
     print(f"{100 * n_passed / n_problems : .02f}% pass@1")
     print(lang_passed, lang_counts)
     with open("evaluated_test.json", "w") as f:
         json.dump(passes, f, indent=2)
+    if cache_path is not None:
+        save_cache(cache_path, cache)
 
     return 100 * n_passed / n_problems
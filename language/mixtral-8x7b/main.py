@@ -84,12 +84,43 @@ def get_args():
         action="store_true",
         help="Enable log tracing. This file can become quite large",
     )
+    parser.add_argument(
+        "--accuracy-log-binary",
+        action="store_true",
+        help="Also write the accuracy log as raw bytes to mlperf_log_accuracy.bin",
+    )
     parser.add_argument(
         "--num-workers",
         type=int,
         default=1,
         help="Number of workers to process queries",
     )
+    parser.add_argument(
+        "--length-bucketing",
+        action="store_true",
+        help="Offline: batch samples of similar prompt and expected output "
+        "length and pad each batch only to its longest prompt",
+    )
+    parser.add_argument(
+        "--use-cached-outputs",
+        action="store_true",
+        help="(Offline) Serve samples already generated with the same model and "
+        "generation config from run_outputs/outputs.bin, e.g. to resume an "
+        "accuracy run that was killed",
+    )
+    parser.add_argument(
+        "--prefix-cache-gb",
+        type=float,
+        default=0,
+        help="With --continuous-batching: memory for the KV of shared prompt "
+        "prefixes in GB, 0 disables the prefix cache",
+    )
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Schedule generation per token step: finished sequences leave and "
+        "new ones join the running batch (up to --batch-size sequences)",
+    )
 
     args = parser.parse_args()
     return args
@@ -121,6 +152,7 @@ def main():
     log_output_settings = lg.LogOutputSettings()
     log_output_settings.outdir = args.output_log_dir
     log_output_settings.copy_summary_to_stdout = True
+    log_output_settings.accuracy_log_binary = args.accuracy_log_binary
     log_settings = lg.LogSettings()
     log_settings.log_output = log_output_settings
     log_settings.enable_trace = args.enable_log_trace
@@ -134,6 +166,10 @@ def main():
         dataset_path=args.dataset_path,
         total_sample_count=args.total_sample_count,
         device=args.device,
+        continuous_batching=args.continuous_batching,
+        length_bucketing=args.length_bucketing,
+        prefix_cache_gb=args.prefix_cache_gb,
+        use_cached_outputs=args.use_cached_outputs,
     )
 
     # Start sut before loadgen starts
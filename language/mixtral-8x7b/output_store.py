@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+# every record is a header followed by n_tokens int32 token ids
+_HEADER = struct.Struct("=8sqq")  # config key, sample index, n_tokens
+
+
+def config_key(config):
+    """Returns the 8 byte key of a run configuration (model, generation
+    arguments, ...), given as a json serializable dict"""
+    blob = json.dumps(config, sort_keys=True, default=str).encode()
+    return hashlib.sha1(blob).digest()[:8]
+
+
+def _scan(f):
+    """Yields (offset, key, index, n_tokens) of the complete records of an
+    opened log, stopping at a truncated record"""
+    size = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset + _HEADER.size <= size:
+        f.seek(offset)
+        key, index, n_tokens = _HEADER.unpack(f.read(_HEADER.size))
+        end = offset + _HEADER.size + 4 * n_tokens
+        if n_tokens < 0 or end > size:
+            break
+        yield offset, key, index, n_tokens
+        offset = end
+
+
+class OutputStore:
+    """Append-only log of the generated tokens of every sample.
+
+    Records are keyed by sample index and by the key of the run
+    configuration, so outputs of a different model or generation setup are
+    never served. The index is rebuilt from the record headers when the
+    store is opened; a record cut off by a crash is dropped and overwritten
+    by the next put().
+
+    The log holds one record per sample: put() keeps the stored output of a
+    sample (greedy outputs of a configuration do not change), and opening
+    the store with a new configuration compacts the log to the records of
+    that configuration, dropping the outputs of the previous one.
+
+    Args:
+        path: log file, created if missing
+        config (dict): run configuration, see config_key()
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.key = config_key(config)
+        self.lock = threading.Lock()
+        self.index = {}
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.f = open(path, "a+b")
+        end = 0
+        records = 0
+        for offset, key, index, n_tokens in _scan(self.f):
+            if key == self.key:
+                self.index[index] = (offset + _HEADER.size, n_tokens)
+            end = offset + _HEADER.size + 4 * n_tokens
+            records += 1
+        self.f.truncate(end)
+        if records > len(self.index):
+            self._compact()
+
+    def _compact(self):
+        """Rewrites the log with only the indexed records"""
+        tmp = self.path + ".tmp"
+        index = {}
+        with open(tmp, "wb") as out:
+            for i, (offset, n_tokens) in sorted(self.index.items()):
+                self.f.seek(offset)
+                data = self.f.read(4 * n_tokens)
+                out.write(_HEADER.pack(self.key, i, n_tokens))
+                index[i] = (out.tell(), n_tokens)
+                out.write(data)
+        self.f.close()
+        os.replace(tmp, self.path)
+        self.f = open(self.path, "a+b")
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, index):
+        return index in self.index
+
+    def get(self, index):
+        """Returns the int64 tokens stored for a sample, or None"""
+        with self.lock:
+            entry = self.index.get(index)
+            if entry is None:
+                return None
+            offset, n_tokens = entry
+            self.f.seek(offset)
+            data = self.f.read(4 * n_tokens)
+        return np.frombuffer(data, np.int32).astype(np.int64)
+
+    def put(self, index, tokens):
+        tokens = np.ascontiguousarray(tokens, np.int32)
+        with self.lock:
+            if index in self.index:
+                return
+            self.f.seek(0, os.SEEK_END)
+            offset = self.f.tell()
+            self.f.write(_HEADER.pack(self.key, index, len(tokens)))
+            self.f.write(tokens.tobytes())
+            self.f.flush()
+            self.index[index] = (offset + _HEADER.size, len(tokens))
+
+    def close(self):
+        self.f.close()
+
+
+def read_outputs(path, config=None):
+    """Reads the outputs of a store in one sequential pass and returns a dict
+    sample index -> int64 tokens. Without config, the store must hold the
+    outputs of a single configuration."""
+    by_key = {}
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            key, index, n_tokens = _HEADER.unpack(header)
+            data = f.read(4 * n_tokens)
+            if n_tokens < 0 or len(data) < 4 * n_tokens:
+                break
+            by_key.setdefault(key, {})[index] = np.frombuffer(
+                data, np.int32).astype(np.int64)
+    if config is not None:
+        return by_key.get(config_key(config), {})
+    if len(by_key) > 1:
+        raise ValueError(
+            "{} holds the outputs of {} run configurations, pass the config "
+            "of the run to read".format(path, len(by_key))
+        )
+    return next(iter(by_key.values()), {})
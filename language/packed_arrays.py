@@ -0,0 +1,108 @@
+"""Encoded samples of the language QSLs, kept as flat numpy arrays on disk.
+
+A QSL encodes its dataset once, saves the arrays with save_packed in a
+directory named by encoding_key, and later runs memory-map them with
+load_packed instead of tokenizing or unpickling again. PackedTokens and
+PackedMasks build the per-sample tensors when they are indexed.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+
+
+class PackedTokens:
+    """Token ids of all samples in one flat array plus offsets.
+
+    Indexing returns the [1, len] tensor of a sample in dtype, created when
+    it is needed, so there is no tensor per sample in memory.
+    """
+
+    def __init__(self, tokens, offsets, dtype=None, device="cpu"):
+        import torch
+
+        self.tokens = tokens
+        self.offsets = offsets
+        self.dtype = dtype or torch.int64
+        self.device = device
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        import torch
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+        ids = torch.from_numpy(np.array(self.tokens[start:end]))
+        return ids.view(1, -1).to(self.device, self.dtype)
+
+
+class PackedMasks:
+    """Attention masks of PackedTokens, all ones, built when indexed"""
+
+    def __init__(self, packed):
+        self.packed = packed
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, i):
+        import torch
+
+        n = int(self.packed.offsets[i + 1] - self.packed.offsets[i])
+        return torch.ones(
+            (1, n), dtype=self.packed.dtype, device=self.packed.device)
+
+
+def pack_tokens(token_lists):
+    """Returns the flat int32 token array and the int64 offsets"""
+    lens = np.fromiter((len(t) for t in token_lists), np.int64, len(token_lists))
+    offsets = np.zeros(len(lens) + 1, np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    tokens = np.fromiter(
+        itertools.chain.from_iterable(token_lists), np.int32, int(offsets[-1])
+    )
+    return tokens, offsets
+
+
+def encoding_key(paths, **config):
+    """Hash of the files the arrays are built from and of everything else
+    they depend on (tokenizer, max length, ...)"""
+    h = hashlib.sha1(json.dumps(config, sort_keys=True).encode())
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+
+def save_packed(packed_dir, arrays):
+    """Saves arrays (name -> numpy array) as .npy files in packed_dir and
+    removes the other arrays in it"""
+    try:
+        os.makedirs(packed_dir, exist_ok=True)
+        for name in os.listdir(packed_dir):
+            if name.endswith(".npy") and name[: -len(".npy")] not in arrays:
+                os.remove(os.path.join(packed_dir, name))
+        for name, array in arrays.items():
+            path = os.path.join(packed_dir, name + ".npy")
+            np.save(path + ".tmp.npy", array)
+            os.replace(path + ".tmp.npy", path)
+    except OSError as e:
+        print("Could not save encoded samples to {}: {}".format(packed_dir, e))
+
+
+def load_packed(packed_dir, required):
+    """Memory-maps all arrays saved by save_packed in packed_dir, or returns
+    None if one of the required arrays is missing"""
+    paths = {
+        name[: -len(".npy")]: os.path.join(packed_dir, name)
+        for name in (os.listdir(packed_dir) if os.path.isdir(packed_dir) else [])
+        if name.endswith(".npy") and not name.endswith(".tmp.npy")
+    }
+    if not set(required).issubset(paths):
+        return None
+    return {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
@@ -0,0 +1,75 @@
+"""Tests of the packed sample arrays shared by the language QSLs:
+
+    python -m pytest packed_arrays_test.py
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from packed_arrays import (
+    PackedMasks,
+    PackedTokens,
+    encoding_key,
+    load_packed,
+    pack_tokens,
+    save_packed,
+)
+
+
+class PackedArraysTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pack_tokens(self):
+        tokens, offsets = pack_tokens([[1, 2, 3], [], [4]])
+        self.assertEqual(tokens.dtype, np.int32)
+        self.assertEqual(tokens.tolist(), [1, 2, 3, 4])
+        self.assertEqual(offsets.tolist(), [0, 3, 3, 4])
+
+    def test_tensors(self):
+        tokens, offsets = pack_tokens([[1, 2, 3], [4]])
+        for dtype in (torch.int32, torch.int64):
+            ids = PackedTokens(tokens, offsets, dtype)
+            masks = PackedMasks(ids)
+            self.assertEqual(len(ids), 2)
+            self.assertEqual(ids[0].tolist(), [[1, 2, 3]])
+            self.assertEqual(ids[1].dtype, dtype)
+            self.assertEqual(masks[0].tolist(), [[1, 1, 1]])
+            self.assertEqual(masks[1].dtype, dtype)
+        self.assertEqual(PackedTokens(tokens, offsets)[0].dtype, torch.int64)
+
+    def test_save_and_load(self):
+        packed_dir = os.path.join(self.dir, "packed")
+        self.assertIsNone(load_packed(packed_dir, ["tokens"]))
+        save_packed(packed_dir, {"tokens": np.arange(4), "extra": np.ones(2)})
+        self.assertIsNone(load_packed(packed_dir, ["tokens", "offsets"]))
+        packed = load_packed(packed_dir, ["tokens"])
+        self.assertEqual(sorted(packed), ["extra", "tokens"])
+        self.assertEqual(packed["tokens"].tolist(), [0, 1, 2, 3])
+        # arrays that are not saved again are removed
+        save_packed(packed_dir, {"tokens": np.arange(2)})
+        self.assertEqual(sorted(load_packed(packed_dir, ["tokens"])),
+                         ["tokens"])
+
+    def test_encoding_key(self):
+        path = os.path.join(self.dir, "dataset.json")
+        with open(path, "w") as f:
+            f.write("a")
+        key = encoding_key([path], max_length=8)
+        self.assertEqual(key, encoding_key([path], max_length=8))
+        self.assertNotEqual(key, encoding_key([path], max_length=9))
+        with open(path, "w") as f:
+            f.write("b")
+        self.assertNotEqual(key, encoding_key([path], max_length=8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,9 @@
 import sys
 
-# Aliasing mlcommons_loadgen as mlperf_loadgen
-sys.modules['mlperf_loadgen'] = sys.modules[__name__]
+try:
+    # the bindings, so that importing a module of this package (e.g.
+    # accuracy_log) does not hide them
+    import mlperf_loadgen  # noqa: F401
+except ImportError:
+    # Aliasing mlcommons_loadgen as mlperf_loadgen
+    sys.modules['mlperf_loadgen'] = sys.modules[__name__]
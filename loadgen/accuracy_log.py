@@ -0,0 +1,194 @@
+# Copyright 2024 The MLPerf Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+
+# \file
+#  \brief Streaming reader for the LoadGen accuracy log.
+#  \details Reads the binary accuracy log written next to
+#  mlperf_log_accuracy.json when LogOutputSettings.accuracy_log_binary is set,
+#  and falls back to the json accuracy log otherwise, or when the binary log
+#  does not come from the same run as the json log. Either way entries are
+#  returned one at a time with the response already decoded to bytes, so
+#  callers never hold the whole log or its hex encoding in memory.
+#
+#  Usage:
+#      for entry in read_accuracy_log("mlperf_log_accuracy.json"):
+#          data = np.frombuffer(entry["data"], np.float32)
+
+import json
+import mmap
+import os
+import struct
+import sys
+import warnings
+
+BIN_MAGIC = b"MLPACC01"
+BIN_INDEX_MAGIC = b"MLPACIDX"
+_RECORD = struct.Struct("=QQqQQ")
+# record count, json log size, end time in ns since the epoch, magic
+_FOOTER = struct.Struct("=QQQ8s")
+
+
+def binary_path(json_path):
+    """Returns the path of the binary accuracy log that belongs to json_path."""
+    root, _ = os.path.splitext(json_path)
+    return root + ".bin"
+
+
+def read_accuracy_log(path, use_binary=True):
+    """Yields the entries of an accuracy log.
+
+    Each entry is a dict with seq_id, qsl_idx and data, plus token_count and
+    token_data when the run logged tokens. data and token_data are bytes-like
+    objects holding the raw response.
+
+    Args:
+        path: path to mlperf_log_accuracy.json or to the binary log.
+        use_binary: prefer the binary log next to path if it exists and was
+            written by the same run as the json log.
+    """
+    if path.endswith(".bin"):
+        return _read_binary(path)
+    bin_path = binary_path(path)
+    if use_binary and os.path.exists(bin_path):
+        mismatch = _check_same_run(bin_path, path)
+        if mismatch is None:
+            return _read_binary(bin_path)
+        warnings.warn(
+            "Ignoring {}: {}, reading {} instead".format(
+                bin_path, mismatch, path))
+    return _read_json(path)
+
+
+def load_accuracy_log(path, use_binary=True):
+    """Returns all entries of the accuracy log as a list."""
+    return list(read_accuracy_log(path, use_binary))
+
+
+def _read_binary(path):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        # the entries hand out views into the map, so it stays open until the
+        # last of them is released
+        buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if bytes(buf[:8]) != BIN_MAGIC:
+        raise ValueError("{} is not a binary accuracy log".format(path))
+    for offset in _binary_offsets(buf, size):
+        seq_id, qsl_idx, token_count, data_size, token_data_size = (
+            _RECORD.unpack_from(buf, offset)
+        )
+        start = offset + _RECORD.size
+        entry = {
+            "seq_id": seq_id,
+            "qsl_idx": qsl_idx,
+            "data": buf[start: start + data_size],
+        }
+        # -1 marks a run that did not log tokens
+        if token_count >= 0:
+            entry["token_count"] = token_count
+        if token_data_size:
+            start += data_size
+            entry["token_data"] = buf[start: start + token_data_size]
+        yield entry
+
+
+def _read_footer(f, size):
+    """Returns (record count, json size, end time in ns) of an opened binary
+    log, or None if it has no footer"""
+    if size < len(BIN_MAGIC) + _FOOTER.size:
+        return None
+    f.seek(size - _FOOTER.size)
+    count, json_size, end_time, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+    if magic != BIN_INDEX_MAGIC:
+        return None
+    return count, json_size, end_time
+
+
+def _check_same_run(bin_path, json_path):
+    """Returns None if the binary log was written by the same run as the json
+    log, otherwise the reason it was not"""
+    with open(bin_path, "rb") as f:
+        footer = _read_footer(f, os.fstat(f.fileno()).st_size)
+    if footer is None:
+        return "it has no index, the run did not finish"
+    _, json_size, _ = footer
+    if json_size != os.path.getsize(json_path):
+        return "it was written with a json log of {} bytes".format(json_size)
+    return None
+
+
+def _binary_offsets(buf, size):
+    """Returns the record offsets from the index, or scans for them when the
+    log has no index (the run did not finish)."""
+    if (size >= len(BIN_MAGIC) + _FOOTER.size
+            and bytes(buf[size - 8:]) == BIN_INDEX_MAGIC):
+        count, _, _, _ = _FOOTER.unpack_from(buf, size - _FOOTER.size)
+        return struct.unpack_from(
+            "={}Q".format(count), buf, size - _FOOTER.size - 8 * count)
+    return _scan_offsets(buf, size)
+
+
+def _scan_offsets(buf, size):
+    offset = len(BIN_MAGIC)
+    while offset + _RECORD.size <= size:
+        _, _, _, data_size, token_data_size = _RECORD.unpack_from(buf, offset)
+        end = offset + _RECORD.size + data_size + token_data_size
+        if end > size:
+            break
+        yield offset
+        offset = end
+
+
+def _decode(entry):
+    entry["data"] = bytes.fromhex(entry["data"])
+    if "token_data" in entry:
+        entry["token_data"] = bytes.fromhex(entry["token_data"])
+    return entry
+
+
+def _read_json(path):
+    # loadgen writes one entry per line, parse line by line so only one entry
+    # is decoded at a time. Anything else (e.g. a log rewritten by another
+    # tool) is parsed as a whole, skipping the entries already returned.
+    done = 0
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip().rstrip(",")
+            if line in ("", "[", "]"):
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = None
+            if not isinstance(entry, dict):
+                break
+            done += 1
+            yield _decode(entry)
+        else:
+            return
+    with open(path, "r") as f:
+        results = json.load(f)
+    for entry in results[done:]:
+        yield _decode(entry)
+
+
+if __name__ == "__main__":
+    # dump a binary log in the json format, for inspection
+    for n, e in enumerate(read_accuracy_log(sys.argv[1])):
+        e = {k: v.hex().upper() if isinstance(v, (bytes, memoryview)) else v
+             for k, v in e.items()}
+        print(("[\n" if n == 0 else ",\n") + json.dumps(e), end="")
+    print("\n]")
@@ -17,6 +17,7 @@ limitations under the License.
 #define PYTHON_BINDINGS_H
 
 #include <functional>
+#include <memory>
 
 #include "../loadgen.h"
 #include "../query_dispatch_library.h"
@@ -165,6 +166,38 @@ class QueryDispatchLibraryTrampoline : public QueryDispatchLibrary {
   NameCallback name_callback_;
 };
 
+// Read-only view of the memory of a C-contiguous buffer-protocol object
+// (numpy array, memoryview, bytes, ...). A torch CPU tensor is viewed through
+// numpy(), which shares its memory. The view holds a reference to the object
+// until it is destroyed, which must happen with the GIL held.
+class ResponseBuffer {
+ public:
+  explicit ResponseBuffer(pybind11::handle obj) {
+    pybind11::object exporter = pybind11::reinterpret_borrow<pybind11::object>(obj);
+    if (!PyObject_CheckBuffer(obj.ptr()) && pybind11::hasattr(obj, "numpy")) {
+      exporter = obj.attr("numpy")();
+    }
+    if (!PyObject_CheckBuffer(exporter.ptr())) {
+      throw pybind11::type_error(
+          "Response data must support the buffer protocol, got " +
+          std::string(pybind11::str(obj.get_type())));
+    }
+    if (PyObject_GetBuffer(exporter.ptr(), &view_, PyBUF_C_CONTIGUOUS) != 0) {
+      throw pybind11::error_already_set();
+    }
+  }
+  ~ResponseBuffer() { PyBuffer_Release(&view_); }
+
+  ResponseBuffer(const ResponseBuffer&) = delete;
+  ResponseBuffer& operator=(const ResponseBuffer&) = delete;
+
+  uintptr_t data() const { return reinterpret_cast<uintptr_t>(view_.buf); }
+  size_t size() const { return static_cast<size_t>(view_.len); }
+
+ private:
+  Py_buffer view_;
+};
+
 }  // namespace
 
 /// \brief Python bindings.
@@ -260,6 +293,33 @@ void QuerySamplesComplete(std::vector<QuerySampleResponse> responses,
   mlperf::QuerySamplesComplete(responses.data(), responses.size(), response_cb);
 }
 
+/// \brief Completes responses whose data are buffer-protocol objects,
+/// without copying them in Python. The buffers are only read during the call.
+void QuerySamplesCompleteBuffers(std::vector<ResponseId> ids,
+                                 pybind11::sequence buffers,
+                                 std::vector<int64_t> n_tokens = {},
+                                 ResponseCallback response_cb = {}) {
+  if (buffers.size() != ids.size() ||
+      (!n_tokens.empty() && n_tokens.size() != ids.size())) {
+    throw pybind11::value_error(
+        "ids, buffers and n_tokens must have the same length");
+  }
+  std::vector<std::unique_ptr<ResponseBuffer>> views;
+  std::vector<QuerySampleResponse> responses;
+  views.reserve(ids.size());
+  responses.reserve(ids.size());
+  for (size_t i = 0; i < ids.size(); i++) {
+    views.emplace_back(new ResponseBuffer(buffers[i]));
+    responses.emplace_back(ids[i], views.back()->data(), views.back()->size(),
+                           n_tokens.empty() ? 0 : n_tokens[i]);
+  }
+  {
+    pybind11::gil_scoped_release gil_releaser;
+    mlperf::QuerySamplesComplete(responses.data(), responses.size(),
+                                 response_cb);
+  }
+}
+
 void FirstTokenComplete(std::vector<QuerySampleResponse> responses,
                         ResponseCallback response_cb = {}) {
   pybind11::gil_scoped_release gil_releaser;
@@ -369,7 +429,9 @@ PYBIND11_MODULE(mlperf_loadgen, m) {
       .def_readwrite("copy_detail_to_stdout",
                      &LogOutputSettings::copy_detail_to_stdout)
       .def_readwrite("copy_summary_to_stdout",
-                     &LogOutputSettings::copy_summary_to_stdout);
+                     &LogOutputSettings::copy_summary_to_stdout)
+      .def_readwrite("accuracy_log_binary",
+                     &LogOutputSettings::accuracy_log_binary);
 
   pybind11::class_<LogSettings>(m, "LogSettings")
       .def(pybind11::init<>())
@@ -403,6 +465,16 @@ PYBIND11_MODULE(mlperf_loadgen, m) {
       .def(pybind11::init<>())
       .def(pybind11::init<ResponseId, uintptr_t, size_t>())
       .def(pybind11::init<ResponseId, uintptr_t, size_t, int64_t>())
+      // Points at the memory of a buffer-protocol object, which is kept alive
+      // as long as the response.
+      .def(pybind11::init([](ResponseId id, pybind11::object buffer,
+                             int64_t n_tokens) {
+             ResponseBuffer view(buffer);
+             return QuerySampleResponse(id, view.data(), view.size(),
+                                        n_tokens);
+           }),
+           pybind11::arg("id"), pybind11::arg("buffer"),
+           pybind11::arg("n_tokens") = 0, pybind11::keep_alive<1, 3>())
       .def_readwrite("id", &QuerySampleResponse::id)
       .def_readwrite("data", &QuerySampleResponse::data)
       .def_readwrite("size", &QuerySampleResponse::size)
@@ -470,6 +542,13 @@ PYBIND11_MODULE(mlperf_loadgen, m) {
         "IssueQuery calls have finished.",
         pybind11::arg("responses"),
         pybind11::arg("response_cb") = ResponseCallback{});
+  m.def("QuerySamplesCompleteBuffers", &py::QuerySamplesCompleteBuffers,
+        "Same as QuerySamplesComplete, for the parallel sequences of response "
+        "ids and buffer-protocol objects (numpy arrays, memoryviews, torch CPU "
+        "tensors) holding their data, read in place.",
+        pybind11::arg("ids"), pybind11::arg("buffers"),
+        pybind11::arg("n_tokens") = std::vector<int64_t>{},
+        pybind11::arg("response_cb") = ResponseCallback{});
   m.def("FirstTokenComplete", &py::FirstTokenComplete,
         "Called by the SUT to indicate that tokens from some combination of"
         "IssueQuery calls have finished.",
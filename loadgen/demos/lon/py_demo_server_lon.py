@@ -23,7 +23,6 @@ which is running the Network SUT demo based on a flask server, implemented in SU
 
 import threading
 import requests
-import array
 import time
 
 from absl import app
@@ -121,7 +120,7 @@ class QDL:
         Args:
             query_samples: A list of QuerySample objects.
         """
-        responses = []
+        results = []
         for s in query_samples:
             # Overall process:
             # QDL builds a real-world query and sends to SUT --> SUT processes --> SUT sends back to QDL
@@ -133,12 +132,10 @@ class QDL:
             # Send the query to SUT in round robin
             # Wait for a response
             sut_result = self.client_predict(features, s.index)
-            response_array = array.array("B", sut_result.encode("utf-8"))
-            bi = response_array.buffer_info()
-            responses.append(
-                mlperf_loadgen.QuerySampleResponse(
-                    s.id, bi[0], bi[1]))
-        mlperf_loadgen.QuerySamplesComplete(responses)
+            results.append(sut_result.encode("utf-8"))
+        # The responses point at the bytes objects, no copy is needed
+        mlperf_loadgen.QuerySamplesCompleteBuffers(
+            [s.id for s in query_samples], results)
 
     def get_sut_id_round_robin(self):
         """Get the SUT id in round robin."""
@@ -18,6 +18,7 @@ limitations under the License.
 #include <atomic>
 #include <cassert>
 #include <chrono>
+#include <cstdio>
 #include <cstring>
 #include <ctime>
 #include <fstream>
@@ -694,6 +695,15 @@ struct LogOutputs {
     summary_out.open(prefix + "summary" + suffix + ".txt");
     detail_out.open(prefix + "detail" + suffix + ".txt");
     accuracy_out.open(prefix + "accuracy" + suffix + ".json");
+    const std::string accuracy_bin_path = prefix + "accuracy" + suffix + ".bin";
+    if (output_settings.accuracy_log_binary) {
+      accuracy_bin_out.open(accuracy_bin_path,
+                            std::ios::out | std::ios::binary);
+    } else {
+      // A binary log left by an earlier run would not match the new json
+      // accuracy log, don't let readers pick it up.
+      std::remove(accuracy_bin_path.c_str());
+    }
     trace_out.open(prefix + "trace" + suffix + ".json");
   }
 
@@ -711,6 +721,10 @@ struct LogOutputs {
       all_ofstreams_good = false;
       std::cerr << "LoadGen: Failed to open accuracy log file.";
     }
+    if (accuracy_bin_out.is_open() && !accuracy_bin_out.good()) {
+      all_ofstreams_good = false;
+      std::cerr << "LoadGen: Failed to open binary accuracy log file.";
+    }
     if (!trace_out.good()) {
       all_ofstreams_good = false;
       std::cerr << "LoadGen: Failed to open trace file.";
@@ -721,6 +735,7 @@ struct LogOutputs {
   std::ofstream summary_out;
   std::ofstream detail_out;
   std::ofstream accuracy_out;
+  std::ofstream accuracy_bin_out;
   std::ofstream trace_out;
 };
 
@@ -1165,7 +1180,10 @@ void StartTest(SystemUnderTest* sut, QuerySampleLibrary* qsl,
   GlobalLogger().StartLogging(&log_outputs.summary_out, &log_outputs.detail_out,
                               &log_outputs.accuracy_out,
                               log_settings.log_output.copy_detail_to_stdout,
-                              log_settings.log_output.copy_summary_to_stdout);
+                              log_settings.log_output.copy_summary_to_stdout,
+                              log_settings.log_output.accuracy_log_binary
+                                  ? &log_outputs.accuracy_bin_out
+                                  : nullptr);
 
   GlobalLogger().SetUseTokens(requested_settings.use_token_latencies);
   bool needs_first_token =
@@ -212,7 +212,8 @@ void AsyncLog::SetCurrentPidTid(uint64_t pid, uint64_t tid) {
 void AsyncLog::SetLogFiles(std::ostream* summary, std::ostream* detail,
                            std::ostream* accuracy, bool copy_detail_to_stdout,
                            bool copy_summary_to_stdout,
-                           PerfClock::time_point log_origin) {
+                           PerfClock::time_point log_origin,
+                           std::ostream* accuracy_bin) {
   std::unique_lock<std::mutex> lock(log_mutex_);
   if (summary_out_ != &std::cerr) {
     std::string warning_summary;
@@ -253,6 +254,7 @@ void AsyncLog::SetLogFiles(std::ostream* summary, std::ostream* detail,
   summary_out_ = summary;
   detail_out_ = detail;
   accuracy_out_ = accuracy;
+  accuracy_bin_out_ = accuracy_bin;
   if (accuracy_out_ != &std::cerr) {
     WriteAccuracyHeaderLocked();
   }
@@ -300,6 +302,15 @@ void AsyncLog::LogAccuracy(uint64_t seq_id, const QuerySampleIndex qsl_idx,
 
   *accuracy_out_ << " }";
   accuracy_needs_comma_ = true;
+
+  if (accuracy_bin_out_) {
+    LogBinaryAsHexString token_data{nullptr};
+    if (use_tokens_ && needs_first_token_) {
+      token_data = token_records_[seq_id - latencies_first_sample_sequence_id_];
+    }
+    WriteAccuracyBinRecordLocked(seq_id, qsl_idx, response, token_data,
+                                 use_tokens_ ? n_tokens : -1);
+  }
 }
 
 void AsyncLog::CacheToken(uint64_t seq_id,
@@ -324,6 +335,9 @@ void AsyncLog::Flush() {
     if (accuracy_out_) {
       accuracy_out_->flush();
     }
+    if (accuracy_bin_out_) {
+      accuracy_bin_out_->flush();
+    }
   }
 
   {
@@ -334,12 +348,73 @@ void AsyncLog::Flush() {
   }
 }
 
+/// \details The binary accuracy log holds the same entries as the json
+/// accuracy log, without the hex encoding. All integers are 64-bit in the
+/// host byte order.
+///   header: "MLPACC01"
+///   record: seq_id, qsl_idx, token_count, data_size, token_data_size,
+///           data bytes, token_data bytes
+///           token_count is -1 if the run does not log tokens
+///   footer: the file offset of each record, the record count, the size of
+///           the json accuracy log, the wall clock time the footer was
+///           written in ns since the epoch, "MLPACIDX"
+/// A file without a footer (e.g. from a crashed run) can still be read
+/// sequentially. Readers use the json size to check that the binary log
+/// comes from the same run as the json log next to it; the time is only
+/// informative, since copies of the logs need not keep their mtimes.
 void AsyncLog::WriteAccuracyHeaderLocked() {
   *accuracy_out_ << "[";
   accuracy_needs_comma_ = false;
+  if (accuracy_bin_out_) {
+    accuracy_bin_pos_ = 0;
+    accuracy_bin_offsets_.clear();
+    WriteAccuracyBinBytesLocked("MLPACC01", 8);
+  }
 }
 
-void AsyncLog::WriteAccuracyFooterLocked() { *accuracy_out_ << "\n]\n"; }
+void AsyncLog::WriteAccuracyFooterLocked() {
+  *accuracy_out_ << "\n]\n";
+  if (accuracy_bin_out_) {
+    uint64_t count = accuracy_bin_offsets_.size();
+    std::streamoff json_pos = accuracy_out_->tellp();
+    uint64_t json_size = json_pos < 0 ? std::numeric_limits<uint64_t>::max()
+                                      : static_cast<uint64_t>(json_pos);
+    uint64_t end_time = std::chrono::duration_cast<std::chrono::nanoseconds>(
+                            std::chrono::system_clock::now().time_since_epoch())
+                            .count();
+    WriteAccuracyBinBytesLocked(accuracy_bin_offsets_.data(),
+                                count * sizeof(uint64_t));
+    WriteAccuracyBinBytesLocked(&count, sizeof(count));
+    WriteAccuracyBinBytesLocked(&json_size, sizeof(json_size));
+    WriteAccuracyBinBytesLocked(&end_time, sizeof(end_time));
+    WriteAccuracyBinBytesLocked("MLPACIDX", 8);
+    accuracy_bin_out_->flush();
+  }
+}
+
+void AsyncLog::WriteAccuracyBinRecordLocked(
+    uint64_t seq_id, const QuerySampleIndex qsl_idx,
+    const LogBinaryAsHexString& response,
+    const LogBinaryAsHexString& token_data, int64_t n_tokens) {
+  accuracy_bin_offsets_.push_back(accuracy_bin_pos_);
+  uint64_t data_size = response.data ? response.data->size() : 0;
+  uint64_t token_data_size = token_data.data ? token_data.data->size() : 0;
+  uint64_t fields[5] = {seq_id, static_cast<uint64_t>(qsl_idx),
+                        static_cast<uint64_t>(n_tokens), data_size,
+                        token_data_size};
+  WriteAccuracyBinBytesLocked(fields, sizeof(fields));
+  if (data_size) {
+    WriteAccuracyBinBytesLocked(response.data->data(), data_size);
+  }
+  if (token_data_size) {
+    WriteAccuracyBinBytesLocked(token_data.data->data(), token_data_size);
+  }
+}
+
+void AsyncLog::WriteAccuracyBinBytesLocked(const void* data, size_t size) {
+  accuracy_bin_out_->write(static_cast<const char*>(data), size);
+  accuracy_bin_pos_ += size;
+}
 
 void AsyncLog::RestartLatencyRecording(uint64_t first_sample_sequence_id,
                                        size_t latencies_to_reserve) {
@@ -845,9 +920,11 @@ void Logger::StopIOThread() {
 
 void Logger::StartLogging(std::ostream* summary, std::ostream* detail,
                           std::ostream* accuracy, bool copy_detail_to_stdout,
-                          bool copy_summary_to_stdout) {
+                          bool copy_summary_to_stdout,
+                          std::ostream* accuracy_bin) {
   async_logger_.SetLogFiles(summary, detail, accuracy, copy_detail_to_stdout,
-                            copy_summary_to_stdout, PerfClock::now());
+                            copy_summary_to_stdout, PerfClock::now(),
+                            accuracy_bin);
 }
 
 void Logger::StopLogging() {
@@ -205,7 +205,8 @@ class AsyncLog {
   void SetLogFiles(std::ostream* summary, std::ostream* detail,
                    std::ostream* accuracy, bool copy_detail_to_stdout,
                    bool copy_summary_to_stdout,
-                   PerfClock::time_point log_origin);
+                   PerfClock::time_point log_origin,
+                   std::ostream* accuracy_bin = nullptr);
   void StartNewTrace(std::ostream* trace_out, PerfClock::time_point origin);
   void StopTrace();
   void Flush();
@@ -318,6 +319,12 @@ class AsyncLog {
  private:
   void WriteAccuracyHeaderLocked();
   void WriteAccuracyFooterLocked();
+  void WriteAccuracyBinRecordLocked(uint64_t seq_id,
+                                    const QuerySampleIndex qsl_idx,
+                                    const LogBinaryAsHexString& response,
+                                    const LogBinaryAsHexString& token_data,
+                                    int64_t n_tokens);
+  void WriteAccuracyBinBytesLocked(const void* data, size_t size);
 
   void LogArgs(std::ostream*) {}
 
@@ -345,6 +352,10 @@ class AsyncLog {
   std::ostream* summary_out_ = &std::cerr;
   std::ostream* detail_out_ = &std::cerr;
   std::ostream* accuracy_out_ = &std::cerr;
+  // Optional binary sidecar of the accuracy log. See WriteAccuracyBin*.
+  std::ostream* accuracy_bin_out_ = nullptr;
+  uint64_t accuracy_bin_pos_ = 0;
+  std::vector<uint64_t> accuracy_bin_offsets_;
   // TODO: Instead of these bools, use a class that forwards to two streams.
   bool copy_detail_to_stdout_ = false;
   bool copy_summary_to_stdout_ = false;
@@ -397,7 +408,8 @@ class Logger {
 
   void StartLogging(std::ostream* summary, std::ostream* detail,
                     std::ostream* accuracy, bool copy_detail_to_stdout,
-                    bool copy_summary_to_stdout);
+                    bool copy_summary_to_stdout,
+                    std::ostream* accuracy_bin = nullptr);
   void StopLogging();
 
   void StartNewTrace(std::ostream* trace_out, PerfClock::time_point origin);
@@ -308,6 +308,9 @@ struct LogOutputSettings {
   bool prefix_with_datetime = false;
   bool copy_detail_to_stdout = false;
   bool copy_summary_to_stdout = false;
+  /// \brief Also write the accuracy log entries as raw bytes to
+  /// <prefix>accuracy<suffix>.bin. The json accuracy log is still written.
+  bool accuracy_log_binary = false;
 };
 
 ///
@@ -14,9 +14,13 @@ limitations under the License.
 /// \brief Basic functionality unit tests.
 
 #include <algorithm>
+#include <cstdint>
+#include <cstring>
 #include <deque>
+#include <fstream>
 #include <future>
 #include <iostream>
+#include <iterator>
 #include <queue>
 #include <unordered_set>
 #include <vector>
@@ -38,7 +42,7 @@ namespace unit_tests {
 /// the TestProxy concept.
 struct SystemUnderTestBasic : public mlperf::QuerySampleLibrary,
                               public mlperf::SystemUnderTest {
-  const std::string& Name() const override { return name_; }
+  const std::string& Name() override { return name_; }
 
   size_t TotalSampleCount() override { return total_sample_count_; }
   size_t PerformanceSampleCount() override { return performance_sample_count_; }
@@ -311,4 +315,108 @@ constexpr size_t TestMultiStreamContiguousRemainderQuery::kBadQslOffset =
 REGISTER_TEST(MultiStream_RemainderQueryContiguous,
               TestProxy<TestMultiStreamContiguousRemainderQuery>(),
               mlperf::TestScenario::MultiStream);
+
+/// \brief Verifies the binary accuracy log holds the responses of all
+/// samples, with a valid index, and that a later run without
+/// accuracy_log_binary removes it.
+/// \ingroup LoadgenTestsBasic
+struct TestAccuracyLogBinary : public SystemUnderTestAccuracy {
+  void SetUpTest(mlperf::TestScenario scenario) {
+    SystemUnderTestAccuracy::SetUpTest(4, 0, 0, scenario);
+    log_settings_.log_output.accuracy_log_binary = true;
+  }
+
+  static std::vector<uint64_t> Payload(mlperf::QuerySampleIndex index) {
+    return {index, index * 7 + 1};
+  }
+
+  void IssueQuery(const std::vector<mlperf::QuerySample>& samples) override {
+    std::vector<std::vector<uint64_t>> payloads;
+    std::vector<mlperf::QuerySampleResponse> responses;
+    payloads.reserve(samples.size());
+    responses.reserve(samples.size());
+    for (auto s : samples) {
+      issued_samples_.push_back(s.index);
+      payloads.push_back(Payload(s.index));
+      responses.push_back(
+          {s.id, reinterpret_cast<uintptr_t>(payloads.back().data()),
+           payloads.back().size() * sizeof(uint64_t)});
+    }
+    mlperf::QuerySamplesComplete(responses.data(), responses.size());
+  }
+
+  static uint64_t ReadU64(const std::string& buf, size_t offset) {
+    uint64_t v;
+    std::memcpy(&v, buf.data() + offset, sizeof(v));
+    return v;
+  }
+
+  void EndTest() override {
+    const std::string prefix = log_settings_.log_output.outdir + "/" +
+                               log_settings_.log_output.prefix + "accuracy" +
+                               log_settings_.log_output.suffix;
+    std::ifstream bin_in(prefix + ".bin", std::ios::binary);
+    FAIL_IF(!bin_in.good()) && FAIL_MSG("No binary accuracy log.") &&
+        ABORT_TEST;
+    std::string buf((std::istreambuf_iterator<char>(bin_in)),
+                    std::istreambuf_iterator<char>());
+    bin_in.close();
+
+    const size_t footer_size = 32;
+    FAIL_IF(buf.size() < 8 + footer_size) && FAIL_EXP(buf.size()) &&
+        ABORT_TEST;
+    FAIL_IF(buf.compare(0, 8, "MLPACC01") != 0) && FAIL_MSG("Bad header.");
+    FAIL_IF(buf.compare(buf.size() - 8, 8, "MLPACIDX") != 0) &&
+        FAIL_MSG("Bad footer.") && ABORT_TEST;
+
+    const size_t footer = buf.size() - footer_size;
+    const uint64_t count = ReadU64(buf, footer);
+    FAIL_IF(count != issued_samples_.size()) && FAIL_EXP(count) &&
+        FAIL_EXP(issued_samples_.size());
+
+    std::ifstream json_in(prefix + ".json", std::ios::binary | std::ios::ate);
+    const uint64_t json_size = ReadU64(buf, footer + 8);
+    FAIL_IF(json_size != static_cast<uint64_t>(json_in.tellg())) &&
+        FAIL_EXP(json_size) && FAIL_EXP(json_in.tellg());
+
+    FAIL_IF(8 * count > footer) && FAIL_EXP(count) && ABORT_TEST;
+    const size_t index = footer - 8 * count;
+    std::vector<mlperf::QuerySampleIndex> logged_samples;
+    for (size_t i = 0; i < count; i++) {
+      const size_t offset = ReadU64(buf, index + 8 * i);
+      FAIL_IF(offset + 40 > index) && FAIL_EXP(offset) && ABORT_TEST;
+      const auto qsl_idx =
+          static_cast<mlperf::QuerySampleIndex>(ReadU64(buf, offset + 8));
+      const uint64_t token_count = ReadU64(buf, offset + 16);
+      const uint64_t data_size = ReadU64(buf, offset + 24);
+      const uint64_t token_data_size = ReadU64(buf, offset + 32);
+      const std::vector<uint64_t> expected = Payload(qsl_idx);
+      FAIL_IF(data_size != expected.size() * sizeof(uint64_t)) &&
+          FAIL_EXP(data_size) && ABORT_TEST;
+      FAIL_IF(token_count != static_cast<uint64_t>(-1)) &&
+          FAIL_MSG("A run without tokens logged a token count.") &&
+          FAIL_EXP(token_count);
+      FAIL_IF(token_data_size != 0) && FAIL_EXP(token_data_size);
+      FAIL_IF(offset + 40 + data_size > index) && FAIL_EXP(offset) &&
+          ABORT_TEST;
+      FAIL_IF(std::memcmp(buf.data() + offset + 40, expected.data(),
+                          data_size) != 0) &&
+          FAIL_MSG("Wrong response data.") && FAIL_EXP(qsl_idx);
+      logged_samples.push_back(qsl_idx);
+    }
+    std::sort(logged_samples.begin(), logged_samples.end());
+    std::sort(issued_samples_.begin(), issued_samples_.end());
+    FAIL_IF(logged_samples != issued_samples_) &&
+        FAIL_MSG("The logged samples are not the issued samples.");
+
+    log_settings_.log_output.accuracy_log_binary = false;
+    mlperf::StartTest(this, this, test_settings_, log_settings_);
+    FAIL_IF(std::ifstream(prefix + ".bin").good()) &&
+        FAIL_MSG("A run without accuracy_log_binary kept the binary log.");
+  }
+};
+
+REGISTER_TEST(Offline_AccuracyLogBinary, TestProxy<TestAccuracyLogBinary>(),
+              mlperf::TestScenario::Offline);
+
 }  // namespace unit_tests
@@ -0,0 +1,117 @@
+# Copyright 2023 MLCommons. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+
+"""Binary payload of the /predict_binary/ endpoint of the network SUTs.
+
+A message carries a batch of samples. Every sample has the same named
+fields, each a flat array:
+
+    magic "LON1", number of samples, number of fields   (<4sII)
+    per field: name length (B), name, dtype code (c)
+    element count of every field of every sample        (<I, sample major)
+    raw little-endian data of every field of every sample
+
+decode() returns numpy views into the message, without copies.
+"""
+
+import struct
+
+import numpy as np
+
+CONTENT_TYPE = "application/x-lon-arrays"
+MAGIC = b"LON1"
+
+_HEADER = struct.Struct("<4sII")
+_DTYPES = {b"i": np.dtype("<i4"), b"q": np.dtype("<i8"), b"f": np.dtype("<f4")}
+_CODES = {dtype: code for code, dtype in _DTYPES.items()}
+
+
+def encode(samples, dtypes):
+    """Encodes samples (list of dict field name -> array-like) whose fields
+    are converted to dtypes (dict field name -> numpy dtype)"""
+    fields = [
+        (name, np.dtype(dtype).newbyteorder("<")) for name, dtype in dtypes.items()
+    ]
+    parts = [_HEADER.pack(MAGIC, len(samples), len(fields))]
+    for name, dtype in fields:
+        encoded = name.encode()
+        parts.append(struct.pack("<B", len(encoded)) + encoded + _CODES[dtype])
+
+    data = [
+        np.ascontiguousarray(sample[name], dtype)
+        for sample in samples
+        for name, dtype in fields
+    ]
+    parts.append(
+        struct.pack("<{}I".format(len(data)), *(a.size for a in data)))
+    parts.extend(a.tobytes() for a in data)
+    return b"".join(parts)
+
+
+def decode(buf):
+    """Returns the samples of a message as a list of dict field name ->
+    1-D numpy array"""
+    buf = memoryview(buf)
+    magic, n_samples, n_fields = _HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("not a LON binary message")
+    offset = _HEADER.size
+    fields = []
+    for _ in range(n_fields):
+        (length,) = struct.unpack_from("<B", buf, offset)
+        name = bytes(buf[offset + 1: offset + 1 + length]).decode()
+        offset += 1 + length
+        fields.append((name, _DTYPES[bytes(buf[offset: offset + 1])]))
+        offset += 1
+
+    counts = struct.unpack_from(
+        "<{}I".format(n_samples * n_fields), buf, offset)
+    offset += 4 * n_samples * n_fields
+
+    samples = []
+    counts = iter(counts)
+    for _ in range(n_samples):
+        sample = {}
+        for name, dtype in fields:
+            count = next(counts)
+            sample[name] = np.frombuffer(buf, dtype, count, offset)
+            offset += count * dtype.itemsize
+        samples.append(sample)
+    return samples
+
+
+def new_session(pool_size):
+    """Returns a requests session keeping up to pool_size connections per
+    SUT node alive between requests"""
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=16, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def post(session, url, samples, dtypes):
+    """Sends samples to a /predict_binary/ endpoint, returns the decoded
+    response samples"""
+    response = session.post(
+        url,
+        data=encode(samples, dtypes),
+        headers={"Content-Type": CONTENT_TYPE},
+    )
+    response.raise_for_status()
+    return decode(response.content)
@@ -0,0 +1,232 @@
+# Copyright 2023 MLCommons. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+
+"""Routes the requests of a QDL over several SUT nodes.
+
+The dispatcher runs an asyncio event loop in one background thread. For every
+node it tracks the number of requests and samples in flight and an
+exponentially weighted moving average (EWMA) of the latency per sample. A
+request goes to the node with a free slot whose queue is expected to finish
+first: (samples in flight + samples of the request) * EWMA latency. Nodes that
+have not answered yet have no EWMA and are tried first.
+
+A node whose request fails is drained: it gets no new requests for a backoff
+time, doubled on every consecutive failure, and the request is retried on
+another node. After the backoff the node is probed with new requests again,
+and its first success resets the backoff. A request that fails on every
+attempt is reported to the on_failure callback given to submit.
+
+The blocking HTTP calls run in a thread pool sized to the total number of
+slots, so the requests session and its pooled connections are reused.
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("LON-Dispatcher")
+
+
+class Node:
+    """Load and health of one SUT node, only touched in the event loop"""
+
+    def __init__(self, addr, max_outstanding):
+        self.addr = addr
+        self.max_outstanding = max_outstanding
+        self.outstanding = 0
+        self.outstanding_samples = 0
+        self.ewma = None
+        self.failures = 0
+        self.down_until = 0.0
+        self.completed = 0
+        self.errors = 0
+
+    def is_up(self, now):
+        return now >= self.down_until
+
+    def has_slot(self, now):
+        return self.is_up(now) and self.outstanding < self.max_outstanding
+
+    def expected_finish(self, size):
+        return (self.outstanding_samples + size) * (self.ewma or 0.0)
+
+
+class Dispatcher:
+    """Sends requests to the least loaded healthy SUT node.
+
+    Args:
+        sut_server_addr: list of the addresses of the SUT nodes.
+        max_outstanding: maximum number of requests in flight per node.
+        alpha: weight of the newest latency in the EWMA.
+        max_retries: number of times a failed request is retried on another
+            node before its future gets the exception.
+        backoff: seconds a node is drained after its first failure.
+        max_backoff: upper bound of the drain time.
+    """
+
+    def __init__(
+        self,
+        sut_server_addr,
+        max_outstanding=4,
+        alpha=0.2,
+        max_retries=3,
+        backoff=1.0,
+        max_backoff=30.0,
+    ):
+        self.nodes = [Node(addr, max_outstanding) for addr in sut_server_addr]
+        self.alpha = alpha
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.executor = ThreadPoolExecutor(max_outstanding * len(self.nodes))
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop, daemon=True)
+        self.thread.start()
+        # created inside the loop, asyncio primitives are bound to it
+        self.changed = asyncio.run_coroutine_threadsafe(
+            self.new_condition(), self.loop
+        ).result()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def new_condition(self):
+        return asyncio.Condition()
+
+    def submit(self, send, *args, size=1, on_failure=None):
+        """Calls send(sut_addr, *args) on a node picked by the dispatcher.
+        Thread safe and non-blocking; returns a concurrent.futures.Future of
+        the result of send. size is the number of samples of the request.
+        If it fails on every attempt, on_failure(exception) is called, e.g.
+        to complete its samples so that loadgen does not wait for them."""
+        future = asyncio.run_coroutine_threadsafe(
+            self.dispatch(send, args, size), self.loop
+        )
+        future.add_done_callback(
+            functools.partial(self.report_failure, on_failure))
+        return future
+
+    def report_failure(self, on_failure, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        log.error("Request failed on every attempt: %r", future.exception())
+        if on_failure is not None:
+            try:
+                on_failure(future.exception())
+            except Exception:
+                log.exception("on_failure callback failed")
+
+    def pick_node(self, size, exclude):
+        """Returns the node with a free slot expected to finish size samples
+        first, or None if every node is busy or drained"""
+        now = time.monotonic()
+        candidates = [
+            node for node in self.nodes if node.has_slot(now) and node not in exclude
+        ]
+        if not candidates and exclude:
+            # every other node is busy or down, the failed one may do
+            candidates = [node for node in self.nodes if node.has_slot(now)]
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda node: (node.expected_finish(size), node.outstanding),
+        )
+
+    def next_recovery(self):
+        """Seconds until the next drained node may be probed, or None"""
+        now = time.monotonic()
+        waits = [node.down_until - now for node in self.nodes if not node.is_up(now)]
+        return max(min(waits), 0.0) if waits else None
+
+    async def acquire(self, size, exclude):
+        async with self.changed:
+            while True:
+                node = self.pick_node(size, exclude)
+                if node is not None:
+                    node.outstanding += 1
+                    node.outstanding_samples += size
+                    return node
+                try:
+                    await asyncio.wait_for(
+                        self.changed.wait(), timeout=self.next_recovery()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, node, size, latency=None):
+        async with self.changed:
+            node.outstanding -= 1
+            node.outstanding_samples -= size
+            if latency is None:
+                node.errors += 1
+                node.failures += 1
+                drain = min(
+                    self.backoff * 2 ** (node.failures - 1), self.max_backoff)
+                node.down_until = time.monotonic() + drain
+                log.warning(
+                    "SUT node %s failed, draining it for %.1f s", node.addr, drain
+                )
+            else:
+                per_sample = latency / size
+                if node.ewma is None:
+                    node.ewma = per_sample
+                else:
+                    node.ewma += self.alpha * (per_sample - node.ewma)
+                node.failures = 0
+                node.completed += 1
+            self.changed.notify_all()
+
+    async def dispatch(self, send, args, size):
+        failed = set()
+        for attempt in range(self.max_retries + 1):
+            node = await self.acquire(size, failed)
+            start = time.monotonic()
+            try:
+                result = await self.loop.run_in_executor(
+                    self.executor, send, node.addr, *args
+                )
+            except Exception as e:
+                await self.release(node, size)
+                failed.add(node)
+                if attempt == self.max_retries:
+                    raise
+                log.warning("Retrying request failed on %s: %r", node.addr, e)
+                continue
+            await self.release(node, size, time.monotonic() - start)
+            return result
+
+    def stats(self):
+        """Returns the per node counters, for logging"""
+        return [
+            {
+                "addr": node.addr,
+                "completed": node.completed,
+                "errors": node.errors,
+                "ewma_latency_per_sample": node.ewma,
+            }
+            for node in self.nodes
+        ]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
@@ -13,18 +13,27 @@
 # limitations under the License.
 # =============================================================================
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from werkzeug.serving import WSGIRequestHandler
 import argparse
 import array
 import json
 import os
 import sys
 
+import numpy as np
+
+import binary_protocol
+
 sys.path.insert(0, os.getcwd())
 
 
 app = Flask(__name__)
 
+# HTTP/1.1 keeps the connections of the pooled LON clients open between
+# requests
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+
 
 node = ""
 
@@ -65,6 +74,22 @@ def predict():
     return jsonify(result=result)
 
 
+@app.route("/predict_binary/", methods=["POST"])
+def predict_binary():
+    """Runs a batch of samples sent in the binary format of
+    binary_protocol.py, returns their float32 outputs in the same format."""
+    queries = binary_protocol.decode(bytearray(request.get_data()))
+    results = [
+        {"output": np.asarray(
+            postprocess(dnn_model(preprocess(query))), np.float32).ravel()}
+        for query in queries
+    ]
+    return Response(
+        binary_protocol.encode(results, {"output": np.float32}),
+        mimetype=binary_protocol.CONTENT_TYPE,
+    )
+
+
 @app.route("/getname/", methods=["POST", "GET"])
 def getname():
     """Returns the name of the SUT."""
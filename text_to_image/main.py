@@ -154,6 +154,11 @@ def get_args():
     parser.add_argument("--time", type=int, help="time to scan in seconds")
     parser.add_argument("--count", type=int, help="dataset items to use")
     parser.add_argument("--debug", action="store_true", help="debug")
+    parser.add_argument(
+        "--accuracy-log-binary",
+        action="store_true",
+        help="also write the accuracy log as raw bytes, much faster to read than the hex json",
+    )
     parser.add_argument(
         "--performance-sample-count",
         type=int,
@@ -436,6 +441,7 @@ def main():
     log_output_settings = lg.LogOutputSettings()
     log_output_settings.outdir = output_dir
     log_output_settings.copy_summary_to_stdout = False
+    log_output_settings.accuracy_log_binary = args.accuracy_log_binary
     log_settings = lg.LogSettings()
     log_settings.enable_trace = args.debug
     log_settings.log_output = log_output_settings
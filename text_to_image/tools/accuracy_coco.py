@@ -21,7 +21,8 @@ from fid.fid_score import (
     calculate_frechet_distance,
 )
 from tqdm import tqdm
-import ijson
+
+from mlcommons_loadgen.accuracy_log import read_accuracy_log
 
 
 def get_args():
@@ -162,8 +163,7 @@ def compute_accuracy(
     result_dict = {}
 
     # Load model outputs
-    with open(mlperf_accuracy_file, "r") as f:
-        results = json.load(f)
+    results = read_accuracy_log(mlperf_accuracy_file)
 
     for j in tqdm(results):
         idx = j["qsl_idx"]
@@ -172,7 +172,7 @@ def compute_accuracy(
         seen.add(idx)
 
         # Load generated image
-        generated_img = np.frombuffer(bytes.fromhex(j["data"]), np.uint8).reshape(
+        generated_img = np.frombuffer(j["data"], np.uint8).reshape(
             1024, 1024, 3
         )
         result_list.append(generated_img)
@@ -241,59 +241,58 @@ def compute_accuracy_low_memory(
     activations = np.empty((0, inception_dims))
 
     # Load model outputs
-    with open(mlperf_accuracy_file, "r") as f:
-        results = ijson.items(f, "item")
-
-        for j in tqdm(results):
-            idx = j["qsl_idx"]
-            if idx in seen:
-                continue
-            seen.add(idx)
-
-            # Load generated image
-            generated_img = np.frombuffer(bytes.fromhex(j["data"]), np.uint8).reshape(
-                1024, 1024, 3
-            )
-            generated_img = Image.fromarray(generated_img)
-
-            # Dump compliance images
-            if dump_compliance_images and idx in compliance_images_idx_list:
-                generated_img.save(
-                    os.path.join(
-                        compliance_images_path,
-                        f"{idx}.png"))
-
-            # Load Ground Truth
-            caption = df_captions.iloc[idx]["caption"]
-            clip_scores.append(
-                100 * clip_model.get_clip_score(caption, generated_img).item()
-            )
+    results = read_accuracy_log(mlperf_accuracy_file)
 
-            result_batch.append(generated_img.convert("RGB"))
-
-            if len(result_batch) == batch_size:
-                act = get_activations(
-                    result_batch,
-                    inception_model,
-                    batch_size,
-                    inception_dims,
-                    device,
-                    num_workers,
-                )
-                activations = np.append(activations, act, axis=0)
-                result_batch.clear()
-
-        # Remaining data for last batch
-        if len(result_batch) > 0:
+    for j in tqdm(results):
+        idx = j["qsl_idx"]
+        if idx in seen:
+            continue
+        seen.add(idx)
+
+        # Load generated image
+        generated_img = np.frombuffer(j["data"], np.uint8).reshape(
+            1024, 1024, 3
+        )
+        generated_img = Image.fromarray(generated_img)
+
+        # Dump compliance images
+        if dump_compliance_images and idx in compliance_images_idx_list:
+            generated_img.save(
+                os.path.join(
+                    compliance_images_path,
+                    f"{idx}.png"))
+
+        # Load Ground Truth
+        caption = df_captions.iloc[idx]["caption"]
+        clip_scores.append(
+            100 * clip_model.get_clip_score(caption, generated_img).item()
+        )
+
+        result_batch.append(generated_img.convert("RGB"))
+
+        if len(result_batch) == batch_size:
             act = get_activations(
                 result_batch,
                 inception_model,
-                len(result_batch),
+                batch_size,
                 inception_dims,
                 device,
                 num_workers,
             )
             activations = np.append(activations, act, axis=0)
+            result_batch.clear()
+
+    # Remaining data for last batch
+    if len(result_batch) > 0:
+        act = get_activations(
+            result_batch,
+            inception_model,
+            len(result_batch),
+            inception_dims,
+            device,
+            num_workers,
+        )
+        activations = np.append(activations, act, axis=0)
 
     m1, s1 = compute_statistics_of_path(
         statistics_path,
@@ -0,0 +1,160 @@
+"""
+multi-instance backend: runs N replicas of any backend, each in its own process
+pinned to a disjoint set of cores with a matching intra-op thread count
+"""
+
+# pylint: disable=unused-argument,missing-docstring
+
+import concurrent.futures
+import contextlib
+import importlib
+import multiprocessing
+import os
+import threading
+
+import backend
+import dataset
+
+global_backend = None
+
+# read by the runtimes and their BLAS/OpenMP libraries when they start
+THREAD_ENV = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "TF_INTRA_OP_PARALLELISM_THREADS",
+    "ORT_INTRA_OP_NUM_THREADS",
+]
+
+
+def _cpu_list():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def split_cores(cores, instances):
+    """Split cores into instances disjoint, contiguous sets of (almost) equal size."""
+    if instances > len(cores):
+        raise ValueError(
+            "{} instances requested but only {} cores available".format(
+                instances, len(cores)
+            )
+        )
+    size, extra = divmod(len(cores), instances)
+    sets = []
+    start = 0
+    for i in range(instances):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+@contextlib.contextmanager
+def _thread_env(threads):
+    """Sets the thread count variables in os.environ for the processes
+    started meanwhile, restores them afterwards"""
+    saved = {env: os.environ.get(env) for env in THREAD_ENV}
+    os.environ.update({env: str(threads) for env in THREAD_ENV})
+    try:
+        yield
+    finally:
+        for env, value in saved.items():
+            if value is None:
+                os.environ.pop(env, None)
+            else:
+                os.environ[env] = value
+
+
+def _worker_initializer(module_name, class_name, model_path,
+                        inputs, outputs, kwargs, cores):
+    # the thread counts are already in the environment the process started
+    # with (see load): a spawned process imports this module, numpy and the
+    # modules of its parent's __main__ before the initializer runs
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    global global_backend
+    cls = getattr(importlib.import_module(module_name), class_name)
+    global_backend = cls()
+    global_backend.load(model_path, inputs=inputs, outputs=outputs, **kwargs)
+
+
+def _worker_io():
+    return global_backend.inputs, global_backend.outputs
+
+
+def _worker_handler(feed):
+    feed = {
+        k: v.resolve() if isinstance(v, dataset.SharedSamples) else v
+        for k, v in feed.items()
+    }
+    return global_backend.predict(feed)
+
+
+class BackendMultiInstance(backend.Backend):
+    # feeds may hold dataset.SharedSamples, the replicas read those batches
+    # from the shared memory arena instead of getting them pickled
+    resolves_shared_samples = True
+
+    def __init__(self, wrapped, instances, cores=None):
+        super(BackendMultiInstance, self).__init__()
+        self.wrapped = wrapped
+        self.instances = instances
+        self.cores = cores if cores else _cpu_list()
+        self.pools = []
+        self.outstanding = []
+        self.lock = threading.Lock()
+
+    def version(self):
+        return self.wrapped.version()
+
+    def name(self):
+        return self.wrapped.name()
+
+    def image_format(self):
+        return self.wrapped.image_format()
+
+    def load(self, model_path, inputs=None, outputs=None, **kwargs):
+        # spawn, so the runtime is imported fresh in each replica, in a
+        # process started with its thread counts in the environment
+        ctx = multiprocessing.get_context("spawn")
+        module_name = type(self.wrapped).__module__
+        class_name = type(self.wrapped).__name__
+        ready = []
+        for cores in split_cores(self.cores, self.instances):
+            with _thread_env(len(cores)):
+                pool = concurrent.futures.ProcessPoolExecutor(
+                    1,
+                    mp_context=ctx,
+                    initializer=_worker_initializer,
+                    initargs=(
+                        module_name,
+                        class_name,
+                        model_path,
+                        inputs,
+                        outputs,
+                        kwargs,
+                        cores,
+                    ),
+                )
+                # a spawn pool starts its process in the first submit
+                ready.append(pool.submit(_worker_io))
+            self.pools.append(pool)
+            self.outstanding.append(0)
+        # all replicas load the same model, take the io names of the first
+        self.inputs, self.outputs = ready[0].result()
+        for f in ready[1:]:
+            f.result()
+        return self
+
+    def predict(self, feed):
+        """Run the prediction on the replica with the fewest outstanding batches."""
+        with self.lock:
+            idx = min(range(self.instances),
+                      key=self.outstanding.__getitem__)
+            self.outstanding[idx] += 1
+        try:
+            return self.pools[idx].submit(_worker_handler, feed).result()
+        finally:
+            with self.lock:
+                self.outstanding[idx] -= 1
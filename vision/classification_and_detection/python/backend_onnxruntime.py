@@ -34,6 +34,9 @@ class BackendOnnxruntime(backend.Backend):
         # issue
         if os.environ.get("HOST_PLATFORM_FLAVOR", "") == "aarch64":
             opt.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        if "ORT_INTRA_OP_NUM_THREADS" in os.environ:
+            opt.intra_op_num_threads = int(
+                os.environ["ORT_INTRA_OP_NUM_THREADS"])
 
         # self.sess = rt.InferenceSession(model_path, opt)
         if len(rt.get_all_providers()) > 1 and os.environ.get(
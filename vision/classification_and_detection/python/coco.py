@@ -9,7 +9,6 @@ import logging
 import os
 import time
 
-import cv2
 import numpy as np
 from pycocotools.cocoeval import COCOeval
 import pycoco
@@ -69,6 +68,11 @@ class Coco(dataset.Dataset):
 
         os.makedirs(self.cache_dir, exist_ok=True)
         start = time.time()
+        cache = None
+        if pre_process:
+            cache = dataset.PreprocessCache(
+                self.cache_dir, pre_process, self.image_size, self.need_transpose
+            )
         images = {}
         with open(image_list, "r") as f:
             coco = json.load(f)
@@ -106,17 +110,8 @@ class Coco(dataset.Dataset):
                 )
                 continue
 
-            os.makedirs(
-                os.path.dirname(os.path.join(self.cache_dir, image_name)), exist_ok=True
-            )
-            dst = os.path.join(self.cache_dir, image_name)
-            if not os.path.exists(dst + ".npy"):
-                # cache a preprocessed version of the image
-                img_org = cv2.imread(src)
-                processed = self.pre_process(
-                    img_org, need_transpose=self.need_transpose, dims=self.image_size
-                )
-                np.save(dst, processed)
+            if cache:
+                self.cache_keys.append(cache.add(image_name, src))
 
             self.image_ids.append(image_id)
             self.image_list.append(image_name)
@@ -127,6 +122,13 @@ class Coco(dataset.Dataset):
             if self.count and len(self.image_list) >= self.count:
                 break
 
+        if cache and cache.jobs:
+            log.info(
+                "Preprocessing {} images using {} processes".format(
+                    len(cache.jobs), min(threads, len(cache.jobs))
+                )
+            )
+            cache.run(threads)
         time_taken = time.time() - start
         if not self.image_list:
             log.error("no images in image list found")
@@ -183,35 +185,28 @@ class PostProcessCoco:
         # results come as:
         # tensorflow, ssd-mobilenet:
         # num_detections,detection_boxes,detection_scores,detection_classes
-        processed_results = []
+        detections = []
         # batch size
         bs = len(results[0])
         for idx in range(0, bs):
-            # keep the content_id from loadgen to handle content_id's without
-            # results
-            self.content_ids.append(ids[idx])
-            processed_results.append([])
             detection_num = int(results[0][idx])
-            detection_boxes = results[1][idx]
-            detection_classes = results[3][idx]
-            expected_classes = expected[idx][0]
-            for detection in range(0, detection_num):
-                detection_class = int(detection_classes[detection])
-                if detection_class in expected_classes:
-                    self.good += 1
-                box = detection_boxes[detection]
-                processed_results[idx].append(
-                    [
-                        float(ids[idx]),
-                        box[0],
-                        box[1],
-                        box[2],
-                        box[3],
-                        results[2][idx][detection],
-                        float(detection_class),
-                    ]
+            detections.append(
+                (
+                    results[1][idx][:detection_num],
+                    results[2][idx][:detection_num],
+                    results[3][idx][:detection_num],
                 )
-                self.total += 1
+            )
+        return self.pack(ids, expected, detections)
+
+    def pack(self, ids, expected, detections):
+        # keep the content_id from loadgen to handle content_id's without
+        # results
+        self.content_ids.extend(ids[: len(detections)])
+        processed_results, good = dataset.pack_detections(
+            ids, expected, detections)
+        self.good += good
+        self.total += sum(len(r) for r in processed_results)
         return processed_results
 
     def start(self):
@@ -223,6 +218,7 @@ class PostProcessCoco:
         result_dict["good"] += self.good
         result_dict["total"] += self.total
 
+        inv_map = None
         if self.use_inv_map:
             # for pytorch
             label_map = {}
@@ -232,51 +228,15 @@ class PostProcessCoco:
                 label_map[cat["id"]] = cnt + 1
             inv_map = {v: k for k, v in label_map.items()}
 
-        detections = []
-        image_indices = []
-        for batch in range(0, len(self.results)):
-            image_indices.append(self.content_ids[batch])
-            for idx in range(0, len(self.results[batch])):
-                detection = self.results[batch][idx]
-                # this is the index of the coco image
-                image_idx = int(detection[0])
-                if image_idx != self.content_ids[batch]:
-                    # working with the coco index/id is error prone - extra
-                    # check to make sure it is consistent
-                    log.error(
-                        "image_idx missmatch, lg={} / result={}".format(
-                            image_idx, self.content_ids[batch]
-                        )
-                    )
-                # map the index to the coco image id
-                detection[0] = ds.image_ids[image_idx]
-                height, width = ds.image_sizes[image_idx]
-                # box comes from model as: ymin, xmin, ymax, xmax
-                ymin = detection[1] * height
-                xmin = detection[2] * width
-                ymax = detection[3] * height
-                xmax = detection[4] * width
-                # pycoco wants {imageID,x1,y1,w,h,score,class}
-                detection[1] = xmin
-                detection[2] = ymin
-                detection[3] = xmax - xmin
-                detection[4] = ymax - ymin
-                if self.use_inv_map:
-                    cat_id = inv_map.get(int(detection[6]), -1)
-                    if cat_id == -1:
-                        # FIXME:
-                        log.info(
-                            "finalize can't map category {}".format(
-                                int(detection[6]))
-                        )
-                    detection[6] = cat_id
-                detections.append(np.array(detection))
+        detections = dataset.coco_detections(
+            self.results, self.content_ids, ds, inv_map)
 
         # map indices to coco image id's
-        image_ids = [ds.image_ids[i] for i in image_indices]
+        image_ids = [ds.image_ids[i]
+                     for i in self.content_ids[: len(self.results)]]
         self.results = []
         cocoGt = pycoco.COCO(ds.annotation_file)
-        cocoDt = cocoGt.loadRes(np.array(detections))
+        cocoDt = cocoGt.loadRes(detections)
         cocoEval = COCOeval(cocoGt, cocoDt, iouType="bbox")
         cocoEval.params.imgIds = image_ids
         cocoEval.evaluate()
@@ -298,39 +258,11 @@ class PostProcessCocoPt(PostProcessCoco):
     def __call__(self, results, ids, expected=None, result_dict=None):
         # results come as:
         #   detection_boxes,detection_classes,detection_scores
-
-        processed_results = []
-        # batch size
-        bs = len(results[0])
-        for idx in range(0, bs):
-            self.content_ids.append(ids[idx])
-            processed_results.append([])
-            detection_boxes = results[0][idx]
-            detection_classes = results[1][idx]
-            expected_classes = expected[idx][0]
-            scores = results[2][idx]
-            # for detection in range(0, len(expected_classes)):
-            for detection in range(0, len(scores)):
-                if scores[detection] < self.score_threshold:
-                    break
-                detection_class = int(detection_classes[detection])
-                if detection_class in expected_classes:
-                    self.good += 1
-                box = detection_boxes[detection]
-                # comes from model as:  0=xmax 1=ymax 2=xmin 3=ymin
-                processed_results[idx].append(
-                    [
-                        float(ids[idx]),
-                        box[1],
-                        box[0],
-                        box[3],
-                        box[2],
-                        scores[detection],
-                        float(detection_class),
-                    ]
-                )
-                self.total += 1
-        return processed_results
+        return self.pack(
+            ids,
+            expected,
+            threshold_detections(results, self.score_threshold, [1, 0, 3, 2]),
+        )
 
 
 class PostProcessCocoOnnx(PostProcessCoco):
@@ -345,39 +277,9 @@ class PostProcessCocoOnnx(PostProcessCoco):
         # results come as:
         # onnx (from pytorch ssd-resnet34):
         # detection_boxes,detection_classes,detection_scores
-
-        processed_results = []
-
-        # batch size
-        bs = len(results[0])
-        for idx in range(0, bs):
-            self.content_ids.append(ids[idx])
-            processed_results.append([])
-            detection_boxes = results[0][idx]
-            detection_classes = results[1][idx]
-            expected_classes = expected[idx][0]
-            scores = results[2][idx]
-            for detection in range(0, len(scores)):
-                if scores[detection] < 0.5:
-                    break
-                detection_class = int(detection_classes[detection])
-                if detection_class in expected_classes:
-                    self.good += 1
-                box = detection_boxes[detection]
-                # comes from model as:  0=xmax 1=ymax 2=xmin 3=ymin
-                processed_results[idx].append(
-                    [
-                        float(ids[idx]),
-                        box[1],
-                        box[0],
-                        box[3],
-                        box[2],
-                        scores[detection],
-                        float(detection_class),
-                    ]
-                )
-                self.total += 1
-        return processed_results
+        return self.pack(
+            ids, expected, threshold_detections(results, 0.5, [1, 0, 3, 2])
+        )
 
 
 class PostProcessCocoTf(PostProcessCoco):
@@ -392,35 +294,22 @@ class PostProcessCocoTf(PostProcessCoco):
     def __call__(self, results, ids, expected=None, result_dict=None):
         # results come as:
         #   detection_boxes,detection_classes,detection_scores
+        return self.pack(
+            ids, expected, threshold_detections(results, 0.05, [0, 1, 2, 3])
+        )
 
-        processed_results = []
-        # batch size
-        bs = len(results[0])
-        for idx in range(0, bs):
-            self.content_ids.append(ids[idx])
-            processed_results.append([])
-            detection_boxes = results[0][idx]
-            detection_classes = results[1][idx]
-            expected_classes = expected[idx][0]
-            scores = results[2][idx]
-            for detection in range(0, len(scores)):
-                if scores[detection] < 0.05:
-                    break
-                detection_class = int(detection_classes[detection])
-                if detection_class in expected_classes:
-                    self.good += 1
-                box = detection_boxes[detection]
-                # comes from model as:  0=xmax 1=ymax 2=xmin 3=ymin
-                processed_results[idx].append(
-                    [
-                        float(ids[idx]),
-                        box[0],
-                        box[1],
-                        box[2],
-                        box[3],
-                        scores[detection],
-                        float(detection_class),
-                    ]
-                )
-                self.total += 1
-        return processed_results
+
+def threshold_detections(results, score_threshold, box_order):
+    """
+    Per image (boxes, scores, classes) of the leading detections scoring at
+    least score_threshold, boxes reordered to ymin, xmin, ymax, xmax.
+    """
+    detections = []
+    # batch size
+    bs = len(results[0])
+    for idx in range(0, bs):
+        scores = np.asarray(results[2][idx])
+        n = dataset.count_above(scores, score_threshold)
+        boxes = np.asarray(results[0][idx])[:n][:, box_order]
+        detections.append((boxes, scores[:n], np.asarray(results[1][idx])[:n]))
+    return detections
@@ -4,9 +4,16 @@ dataset related classes and methods
 
 # pylint: disable=unused-argument,missing-docstring
 
+import concurrent.futures
+import functools
+import hashlib
+import inspect
+import json
 import logging
+import os
 import sys
 import time
+from multiprocessing import shared_memory
 
 import cv2
 import numpy as np
@@ -50,6 +57,12 @@ class Dataset:
         self.label_list = []
         self.image_list_inmemory = {}
         self.last_loaded = -1
+        self.sample_shape = None
+        self.sample_dtype = None
+        self.cache_keys = []
+        self.packed_store = None
+        self.shared_memory = False
+        self.shared_arena = None
 
     def preprocess(self, use_cache=True):
         raise NotImplementedError("Dataset:preprocess")
@@ -60,13 +73,54 @@ class Dataset:
     def get_list(self):
         raise NotImplementedError("Dataset:get_list")
 
+    def use_packed_store(self, path=None):
+        """Serve samples from a single memory-mapped file instead of one .npy per image."""
+        if path is None:
+            path = os.path.join(self.cache_dir, "packed")
+        store = PackedStore(path)
+        if not store.is_valid(self):
+            start = time.time()
+            store.build(self)
+            log.info(
+                "packed {} images into {}, took={:.1f}sec".format(
+                    len(self.image_list), store.data_file, time.time() - start
+                )
+            )
+        self.packed_store = store
+
+    def use_shared_memory(self):
+        """Load query samples into a shared memory arena worker processes can attach to."""
+        self.shared_memory = True
+
     def load_query_samples(self, sample_list):
         self.image_list_inmemory = {}
-        for sample in sample_list:
-            self.image_list_inmemory[sample], _ = self.get_item(sample)
+        self.release_shared_arena()
+        if self.packed_store is not None:
+            # the whole store is mapped once, pages are faulted in on access
+            data = self.packed_store.open()
+            self.sample_shape, self.sample_dtype = data.shape[1:], data.dtype
+        elif self.shared_memory:
+            first, _ = self.get_item(sample_list[0])
+            arena = SharedArena(len(sample_list), first.shape, first.dtype)
+            arena.add(sample_list[0], first)
+            for sample in sample_list[1:]:
+                arena.add(sample, self.get_item(sample)[0])
+            self.shared_arena = arena
+            self.sample_shape, self.sample_dtype = arena.shape, arena.dtype
+        else:
+            for sample in sample_list:
+                self.image_list_inmemory[sample], _ = self.get_item(sample)
+                self.sample_shape = self.image_list_inmemory[sample].shape
+                self.sample_dtype = self.image_list_inmemory[sample].dtype
         self.last_loaded = time.time()
 
     def unload_query_samples(self, sample_list):
+        if self.packed_store is not None:
+            return
+        if self.shared_arena is not None:
+            # loadgen always unloads the whole set it loaded
+            self.release_shared_arena()
+            return
         if sample_list:
             for sample in sample_list:
                 if sample in self.image_list_inmemory:
@@ -74,14 +128,300 @@ class Dataset:
         else:
             self.image_list_inmemory = {}
 
-    def get_samples(self, id_list):
-        data = np.array([self.image_list_inmemory[id] for id in id_list])
+    def get_samples(self, id_list, out=None):
+        """Stack the samples, gathering into out[:len(id_list)] if a buffer is given."""
+        if self.packed_store is not None:
+            data = self.packed_store.get_samples(id_list, out)
+        elif self.shared_arena is not None:
+            data = self.shared_arena.get_samples(id_list, out)
+        elif out is not None:
+            data = out[: len(id_list)]
+            for i, id in enumerate(id_list):
+                data[i] = self.image_list_inmemory[id]
+        else:
+            data = np.array([self.image_list_inmemory[id] for id in id_list])
         return data, self.label_list[id_list]
 
+    def shared_samples(self, id_list):
+        """Like get_samples, but returns a SharedSamples reference instead of the data."""
+        return self.shared_arena.samples(id_list), self.label_list[id_list]
+
+    def release_shared_arena(self):
+        if self.shared_arena is not None:
+            self.shared_arena.close()
+            self.shared_arena = None
+
     def get_item_loc(self, id):
         raise NotImplementedError("Dataset:get_item_loc")
 
 
+class PackedStore:
+    """
+    All preprocessed images of a dataset in one fixed-stride .npy file that is
+    memory-mapped read-only, plus a small json index listing the images in
+    store order. The index must match the dataset's image list, otherwise
+    the store is rebuilt.
+    """
+
+    def __init__(self, path):
+        self.data_file = path + ".npy"
+        self.index_file = path + ".json"
+        self.data = None
+
+    def is_valid(self, ds):
+        if not os.path.exists(self.data_file) or not os.path.exists(
+            self.index_file
+        ):
+            return False
+        with open(self.index_file, "r") as f:
+            index = json.load(f)
+        return index["images"] == list(ds.image_list) and index.get(
+            "keys", []
+        ) == list(ds.cache_keys)
+
+    def build(self, ds):
+        count = ds.get_item_count()
+        first, _ = ds.get_item(0)
+        # write under a temporary name so an interrupted build is never
+        # mistaken for a valid store
+        tmp = self.data_file + ".tmp"
+        out = np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=first.dtype, shape=(count,) + first.shape
+        )
+        out[0] = first
+        for i in range(1, count):
+            out[i], _ = ds.get_item(i)
+        out.flush()
+        del out
+        os.replace(tmp, self.data_file)
+        index = {
+            "images": list(ds.image_list),
+            "keys": list(ds.cache_keys),
+            "shape": list(first.shape),
+            "dtype": first.dtype.str,
+        }
+        with open(self.index_file, "w") as f:
+            json.dump(index, f)
+        self.data = None
+
+    def open(self):
+        if self.data is None:
+            self.data = np.load(self.data_file, mmap_mode="r")
+        return self.data
+
+    def get_samples(self, id_list, out=None):
+        return gather_rows(self.open(), id_list, out)
+
+
+class SharedArena:
+    """
+    The loaded query samples in one multiprocessing.shared_memory block, one
+    fixed-size row per sample. The process that loads the samples owns the
+    block. Worker processes get SharedSamples references to rows of it and
+    read them as numpy views after attaching by name, so the samples are
+    neither pickled nor loaded again per process.
+    """
+
+    def __init__(self, count, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = count * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.data = np.ndarray(
+            (count,) + self.shape, dtype=self.dtype, buffer=self.shm.buf
+        )
+        self.rows = {}
+
+    def add(self, sample, img):
+        row = len(self.rows)
+        self.data[row] = img
+        self.rows[sample] = row
+
+    def get_samples(self, id_list, out=None):
+        return gather_rows(self.data, [self.rows[i] for i in id_list], out)
+
+    def samples(self, id_list):
+        return SharedSamples(
+            self.shm.name,
+            self.data.shape,
+            self.dtype.str,
+            [self.rows[i] for i in id_list],
+        )
+
+    def close(self):
+        self.data = None
+        self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # a batch still holds a view, the mapping goes away with it
+            pass
+
+
+class SharedSamples:
+    """Picklable reference to rows of a SharedArena, resolved in the worker process."""
+
+    def __init__(self, name, shape, dtype, rows):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def resolve(self):
+        return gather_rows(
+            attach_shared_arena(self.name, self.shape, self.dtype), self.rows
+        )
+
+
+# the arena this process is attached to, as (name, shm, data)
+_attached_arena = None
+
+
+def attach_shared_arena(name, shape, dtype):
+    global _attached_arena
+    if _attached_arena is not None and _attached_arena[0] == name:
+        return _attached_arena[2]
+    if _attached_arena is not None:
+        # the samples were reloaded into a new arena, drop the old one
+        try:
+            _attached_arena[1].close()
+        except BufferError:
+            pass
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    _attached_arena = (name, shm, data)
+    return data
+
+
+def gather_rows(data, rows, out=None):
+    """Returns data[rows], as a view if rows are consecutive."""
+    first = rows[0]
+    n = len(rows)
+    if rows[-1] - first == n - 1 and all(
+        rows[i] == first + i for i in range(n)
+    ):
+        # consecutive samples are a zero-copy view
+        return data[first: first + n]
+    # one gather straight into a batch array
+    if out is not None:
+        return np.take(data, rows, axis=0, out=out[:n])
+    return data[rows]
+
+
+class PreprocessCache:
+    """
+    Preprocessed images cached as <cache_dir>/<image_name>.npy. Every entry is
+    keyed on a hash of the preprocessing function (including the module level
+    helpers it calls), its parameters and the source file's size and mtime;
+    the keys live in a manifest next to the images so a changed image_size or
+    pre_process function never reuses a stale file. Misses are preprocessed
+    on a process pool and written atomically.
+    """
+
+    MANIFEST = "preprocess_manifest.json"
+
+    def __init__(self, cache_dir, pre_process, dims, need_transpose):
+        self.cache_dir = cache_dir
+        self.pre_process = pre_process
+        self.dims = dims
+        self.need_transpose = need_transpose
+        self.manifest_file = os.path.join(cache_dir, self.MANIFEST)
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                self.manifest = json.load(f)
+        h = hashlib.sha1(function_digest(pre_process).encode())
+        h.update(json.dumps([dims, need_transpose, cv2.__version__]).encode())
+        self.digest = h.hexdigest()
+        self.jobs = []
+
+    def add(self, image_name, src):
+        """Queue src for preprocessing unless its cached version is current, return the cache key."""
+        st = os.stat(src)
+        key = hashlib.sha1(
+            "{}:{}:{}".format(self.digest, st.st_size, st.st_mtime_ns).encode()
+        ).hexdigest()
+        dst = os.path.join(self.cache_dir, image_name) + ".npy"
+        if self.manifest.get(image_name) != key or not os.path.exists(dst):
+            self.jobs.append((image_name, src, dst, key))
+        return key
+
+    def run(self, workers):
+        """Preprocess all queued images, return the number of images processed."""
+        jobs, self.jobs = self.jobs, []
+        if not jobs:
+            return 0
+        workers = max(1, min(workers or 1, len(jobs)))
+        args = [
+            (self.pre_process, src, dst, self.dims, self.need_transpose)
+            for _, src, dst, _ in jobs
+        ]
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_pre_process_init
+            ) as executor:
+                for job, _ in zip(
+                    jobs,
+                    executor.map(
+                        _pre_process_file,
+                        args,
+                        chunksize=max(1, len(jobs) // (workers * 8)),
+                    ),
+                ):
+                    self.manifest[job[0]] = job[3]
+        finally:
+            # keep whatever finished so an interrupted run resumes from there
+            self._save_manifest()
+        return len(jobs)
+
+    def _save_manifest(self):
+        tmp = "{}.{}.tmp".format(self.manifest_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.manifest_file)
+
+
+@functools.lru_cache(maxsize=None)
+def function_digest(fn):
+    """Hash the source of fn and of the module level functions it calls."""
+    h = hashlib.sha1()
+    seen = set()
+    pending = [fn]
+    while pending:
+        f = pending.pop()
+        if f in seen:
+            continue
+        seen.add(f)
+        try:
+            h.update(inspect.getsource(f).encode())
+        except (OSError, TypeError):
+            h.update(f.__qualname__.encode())
+        for name in f.__code__.co_names:
+            g = f.__globals__.get(name)
+            if inspect.isfunction(g) and g.__module__ == f.__module__:
+                pending.append(g)
+    return h.hexdigest()
+
+
+def _pre_process_init():
+    # one image per process, don't let cv2 oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+def _pre_process_file(args):
+    pre_process, src, dst, dims, need_transpose = args
+    img_org = cv2.imread(src)
+    processed = pre_process(img_org, need_transpose=need_transpose, dims=dims)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = "{}.{}.tmp".format(dst, os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, processed)
+    os.replace(tmp, dst)
+
+
 #
 # Post processing
 #
@@ -144,6 +484,82 @@ class PostProcessArgMax:
         results["total"] = self.total
 
 
+def count_above(scores, threshold):
+    """Number of leading scores >= threshold, detections come sorted by score."""
+    below = np.flatnonzero(np.asarray(scores) < threshold)
+    return int(below[0]) if len(below) else len(scores)
+
+
+def pack_detections(ids, expected, detections):
+    """
+    Pack per image (boxes, scores, classes) detections into one float32 array
+    of [content_id, box0, box1, box2, box3, score, class] rows for the whole
+    batch. Returns one view into it per image and the number of detections
+    whose class is among the image's expected classes.
+    """
+    counts = [len(scores) for _, scores, _ in detections]
+    offsets = np.cumsum([0] + counts)
+    packed = np.empty((offsets[-1], 7), dtype=np.float32)
+    good = 0
+    for idx, (boxes, scores, classes) in enumerate(detections):
+        rows = packed[offsets[idx]: offsets[idx + 1]]
+        classes = np.asarray(classes).astype(np.int64)
+        rows[:, 0] = ids[idx]
+        rows[:, 1:5] = boxes
+        rows[:, 5] = scores
+        rows[:, 6] = classes
+        good += int(np.isin(classes, expected[idx][0]).sum())
+    return np.split(packed, offsets[1:-1]), good
+
+
+def coco_detections(results, content_ids, ds, inv_map=None):
+    """
+    Convert the packed per image results (boxes normalized as ymin, xmin,
+    ymax, xmax) into the [image_id, x1, y1, w, h, score, class] rows pycoco
+    wants, scaled to the original image sizes.
+    """
+    counts = [len(r) for r in results]
+    if not results or sum(counts) == 0:
+        return np.zeros((0, 7))
+    detections = np.concatenate(results).astype(np.float64)
+    image_idx = detections[:, 0].astype(np.int64)
+    # working with the coco index/id is error prone - extra check to make
+    # sure it is consistent
+    expected_idx = np.repeat(
+        np.asarray(content_ids[: len(results)], dtype=np.int64), counts)
+    for idx in np.flatnonzero(image_idx != expected_idx):
+        log.error(
+            "image_idx missmatch, lg={} / result={}".format(
+                image_idx[idx], expected_idx[idx]
+            )
+        )
+    sizes = np.asarray(ds.image_sizes, dtype=np.float64)[image_idx]
+    height, width = sizes[:, 0], sizes[:, 1]
+    ymin = detections[:, 1] * height
+    xmin = detections[:, 2] * width
+    ymax = detections[:, 3] * height
+    xmax = detections[:, 4] * width
+    out = np.empty_like(detections)
+    # map the index to the coco image id
+    out[:, 0] = np.asarray(ds.image_ids)[image_idx]
+    out[:, 1] = xmin
+    out[:, 2] = ymin
+    out[:, 3] = xmax - xmin
+    out[:, 4] = ymax - ymin
+    out[:, 5] = detections[:, 5]
+    out[:, 6] = detections[:, 6]
+    if inv_map is not None:
+        classes = detections[:, 6].astype(np.int64)
+        lookup = np.full(max(max(inv_map), classes.max()) + 1, -1)
+        lookup[list(inv_map.keys())] = list(inv_map.values())
+        cat_ids = np.where(classes >= 0, lookup[np.maximum(classes, 0)], -1)
+        for cat in np.unique(classes[cat_ids == -1]):
+            # FIXME:
+            log.info("finalize can't map category {}".format(cat))
+        out[:, 6] = cat_ids
+    return out
+
+
 #
 # pre-processing
 #
@@ -9,7 +9,6 @@ import os
 import re
 import time
 
-import cv2
 import numpy as np
 
 import dataset
@@ -65,58 +64,47 @@ class Imagenet(dataset.Dataset):
         if image_list is None:
             # by default look for val_map.txt
             image_list = os.path.join(data_path, "val_map.txt")
-        with open(image_list, "r") as fp:
-            for count, line in enumerate(fp):
-                pass
-        count = count + 1
-        if not self.count:
-            CNT = count
-        else:
-            CNT = count if count <= self.count else self.count
 
         os.makedirs(self.cache_dir, exist_ok=True)
 
         start = time.time()
-        N = threads
-        import concurrent.futures
-
-        if N > CNT:
-            N = CNT
+        cache = None
+        if pre_process:
+            cache = dataset.PreprocessCache(
+                self.cache_dir, pre_process, self.image_size, self.need_transpose
+            )
+        with open(image_list, "r") as fp:
+            for s in fp:
+                image_name, label = re.split(r"\s+", s.strip())
+                src = os.path.join(data_path, image_name)
+                if not pre_process:
+                    if not os.path.exists(src + ".npy"):
+                        # if the image does not exists ignore it
+                        self.not_found += 1
+                        continue
+                else:
+                    if not os.path.exists(src):
+                        # if the image does not exists ignore it
+                        self.not_found += 1
+                        continue
+                    self.cache_keys.append(cache.add(image_name, src))
+                self.image_list.append(image_name)
+                self.label_list.append(int(label))
+
+                # limit the dataset if requested
+                if self.count and len(self.image_list) >= self.count:
+                    break
 
         if not pre_process:
             log.info(
-                "Loading {} preprocessed images using {} threads".format(
-                    CNT, N))
-        else:
-            log.info("Preprocessing {} images using {} threads".format(CNT, N))
-
-        with open(image_list, "r") as f:
-            lists = []
-            image_lists = []
-            label_lists = []
-            for i in range(N):
-                lists.append([next(f) for x in range(int(CNT / N))])
-                image_lists.append([])
-                label_lists.append([])
-            if int(CNT % N) > 0:
-                lists.append([next(f) for x in range(int(CNT % N))])
-                image_lists.append([])
-                label_lists.append([])
-        executor = concurrent.futures.ThreadPoolExecutor(N)
-        futures = [
-            executor.submit(
-                self.process,
-                data_path,
-                item,
-                image_lists[lists.index(item)],
-                label_lists[lists.index(item)],
+                "Loading {} preprocessed images".format(len(self.image_list)))
+        elif cache.jobs:
+            log.info(
+                "Preprocessing {} images using {} processes".format(
+                    len(cache.jobs), min(threads, len(cache.jobs))
+                )
             )
-            for item in lists
-        ]
-        concurrent.futures.wait(futures)
-        for i in range(len(image_lists)):
-            self.image_list += image_lists[i]
-            self.label_list += label_lists[i]
+            cache.run(threads)
         time_taken = time.time() - start
         if not self.image_list:
             log.error("no images in image list found")
@@ -131,42 +119,6 @@ class Imagenet(dataset.Dataset):
         )
         self.label_list = np.array(self.label_list)
 
-    def process(self, data_path, files, image_list, label_list):
-        for s in files:
-            image_name, label = re.split(r"\s+", s.strip())
-            src = os.path.join(data_path, image_name)
-            if not self.pre_process:
-                if not os.path.exists(os.path.join(
-                        data_path, image_name) + ".npy"):
-                    # if the image does not exists ignore it
-                    self.not_found += 1
-                    continue
-            else:
-                if not os.path.exists(src):
-                    # if the image does not exists ignore it
-                    self.not_found += 1
-                    continue
-                os.makedirs(
-                    os.path.dirname(os.path.join(self.cache_dir, image_name)),
-                    exist_ok=True,
-                )
-                dst = os.path.join(self.cache_dir, image_name)
-                if not os.path.exists(dst + ".npy"):
-                    # cache a preprocessed version of the image
-                    img_org = cv2.imread(src)
-                    processed = self.pre_process(
-                        img_org,
-                        need_transpose=self.need_transpose,
-                        dims=self.image_size,
-                    )
-                    np.save(dst, processed)
-            image_list.append(image_name)
-            label_list.append(int(label))
-
-            # limit the dataset if requested
-            if self.count and len(self.image_list) >= self.count:
-                break
-
     def get_item(self, nr):
         """Get image by number in the list."""
         dst = os.path.join(self.cache_dir, self.image_list[nr])
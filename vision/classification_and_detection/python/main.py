@@ -7,7 +7,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
-import array
 import collections
 import json
 import logging
@@ -15,7 +14,7 @@ import os
 import sys
 import threading
 import time
-from queue import Queue
+from queue import Empty, Queue
 
 import mlperf_loadgen as lg
 import numpy as np
@@ -306,6 +305,12 @@ def get_args():
         default=os.cpu_count(),
         type=int,
         help="threads")
+    parser.add_argument(
+        "--instances",
+        default=1,
+        type=int,
+        help="model replicas, each in its own process pinned to its share of the cores",
+    )
     parser.add_argument("--qps", type=int, help="target qps")
     parser.add_argument("--cache", type=int, default=0, help="use cache")
     parser.add_argument(
@@ -322,6 +327,16 @@ def get_args():
         action="store_true",
         help="use preprocessed dataset instead of the original",
     )
+    parser.add_argument(
+        "--packed_store",
+        action="store_true",
+        help="serve preprocessed images from a single memory-mapped file in the cache dir",
+    )
+    parser.add_argument(
+        "--shared_memory",
+        action="store_true",
+        help="load query samples into shared memory that model worker processes read from",
+    )
     parser.add_argument(
         "--accuracy",
         action="store_true",
@@ -335,6 +350,11 @@ def get_args():
         "--debug",
         action="store_true",
         help="debug, turn traces on")
+    parser.add_argument(
+        "--accuracy-log-binary",
+        action="store_true",
+        help="also write the accuracy log as raw bytes, much faster to read than the hex json",
+    )
 
     # file for user LoadGen settings such as target QPS
     parser.add_argument(
@@ -363,6 +383,18 @@ def get_args():
         type=int,
         help="mlperf multi-stream samples per query",
     )
+    parser.add_argument(
+        "--max-batch-wait",
+        default=0.0,
+        type=float,
+        help="server: max seconds a sample waits for its dynamic batch to fill",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        default=0,
+        type=int,
+        help="run gather, predict and post-process as stages with queues of this many batches",
+    )
     args = parser.parse_args()
 
     # don't use defaults in argparser. Instead we default to a dict, override that with a profile
@@ -427,14 +459,44 @@ def get_backend(backend):
 class Item:
     """An item that we queue for processing by the thread pool."""
 
-    def __init__(self, query_id, content_id, img, label=None):
+    def __init__(self, query_id, content_id, img, label=None, buffer=None):
         self.query_id = query_id
         self.content_id = content_id
         self.img = img
         self.label = label
+        self.buffer = buffer
         self.start = time.time()
 
 
+class BatchBufferPool:
+    """Reusable max_batchsize input arrays that batches are gathered into."""
+
+    def __init__(self, max_batchsize, count):
+        self.max_batchsize = max_batchsize
+        self.count = count
+        self.allocated = 0
+        self.free = Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        try:
+            return self.free.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            # buffers are allocated lazily up to count, after that we wait
+            # for one to be released
+            if self.allocated < self.count:
+                self.allocated += 1
+                return np.empty((self.max_batchsize,) +
+                                tuple(shape), dtype=dtype)
+        return self.free.get()
+
+    def release(self, buffer):
+        if buffer is not None:
+            self.free.put(buffer)
+
+
 class RunnerBase:
     def __init__(self, model, ds, threads, post_proc=None, max_batchsize=128):
         self.take_accuracy = False
@@ -445,6 +507,8 @@ class RunnerBase:
         self.take_accuracy = False
         self.max_batchsize = max_batchsize
         self.result_timing = []
+        # enqueue runs each batch to completion, one buffer is enough
+        self.buffers = BatchBufferPool(max_batchsize, 1)
 
     def handle_tasks(self, tasks_queue):
         pass
@@ -456,47 +520,84 @@ class RunnerBase:
         self.post_process.start()
 
     def run_one_item(self, qitem):
-        # run the prediction
+        self.respond(qitem, self.predict(qitem))
+
+    def predict(self, qitem):
+        """Run the prediction for one batch, None if it failed."""
+        try:
+            return self.model.predict({self.model.inputs[0]: qitem.img})
+        except Exception as ex:  # pylint: disable=broad-except
+            src = [self.ds.get_item_loc(i) for i in qitem.content_id]
+            log.error("thread: failed on contentid=%s, %s", src, ex)
+            return None
+
+    def respond(self, qitem, results):
+        """Post-process the results of one batch and report them to loadgen."""
         processed_results = []
         try:
-            results = self.model.predict({self.model.inputs[0]: qitem.img})
-            processed_results = self.post_process(
-                results, qitem.content_id, qitem.label, self.result_dict
-            )
-            if self.take_accuracy:
-                self.post_process.add_results(processed_results)
-            self.result_timing.append(time.time() - qitem.start)
+            if results is None:
+                # since post_process will not run, fake empty responses
+                processed_results = [[]] * len(qitem.query_id)
+            else:
+                processed_results = self.post_process(
+                    results, qitem.content_id, qitem.label, self.result_dict
+                )
+                if self.take_accuracy:
+                    self.post_process.add_results(processed_results)
+                self.result_timing.append(time.time() - qitem.start)
         except Exception as ex:  # pylint: disable=broad-except
             src = [self.ds.get_item_loc(i) for i in qitem.content_id]
             log.error("thread: failed on contentid=%s, %s", src, ex)
             # since post_process will not run, fake empty responses
             processed_results = [[]] * len(qitem.query_id)
         finally:
-            response_array_refs = []
+            self.buffers.release(qitem.buffer)
+            # loadgen copies the response data before QuerySamplesComplete
+            # returns, so pointing it at the float32 arrays is enough
+            response_arrays = []
             response = []
             for idx, query_id in enumerate(qitem.query_id):
-                response_array = array.array(
-                    "B", np.array(processed_results[idx], np.float32).tobytes()
+                response_array = np.ascontiguousarray(
+                    processed_results[idx], np.float32
+                )
+                response_arrays.append(response_array)
+                response.append(
+                    lg.QuerySampleResponse(
+                        query_id,
+                        response_array.ctypes.data,
+                        response_array.nbytes)
                 )
-                response_array_refs.append(response_array)
-                bi = response_array.buffer_info()
-                response.append(lg.QuerySampleResponse(query_id, bi[0], bi[1]))
             lg.QuerySamplesComplete(response)
 
+    def get_item(self, query_id, idx):
+        """Gather the samples of one batch into a pooled buffer."""
+        if self.ds.shared_arena is not None and getattr(
+            self.model, "resolves_shared_samples", False
+        ):
+            # the model's worker processes read the batch from shared memory
+            data, label = self.ds.shared_samples(idx)
+            return Item(query_id, idx, data, label)
+        buffer = self.buffers.acquire(
+            self.ds.sample_shape, self.ds.sample_dtype)
+        data, label = self.ds.get_samples(idx, out=buffer)
+        return Item(query_id, idx, data, label, buffer)
+
     def enqueue(self, query_samples):
         idx = [q.index for q in query_samples]
         query_id = [q.id for q in query_samples]
         if len(query_samples) < self.max_batchsize:
-            data, label = self.ds.get_samples(idx)
-            self.run_one_item(Item(query_id, idx, data, label))
+            self.run_one_item(self.get_item(query_id, idx))
         else:
             bs = self.max_batchsize
             for i in range(0, len(idx), bs):
-                data, label = self.ds.get_samples(idx[i: i + bs])
                 self.run_one_item(
-                    Item(query_id[i: i + bs], idx[i: i + bs], data, label)
+                    self.get_item(query_id[i: i + bs], idx[i: i + bs])
                 )
 
+    def get_stats(self):
+        """Runner specific statistics to write next to results.json."""
+        return None
+
     def finish(self):
         pass
 
@@ -507,6 +608,8 @@ class QueueRunner(RunnerBase):
         self.tasks = Queue(maxsize=threads * 4)
         self.workers = []
         self.result_dict = {}
+        # one buffer per queued item, per worker and for the issuing thread
+        self.buffers = BatchBufferPool(max_batchsize, threads * 5 + 1)
 
         for _ in range(self.threads):
             worker = threading.Thread(
@@ -531,14 +634,12 @@ class QueueRunner(RunnerBase):
         idx = [q.index for q in query_samples]
         query_id = [q.id for q in query_samples]
         if len(query_samples) < self.max_batchsize:
-            data, label = self.ds.get_samples(idx)
-            self.tasks.put(Item(query_id, idx, data, label))
+            self.tasks.put(self.get_item(query_id, idx))
         else:
             bs = self.max_batchsize
             for i in range(0, len(idx), bs):
                 ie = i + bs
-                data, label = self.ds.get_samples(idx[i:ie])
-                self.tasks.put(Item(query_id[i:ie], idx[i:ie], data, label))
+                self.tasks.put(self.get_item(query_id[i:ie], idx[i:ie]))
 
     def finish(self):
         # exit all threads
@@ -548,6 +649,169 @@ class QueueRunner(RunnerBase):
             worker.join()
 
 
+class DynamicBatchRunner(QueueRunner):
+    """
+    QueueRunner for the Server scenario that coalesces samples from separate
+    issue_queries calls into batches of up to max_batchsize. A batch is
+    dispatched once it is full or its oldest sample waited max_wait seconds.
+    """
+
+    def __init__(
+        self, model, ds, threads, post_proc=None, max_batchsize=128, max_wait=0.0
+    ):
+        super().__init__(model, ds, threads, post_proc, max_batchsize)
+        self.max_wait = max_wait
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.stop = False
+        self.batch_sizes = []
+        self.batch_waits = []
+        self.batcher = threading.Thread(target=self.form_batches)
+        self.batcher.daemon = True
+        self.batcher.start()
+
+    def start_run(self, result_dict, take_accuracy):
+        super().start_run(result_dict, take_accuracy)
+        self.batch_sizes = []
+        self.batch_waits = []
+
+    def enqueue(self, query_samples):
+        now = time.time()
+        with self.cond:
+            self.pending.extend((q.id, q.index, now) for q in query_samples)
+            self.cond.notify()
+
+    def form_batches(self):
+        """Batcher thread."""
+        while True:
+            with self.cond:
+                while not self.pending and not self.stop:
+                    self.cond.wait()
+                if not self.pending:
+                    break
+                deadline = self.pending[0][2] + self.max_wait
+                while len(self.pending) < self.max_batchsize and not self.stop:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                n = min(len(self.pending), self.max_batchsize)
+                batch = [self.pending.popleft() for _ in range(n)]
+            qitem = self.get_item([b[0] for b in batch], [b[1] for b in batch])
+            # latency is measured from the arrival of the oldest sample
+            qitem.start = batch[0][2]
+            self.batch_sizes.append(n)
+            self.batch_waits.append(time.time() - qitem.start)
+            self.tasks.put(qitem)
+
+    def get_stats(self):
+        if not self.batch_sizes:
+            return None
+        percentiles = [50.0, 90.0, 99.0]
+        return {
+            "batches": len(self.batch_sizes),
+            "max_wait": self.max_wait,
+            "batch_size": {
+                "mean": float(np.mean(self.batch_sizes)),
+                "histogram": {
+                    str(k): v
+                    for k, v in sorted(collections.Counter(self.batch_sizes).items())
+                },
+            },
+            "wait": {
+                "mean": float(np.mean(self.batch_waits)),
+                "percentiles": {
+                    str(k): v
+                    for k, v in zip(
+                        percentiles,
+                        np.percentile(self.batch_waits, percentiles).tolist(),
+                    )
+                },
+            },
+        }
+
+    def finish(self):
+        with self.cond:
+            self.stop = True
+            self.cond.notify()
+        self.batcher.join()
+        super().finish()
+
+
+class PipelineRunner(RunnerBase):
+    """
+    Runs batches through three stages, each with its own threads and a
+    bounded queue of depth batches in front of it: gather the samples into a
+    pooled buffer, predict, then post-process and respond to loadgen. While
+    one batch is predicted the next ones are gathered and the previous ones
+    post-processed.
+    """
+
+    def __init__(
+        self, model, ds, threads, post_proc=None, max_batchsize=128, depth=2
+    ):
+        super().__init__(model, ds, threads, post_proc, max_batchsize)
+        self.depth = depth
+        # one buffer per queued batch and per batch a stage is working on
+        self.buffers = BatchBufferPool(max_batchsize, 2 * depth + threads + 2)
+        self.stages = []
+        self.gather_queue = self.add_stage(self.gather, 1)
+        self.predict_queue = self.add_stage(self.run_predict, threads)
+        self.respond_queue = self.add_stage(self.run_respond, 1)
+
+    def add_stage(self, handler, threads):
+        tasks = Queue(maxsize=self.depth)
+        workers = []
+        for _ in range(threads):
+            worker = threading.Thread(
+                target=self.handle_tasks, args=(tasks, handler))
+            worker.daemon = True
+            workers.append(worker)
+            worker.start()
+        self.stages.append((tasks, workers))
+        return tasks
+
+    def handle_tasks(self, tasks_queue, handler=None):
+        """Stage worker thread."""
+        while True:
+            task = tasks_queue.get()
+            if task is None:
+                # None in the queue indicates the parent want us to exit
+                tasks_queue.task_done()
+                break
+            handler(task)
+            tasks_queue.task_done()
+
+    def gather(self, task):
+        query_id, idx, start = task
+        qitem = self.get_item(query_id, idx)
+        qitem.start = start
+        self.predict_queue.put(qitem)
+
+    def run_predict(self, qitem):
+        self.respond_queue.put((qitem, self.predict(qitem)))
+
+    def run_respond(self, task):
+        self.respond(*task)
+
+    def enqueue(self, query_samples):
+        now = time.time()
+        idx = [q.index for q in query_samples]
+        query_id = [q.id for q in query_samples]
+        bs = self.max_batchsize
+        for i in range(0, len(idx), bs):
+            self.gather_queue.put((query_id[i: i + bs], idx[i: i + bs], now))
+
+    def finish(self):
+        # stop the stages in order, so every stage drains into the next
+        # before that one is stopped
+        for tasks, workers in self.stages:
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+
+
 def add_results(
     final_results, name, result_dict, result_list, took, show_accuracy=False
 ):
@@ -609,6 +873,10 @@ def main():
         backend.max_batchsize = args.max_batchsize
         backend.arena_num = args.threads
         backend.arena_size = 4
+    elif args.instances > 1:
+        from backend_multi_instance import BackendMultiInstance
+
+        backend = BackendMultiInstance(backend, args.instances)
 
     # override image format if given
     image_format = args.data_format if args.data_format else backend.image_format()
@@ -637,6 +905,10 @@ def main():
         threads=args.threads,
         **kwargs
     )
+    if args.packed_store:
+        ds.use_packed_store()
+    if args.shared_memory:
+        ds.use_shared_memory()
     # load model to backend
     if args.device == "tpu":
         model = backend.load(
@@ -683,11 +955,22 @@ def main():
     runner_map = {
         lg.TestScenario.SingleStream: RunnerBase,
         lg.TestScenario.MultiStream: QueueRunner,
-        lg.TestScenario.Server: QueueRunner,
+        lg.TestScenario.Server: DynamicBatchRunner,
         lg.TestScenario.Offline: QueueRunner,
     }
+    runner_kwargs = {}
+    if scenario == lg.TestScenario.Server:
+        runner_kwargs["max_wait"] = args.max_batch_wait
+    elif args.pipeline_depth > 0:
+        runner_map[scenario] = PipelineRunner
+        runner_kwargs["depth"] = args.pipeline_depth
     runner = runner_map[scenario](
-        model, ds, args.threads, post_proc=post_proc, max_batchsize=args.max_batchsize
+        model,
+        ds,
+        args.threads,
+        post_proc=post_proc,
+        max_batchsize=args.max_batchsize,
+        **runner_kwargs
     )
 
     def issue_queries(query_samples):
@@ -699,6 +982,7 @@ def main():
     log_output_settings = lg.LogOutputSettings()
     log_output_settings.outdir = output_dir
     log_output_settings.copy_summary_to_stdout = False
+    log_output_settings.accuracy_log_binary = args.accuracy_log_binary
     log_settings = lg.LogSettings()
     log_settings.enable_trace = args.debug
     log_settings.log_output = log_output_settings
@@ -775,6 +1059,10 @@ def main():
     if args.output:
         with open("results.json", "w") as f:
             json.dump(final_results, f, sort_keys=True, indent=4)
+        runner_stats = runner.get_stats()
+        if runner_stats:
+            with open("runner_stats.json", "w") as f:
+                json.dump(runner_stats, f, sort_keys=True, indent=4)
 
 
 if __name__ == "__main__":
@@ -3,7 +3,6 @@ import logging
 import os
 import time
 
-import cv2
 import numpy as np
 from pycocotools.cocoeval import COCOeval
 import pycoco
@@ -71,6 +70,11 @@ class OpenImages(dataset.Dataset):
 
         os.makedirs(self.cache_dir, exist_ok=True)
         start = time.time()
+        cache = None
+        if pre_process:
+            cache = dataset.PreprocessCache(
+                self.cache_dir, pre_process, self.image_size, self.need_transpose
+            )
         images = {}
         with open(image_list, "r") as f:
             openimages = json.load(f)
@@ -115,20 +119,7 @@ class OpenImages(dataset.Dataset):
                     # if the image does not exists ignore it
                     not_found += 1
                     continue
-                os.makedirs(
-                    os.path.dirname(os.path.join(self.cache_dir, image_name)),
-                    exist_ok=True,
-                )
-                dst = os.path.join(self.cache_dir, image_name)
-                if not os.path.exists(dst + ".npy"):
-                    # cache a preprocessed version of the image
-                    img_org = cv2.imread(src)
-                    processed = self.pre_process(
-                        img_org,
-                        need_transpose=self.need_transpose,
-                        dims=self.image_size,
-                    )
-                    np.save(dst, processed)
+                self.cache_keys.append(cache.add(image_name, src))
 
             self.image_ids.append(image_id)
             self.image_list.append(image_name)
@@ -139,6 +130,13 @@ class OpenImages(dataset.Dataset):
             if self.count and len(self.image_list) >= self.count:
                 break
 
+        if cache and cache.jobs:
+            log.info(
+                "Preprocessing {} images using {} processes".format(
+                    len(cache.jobs), min(threads, len(cache.jobs))
+                )
+            )
+            cache.run(threads)
         time_taken = time.time() - start
         if not self.image_list:
             log.error("no images in image list found")
@@ -196,35 +194,28 @@ class PostProcessOpenImages:
         # results come as:
         # tensorflow, ssd-mobilenet:
         # num_detections,detection_boxes,detection_scores,detection_classes
-        processed_results = []
+        detections = []
         # batch size
         bs = len(results[0])
         for idx in range(0, bs):
-            # keep the content_id from loadgen to handle content_id's without
-            # results
-            self.content_ids.append(ids[idx])
-            processed_results.append([])
             detection_num = int(results[0][idx])
-            detection_boxes = results[1][idx]
-            detection_classes = results[3][idx]
-            expected_classes = expected[idx][0]
-            for detection in range(0, detection_num):
-                detection_class = int(detection_classes[detection])
-                if detection_class in expected_classes:
-                    self.good += 1
-                box = detection_boxes[detection]
-                processed_results[idx].append(
-                    [
-                        float(ids[idx]),
-                        box[0],
-                        box[1],
-                        box[2],
-                        box[3],
-                        results[2][idx][detection],
-                        float(detection_class),
-                    ]
+            detections.append(
+                (
+                    results[1][idx][:detection_num],
+                    results[2][idx][:detection_num],
+                    results[3][idx][:detection_num],
                 )
-                self.total += 1
+            )
+        return self.pack(ids, expected, detections)
+
+    def pack(self, ids, expected, detections):
+        # keep the content_id from loadgen to handle content_id's without
+        # results
+        self.content_ids.extend(ids[: len(detections)])
+        processed_results, good = dataset.pack_detections(
+            ids, expected, detections)
+        self.good += good
+        self.total += sum(len(r) for r in processed_results)
         return processed_results
 
     def start(self):
@@ -236,6 +227,7 @@ class PostProcessOpenImages:
         result_dict["good"] += self.good
         result_dict["total"] += self.total
 
+        inv_map = None
         if self.use_inv_map:
             # for pytorch
             label_map = {}
@@ -245,51 +237,15 @@ class PostProcessOpenImages:
                 label_map[cat["id"]] = cnt + 1
             inv_map = {v: k for k, v in label_map.items()}
 
-        detections = []
-        image_indices = []
-        for batch in range(0, len(self.results)):
-            image_indices.append(self.content_ids[batch])
-            for idx in range(0, len(self.results[batch])):
-                detection = self.results[batch][idx]
-                # this is the index of the coco image
-                image_idx = int(detection[0])
-                if image_idx != self.content_ids[batch]:
-                    # working with the coco index/id is error prone - extra
-                    # check to make sure it is consistent
-                    log.error(
-                        "image_idx missmatch, lg={} / result={}".format(
-                            image_idx, self.content_ids[batch]
-                        )
-                    )
-                # map the index to the coco image id
-                detection[0] = ds.image_ids[image_idx]
-                height, width = ds.image_sizes[image_idx]
-                # box comes from model as: ymin, xmin, ymax, xmax
-                ymin = detection[1] * height
-                xmin = detection[2] * width
-                ymax = detection[3] * height
-                xmax = detection[4] * width
-                # pycoco wants {imageID,x1,y1,w,h,score,class}
-                detection[1] = xmin
-                detection[2] = ymin
-                detection[3] = xmax - xmin
-                detection[4] = ymax - ymin
-                if self.use_inv_map:
-                    cat_id = inv_map.get(int(detection[6]), -1)
-                    if cat_id == -1:
-                        # FIXME:
-                        log.info(
-                            "finalize can't map category {}".format(
-                                int(detection[6]))
-                        )
-                    detection[6] = cat_id
-                detections.append(np.array(detection))
+        detections = dataset.coco_detections(
+            self.results, self.content_ids, ds, inv_map)
 
         # map indices to coco image id's
-        image_ids = [ds.image_ids[i] for i in image_indices]
+        image_ids = [ds.image_ids[i]
+                     for i in self.content_ids[: len(self.results)]]
         self.results = []
         cocoGt = pycoco.COCO(ds.annotation_file)
-        cocoDt = cocoGt.loadRes(np.array(detections))
+        cocoDt = cocoGt.loadRes(detections)
         cocoEval = COCOeval(cocoGt, cocoDt, iouType="bbox")
         cocoEval.params.imgIds = image_ids
         cocoEval.evaluate()
@@ -323,49 +279,27 @@ class PostProcessOpenImagesRetinanet(PostProcessOpenImages):
         if self.dict_format:
             # If the output of the model is in dictionary format. This happens
             # for the model retinanet-pytorch
-            bboxes_ = [e["boxes"].cpu() for e in results]
-            labels_ = [e["labels"].cpu() for e in results]
-            scores_ = [e["scores"].cpu() for e in results]
-            results = [bboxes_, labels_, scores_]
+            bboxes_ = [e["boxes"].cpu().numpy() for e in results]
+            labels_ = [e["labels"].cpu().numpy() for e in results]
+            scores_ = [e["scores"].cpu().numpy() for e in results]
         else:
             bboxes_ = [results[0]]
             labels_ = [results[1]]
             scores_ = [results[2]]
-            results = [bboxes_, labels_, scores_]
 
-        processed_results = []
-        content_ids = []
+        # box comes from model as: xmin, ymin, xmax, ymax
+        # box comes with dimentions in the range of [0, height]
+        # and [0, width] respectively. It is necesary to scale
+        # them in the range [0, 1]
+        scale = np.array(
+            [self.height, self.width, self.height, self.width], dtype=np.float32
+        )
+        detections = []
         # batch size
-        bs = len(results[0])
+        bs = len(bboxes_)
         for idx in range(0, bs):
-            content_ids.append(ids[idx])
-            processed_results.append([])
-            detection_boxes = results[0][idx]
-            detection_classes = results[1][idx]
-            expected_classes = expected[idx][0]
-            scores = results[2][idx]
-            for detection in range(0, len(scores)):
-                if scores[detection] < self.score_threshold:
-                    break
-                detection_class = int(detection_classes[detection])
-                if detection_class in expected_classes:
-                    self.good += 1
-                box = detection_boxes[detection]
-                # box comes from model as: xmin, ymin, xmax, ymax
-                # box comes with dimentions in the range of [0, height]
-                # and [0, width] respectively. It is necesary to scale
-                # them in the range [0, 1]
-                processed_results[idx].append(
-                    [
-                        float(ids[idx]),
-                        box[1] / self.height,
-                        box[0] / self.width,
-                        box[3] / self.height,
-                        box[2] / self.width,
-                        scores[detection],
-                        float(detection_class),
-                    ]
-                )
-                self.total += 1
-        self.content_ids.extend(content_ids)
-        return processed_results
+            scores = np.asarray(scores_[idx])
+            n = dataset.count_above(scores, self.score_threshold)
+            boxes = np.asarray(bboxes_[idx])[:n][:, [1, 0, 3, 2]] / scale
+            detections.append((boxes, scores[:n], np.asarray(labels_[idx])[:n]))
+        return self.pack(ids, expected, detections)
@@ -52,8 +52,9 @@ import time
 # from matplotlib.patches import Polygon
 import numpy as np
 import copy
-import itertools
+import multiprocessing
 from pycocotools import mask as maskUtils
+from pycocotools.cocoeval import COCOeval
 import os
 from collections import defaultdict
 import sys
@@ -121,6 +122,31 @@ class COCO:
         self.catToImgs = catToImgs
         self.imgs = imgs
         self.cats = cats
+        self.createColumnarIndex()
+
+    def createColumnarIndex(self):
+        """
+        Annotation ids, image ids, category ids, areas and crowd flags as numpy
+        columns sorted by image id (annotation order is kept within an image),
+        so getAnnIds can slice per image and mask per category.
+        """
+        anns = self.dataset.get("annotations", [])
+        img_ids = np.array([ann["image_id"] for ann in anns], dtype=np.int64)
+        order = np.argsort(img_ids, kind="stable")
+        self.annImgIds = img_ids[order]
+        self.annIds = np.array([ann["id"]
+                               for ann in anns], dtype=np.int64)[order]
+        self.annCatIds = np.array(
+            [ann["category_id"] for ann in anns], dtype=np.int64
+        )[order]
+        self.annAreas = np.array(
+            [ann.get("area", 0) for ann in anns], dtype=np.float64
+        )[order]
+        self.annIsCrowd = np.array(
+            [ann.get("iscrowd", 0) for ann in anns], dtype=np.int64
+        )[order]
+        # position of every annotation of the dataset within the columns
+        self.annRows = np.argsort(order, kind="stable")
 
     def info(self):
         """
@@ -142,35 +168,29 @@ class COCO:
         imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
         catIds = catIds if _isArrayLike(catIds) else [catIds]
 
-        if len(imgIds) == len(catIds) == len(areaRng) == 0:
-            anns = self.dataset["annotations"]
-        else:
-            if not len(imgIds) == 0:
-                lists = [
-                    self.imgToAnns[imgId] for imgId in imgIds if imgId in self.imgToAnns
-                ]
-                anns = list(itertools.chain.from_iterable(lists))
-            else:
-                anns = self.dataset["annotations"]
-            anns = (
-                anns
-                if len(catIds) == 0
-                else [ann for ann in anns if ann["category_id"] in catIds]
-            )
-            anns = (
-                anns
-                if len(areaRng) == 0
-                else [
-                    ann
-                    for ann in anns
-                    if ann["area"] > areaRng[0] and ann["area"] < areaRng[1]
-                ]
+        if len(imgIds) == len(catIds) == len(areaRng) == 0 and iscrowd is None:
+            return [ann["id"] for ann in self.dataset["annotations"]]
+        if not len(imgIds) == 0:
+            # rows of every requested image, in the order the images were
+            # given
+            imgIds = np.asarray(imgIds, dtype=np.int64)
+            lo = np.searchsorted(self.annImgIds, imgIds, side="left")
+            hi = np.searchsorted(self.annImgIds, imgIds, side="right")
+            counts = hi - lo
+            rows = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(
+                counts.sum()
             )
-        if not iscrowd is None:
-            ids = [ann["id"] for ann in anns if ann["iscrowd"] == iscrowd]
         else:
-            ids = [ann["id"] for ann in anns]
-        return ids
+            rows = self.annRows
+        mask = np.ones(len(rows), dtype=bool)
+        if not len(catIds) == 0:
+            mask &= np.isin(self.annCatIds[rows], catIds)
+        if not len(areaRng) == 0:
+            areas = self.annAreas[rows]
+            mask &= (areas > areaRng[0]) & (areas < areaRng[1])
+        if not iscrowd is None:
+            mask &= self.annIsCrowd[rows] == iscrowd
+        return self.annIds[rows[mask]].tolist()
 
     def getCatIds(self, catNms=[], supNms=[], catIds=[]):
         """
@@ -458,20 +478,21 @@ class COCO:
         assert isinstance(data, np.ndarray)
         print(data.shape)
         assert data.shape[1] == 7
-        N = data.shape[0]
-        ann = []
-        for i in range(N):
-            if i % 1000000 == 0:
-                print("{}/{}".format(i, N))
-            ann += [
-                {
-                    "image_id": int(data[i, 0]),
-                    "bbox": [data[i, 1], data[i, 2], data[i, 3], data[i, 4]],
-                    "score": data[i, 5],
-                    "category_id": int(data[i, 6]),
-                }
-            ]
-        return ann
+        image_ids = data[:, 0].astype(np.int64).tolist()
+        bboxes = data[:, 1:5].tolist()
+        scores = data[:, 5].tolist()
+        category_ids = data[:, 6].astype(np.int64).tolist()
+        return [
+            {
+                "image_id": image_id,
+                "bbox": bbox,
+                "score": score,
+                "category_id": category_id,
+            }
+            for image_id, bbox, score, category_id in zip(
+                image_ids, bboxes, scores, category_ids
+            )
+        ]
 
     def annToRLE(self, ann):
         """
@@ -502,3 +523,75 @@ class COCO:
         rle = self.annToRLE(ann)
         m = maskUtils.decode(rle)
         return m
+
+
+_shard_eval = None
+
+
+def _evaluateShard(imgIds):
+    cocoEval = _shard_eval
+    cocoEval.params.imgIds = imgIds
+    COCOeval.evaluate(cocoEval)
+    return cocoEval.evalImgs
+
+
+class COCOevalParallel(COCOeval):
+    """
+    COCOeval that shards the per image IoU computation and matching of
+    evaluate() across forked processes by image. The merged evalImgs are in
+    the same order as COCOeval's, so accumulate() and summarize() are
+    unchanged. Meant for standalone scripts like tools/accuracy-coco.py:
+    forking a process that runs other threads, like main.py with loadgen
+    and the backend, is not safe.
+    """
+
+    def __init__(self, cocoGt=None, cocoDt=None,
+                 iouType="segm", processes=None):
+        super().__init__(cocoGt, cocoDt, iouType)
+        self.processes = processes if processes else os.cpu_count()
+
+    def evaluate(self):
+        p = self.params
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+        processes = min(self.processes, len(p.imgIds))
+        if (
+            processes <= 1
+            or "fork" not in multiprocessing.get_all_start_methods()
+        ):
+            return super().evaluate()
+
+        tic = time.time()
+        print(
+            "Running per image evaluation in {} processes...".format(processes))
+        shards = [list(s) for s in np.array_split(p.imgIds, processes)]
+        # the workers inherit self through fork instead of pickling the
+        # ground truth and detections
+        global _shard_eval
+        _shard_eval = self
+        try:
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                results = pool.map(_evaluateShard, shards)
+        finally:
+            _shard_eval = None
+
+        # evalImgs is ordered category, area range, image - stitch the
+        # shards back together along the image axis
+        K = len(p.catIds) if p.useCats else 1
+        A = len(p.areaRng)
+        evalImgs = np.empty((K, A, len(p.imgIds)), dtype=object)
+        offset = 0
+        for shard, shardImgs in zip(shards, results):
+            shardArr = np.empty(len(shardImgs), dtype=object)
+            shardArr[:] = shardImgs
+            evalImgs[:, :, offset: offset + len(shard)] = shardArr.reshape(
+                K, A, len(shard)
+            )
+            offset += len(shard)
+        self.evalImgs = evalImgs.ravel().tolist()
+        self.ious = {}
+        self._paramsEval = copy.deepcopy(self.params)
+        print("DONE (t={:0.2f}s).".format(time.time() - tic))
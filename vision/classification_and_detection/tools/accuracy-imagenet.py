@@ -8,10 +8,11 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
-import json
 
 import numpy as np
 
+from mlcommons_loadgen.accuracy_log import read_accuracy_log
+
 
 # pylint: disable=missing-docstring
 
@@ -51,12 +52,13 @@ def main():
             cols = line.strip().split()
             imagenet.append((cols[0], int(cols[1])))
 
-    with open(args.mlperf_accuracy_file, "r") as f:
-        results = json.load(f)
+    results = read_accuracy_log(args.mlperf_accuracy_file)
 
     seen = set()
     good = 0
+    found_results = 0
     for j in results:
+        found_results += 1
         idx = j["qsl_idx"]
 
         # de-dupe in case loadgen sends the same image multiple times
@@ -68,7 +70,7 @@ def main():
         img, label = imagenet[idx]
 
         # reconstruct label from mlperf accuracy log
-        data = np.frombuffer(bytes.fromhex(j["data"]), dtype_map[args.dtype])
+        data = np.frombuffer(j["data"], dtype_map[args.dtype])
         found = int(data[0])
         if label == found:
             good += 1
@@ -82,7 +84,7 @@ def main():
         )
     )
     if args.verbose:
-        print("found and ignored {} dupes".format(len(results) - len(seen)))
+        print("found and ignored {} dupes".format(found_results - len(seen)))
 
 
 if __name__ == "__main__":
@@ -11,11 +11,15 @@ from __future__ import unicode_literals
 import argparse
 import json
 import os
+import sys
 
 import numpy as np
 
-from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python")
+)
+from pycoco import COCO, COCOevalParallel  # noqa: E402
+from mlcommons_loadgen.accuracy_log import read_accuracy_log
 
 # pylint: disable=missing-docstring
 
@@ -40,6 +44,12 @@ def get_args():
     parser.add_argument(
         "--use-inv-map", action="store_true", help="use inverse label map"
     )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="processes to shard the per image evaluation across",
+    )
     args = parser.parse_args()
     return args
 
@@ -57,8 +67,7 @@ def main():
         # First label in inv_map is not used
         inv_map = [0] + cocoGt.getCatIds()
 
-    with open(args.mlperf_accuracy_file, "r") as f:
-        results = json.load(f)
+    results = read_accuracy_log(args.mlperf_accuracy_file)
 
     detections = []
     image_ids = set()
@@ -66,7 +75,9 @@ def main():
     no_results = 0
     image_map = cocoGt.dataset["images"]
 
+    found_results = 0
     for j in results:
+        found_results += 1
         idx = j["qsl_idx"]
         # de-dupe in case loadgen sends the same image multiple times
         if idx in seen:
@@ -78,7 +89,7 @@ def main():
         # id, box[0], box[1], box[2], box[3], score, detection_class
         # note that id is a index into instances_val2017.json, not the actual
         # image_id
-        data = np.frombuffer(bytes.fromhex(j["data"]), np.float32)
+        data = np.frombuffer(j["data"], np.float32)
         if len(data) < 7:
             # handle images that had no results
             image = image_map[idx]
@@ -135,7 +146,9 @@ def main():
     cocoDt = cocoGt.loadRes(
         args.output_file
     )  # Load from file to bypass error with Python3
-    cocoEval = COCOeval(cocoGt, cocoDt, iouType="bbox")
+    cocoEval = COCOevalParallel(
+        cocoGt, cocoDt, iouType="bbox", processes=args.processes
+    )
     cocoEval.params.imgIds = list(image_ids)
     cocoEval.evaluate()
     cocoEval.accumulate()
@@ -143,10 +156,10 @@ def main():
 
     print("mAP={:.3f}%".format(100.0 * cocoEval.stats[0]))
     if args.verbose:
-        print("found {} results".format(len(results)))
+        print("found {} results".format(found_results))
         print("found {} images".format(len(image_ids)))
         print("found {} images with no results".format(no_results))
-        print("ignored {} dupes".format(len(results) - len(seen)))
+        print("ignored {} dupes".format(found_results - len(seen)))
 
 
 if __name__ == "__main__":